@@ -0,0 +1,92 @@
+from typing import Optional
+import numpy as np
+
+__all__ = ["draw_bootstraps", "bootstrap_counts", "bootstrap_auroc"]
+
+
+def draw_bootstraps(
+    labels: np.ndarray, n_bootstraps: int, max_redraws: int = 1000, seed: Optional[int] = None
+) -> np.ndarray:
+    """Draw bootstraps (samples with replacement) that each contain every class at least once.
+
+    All bootstraps are drawn as one array; the ones that miss a class are found with a single bincount and redrawn
+    together, until none are left.
+
+    Args:
+        labels (np.ndarray): Class index of each sample, of shape [n_samples]; negative for samples without a label.
+        n_bootstraps (int): Number of bootstraps.
+        max_redraws (int, optional): Maximum number of rounds of redrawing. Defaults to 1000.
+        seed (Optional[int], optional): Random seed. Defaults to None.
+
+    Returns:
+        np.ndarray: Indices of the samples in each bootstrap, of shape [n_bootstraps, n_samples].
+    """
+    rng = np.random.default_rng(seed)
+    labels = np.asarray(labels, dtype=np.int64)
+    n_samples = len(labels)
+    classes = np.unique(labels[labels >= 0])  # classes that each bootstrap needs to contain
+    labels = np.where(labels >= 0, labels, labels.max() + 1)  # count unlabeled samples as a class of their own
+    bootstraps = rng.integers(0, n_samples, size=(n_bootstraps, n_samples))
+    missing = np.arange(n_bootstraps)
+    for _ in range(max_redraws):
+        counts = bootstrap_counts(labels[bootstraps[missing]], labels.max() + 1)
+        missing = missing[(counts[:, classes] == 0).any(axis=1)]
+        if len(missing) == 0:
+            return bootstraps
+        bootstraps[missing] = rng.integers(0, n_samples, size=(len(missing), n_samples))
+    raise RuntimeError(f"{len(missing)} bootstraps still miss a class after {max_redraws} redraws")
+
+
+def bootstrap_counts(bootstraps: np.ndarray, n_samples: int) -> np.ndarray:
+    """Number of times each sample occurs in each bootstrap.
+
+    Args:
+        bootstraps (np.ndarray): Indices of the samples in each bootstrap, of shape [n_bootstraps, bootstrap_size].
+        n_samples (int): Total number of samples.
+
+    Returns:
+        np.ndarray: Counts of shape [n_bootstraps, n_samples].
+    """
+    n_bootstraps = len(bootstraps)
+    flat = (bootstraps.astype(np.int64) + n_samples * np.arange(n_bootstraps)[:, None]).ravel()
+    return np.bincount(flat, minlength=n_bootstraps * n_samples).reshape(n_bootstraps, n_samples)
+
+
+def _weighted_auroc(scores: np.ndarray, positive: np.ndarray, weights: np.ndarray) -> np.ndarray:
+    """Weighted Mann-Whitney AUROC of binary labels for each row of weights ([n_bootstraps, n_samples]) at once."""
+    order = np.argsort(scores, kind="stable")
+    _, group_starts = np.unique(scores[order], return_index=True)  # tied scores form one group
+    weights = weights[:, order].astype(np.float64)
+    positive = positive[order]
+    pos = np.add.reduceat(weights * positive, group_starts, axis=1)  # [n_bootstraps, n_groups]
+    neg = np.add.reduceat(weights * ~positive, group_starts, axis=1)
+    neg_below = np.cumsum(neg, axis=1) - neg
+    # Each positive beats the negatives with lower scores, and ties count half
+    wins = (pos * (neg_below + 0.5 * neg)).sum(axis=1)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return wins / (pos.sum(axis=1) * neg.sum(axis=1))
+
+
+def bootstrap_auroc(preds: np.ndarray, targets: np.ndarray, bootstraps: np.ndarray) -> np.ndarray:
+    """One-vs-rest macro AUROC of many bootstraps at once (like torchmetrics' MulticlassAUROC on each bootstrap).
+
+    Each bootstrap is represented by how often it contains each sample, so that the AUROC of each class only needs one
+    sort of the scores for all bootstraps together.
+
+    Args:
+        preds (np.ndarray): Predicted scores of shape [n_samples, n_classes]. As in torchmetrics, they are softmaxed if
+            they are not all probabilities.
+        targets (np.ndarray): Class index of each sample, of shape [n_samples].
+        bootstraps (np.ndarray): Indices of the samples in each bootstrap, of shape [n_bootstraps, bootstrap_size].
+
+    Returns:
+        np.ndarray: AUROC of each bootstrap, of shape [n_bootstraps]. Classes that do not occur (or are the only class)
+            in a bootstrap are left out of its average.
+    """
+    preds = np.asarray(preds, dtype=np.float64)
+    if not ((preds >= 0) & (preds <= 1)).all():
+        preds = np.exp(preds - preds.max(axis=1, keepdims=True))
+        preds = preds / preds.sum(axis=1, keepdims=True)
+    weights = bootstrap_counts(np.asarray(bootstraps), len(preds))
+    aurocs = np.stack([_weighted_auroc(preds[:, c], targets == c, weights) for c in range(preds.shape[1])], axis=-1)
+    return np.nanmean(aurocs, axis=-1)
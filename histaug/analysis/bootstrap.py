@@ -4,15 +4,14 @@ from loguru import logger
 from tqdm import tqdm
 from pathlib import Path
 import numpy as np
-import torch
-from torchmetrics.classification import MulticlassAUROC
 from typing import Sequence
 from tqdm.contrib.concurrent import process_map
 from functools import partial
 
-from histaug.utils import cached_df
+from histaug.utils import cached_df, hash_df
 from histaug.utils.display import RENAME_FEATURE_EXTRACTORS, RENAME_MODELS, RENAME_TARGETS
 from histaug.analysis.collect_results import load_results, INDEX_COLS
+from histaug.analysis.auroc import bootstrap_auroc, draw_bootstraps
 
 TRAIN_DIR = Path("/data/histaug/train")
 BOOTSTRAPS_DIR = Path("/data/histaug/bootstraps")
@@ -41,31 +40,41 @@ def load_bootstraps(run, n_bootstraps: int = 1000):
     dataset = run.test_dataset
     column = run.target
 
-    bootstrap_csv = BOOTSTRAPS_DIR / f"{dataset}_{column}_{n_bootstraps}.csv"
-    if not bootstrap_csv.exists():
-        logger.debug(f"Caching bootstraps for {dataset} {column} at {bootstrap_csv}")
+    # The bootstraps are stored as indices into the list of patients, which is stored alongside them
+    bootstrap_npy = BOOTSTRAPS_DIR / f"{dataset}_{column}_{n_bootstraps}.npy"
+    patients_npy = BOOTSTRAPS_DIR / f"{dataset}_{column}_{n_bootstraps}_patients.npy"
+    bootstrap_csv = bootstrap_npy.with_suffix(".csv")
+    if bootstrap_csv.exists() and not bootstrap_npy.exists():  # bootstraps cached before they were stored as .npy
+        return pd.read_csv(bootstrap_csv, header=None).values
+
+    if not bootstrap_npy.exists():
+        logger.debug(f"Caching bootstraps for {dataset} {column} at {bootstrap_npy}")
         df = get_test_preds(run.wandb_id)
-        patients = df.index.unique()
+        assert df.index.is_unique, f"test-patient-preds.csv of {run.wandb_id} contains patients more than once"
+        patients = df.index
         classes = get_classes_from_test_preds(df, column)
-        bootstraps = np.random.choice(patients, size=(n_bootstraps, len(patients)), replace=True)
+        labels = pd.Categorical(df[column].astype(str), categories=classes).codes
         # Ensure that there is at least one instance from each class in each bootstrap
-        for i, bootstrap in enumerate(bootstraps):
-            while not all(df.loc[bootstrap, column].astype(str).value_counts().reindex(classes).fillna(0) > 0):
-                bootstraps[i] = np.random.choice(patients, size=len(patients), replace=True)
-        bootstraps_df = pd.DataFrame(bootstraps)
+        bootstraps = draw_bootstraps(labels, n_bootstraps)
         BOOTSTRAPS_DIR.mkdir(parents=True, exist_ok=True)
-        bootstraps_df.to_csv(bootstrap_csv, index=False, header=False)
+        np.save(patients_npy, np.array(patients.tolist()))  # a plain str/int array, so it loads without pickle
+        np.save(bootstrap_npy, bootstraps.astype(np.min_scalar_type(len(patients))))
+
+    return np.load(patients_npy)[np.load(bootstrap_npy)]
 
-    return pd.read_csv(bootstrap_csv, header=None).values
 
+def _preds_and_targets(df, column, classes):
+    preds = df[[f"{column}_{c}" for c in classes]].values
+    targets = df[column].map(lambda x: classes.index(str(x))).values
+    return preds, targets
 
-def compute_auroc(df, column, classes):
-    auroc = MulticlassAUROC(num_classes=len(classes))
 
-    logits = df[[f"{column}_{c}" for c in classes]].values
-    y_true = df[column].map(lambda x: classes.index(str(x))).values
-    auroc.update(torch.from_numpy(logits), torch.from_numpy(y_true))
-    return auroc.compute().numpy()
+def _bootstrap_rows(df, bootstraps):
+    """Convert bootstraps of patients into bootstraps of rows of df"""
+    assert df.index.is_unique, "predictions contain patients more than once"
+    rows = df.index.get_indexer(bootstraps.ravel()).reshape(bootstraps.shape)
+    assert (rows >= 0).all(), "bootstraps contain patients that are not in the predictions"
+    return rows
 
 
 def compute_auroc_diffs(runs_a: pd.DataFrame, runs_b: pd.DataFrame, target: str, n_bootstraps: int):
@@ -80,13 +89,14 @@ def compute_auroc_diffs(runs_a: pd.DataFrame, runs_b: pd.DataFrame, target: str,
         bootstraps_a = load_bootstraps(run_a, n_bootstraps=n_bootstraps)
         bootstraps_b = load_bootstraps(run_b, n_bootstraps=n_bootstraps)
         assert (bootstraps_a == bootstraps_b).all()
-        for bootstrap_a, bootstrap_b in zip(bootstraps_a, bootstraps_b):
-            df_bootstrap_a = df_a.loc[bootstrap_a]
-            df_bootstrap_b = df_b.loc[bootstrap_b]
-            yield compute_auroc(df_bootstrap_b, target, classes) - compute_auroc(df_bootstrap_a, target, classes)
+        # Compute the AUROCs of all bootstraps at once, from the row of each bootstrapped patient in each run's preds
+        aurocs_a = bootstrap_auroc(*_preds_and_targets(df_a, target, classes), _bootstrap_rows(df_a, bootstraps_a))
+        aurocs_b = bootstrap_auroc(*_preds_and_targets(df_b, target, classes), _bootstrap_rows(df_b, bootstraps_b))
+        yield from aurocs_b - aurocs_a
 
 
-def hash_df(df):
+def _legacy_hash_df(df):
+    """Hash of runs in the names of tables cached before hash_df() (slow for large dataframes)"""
     import hashlib
 
     return hashlib.md5(df.to_csv().encode()).hexdigest()
@@ -122,12 +132,16 @@ def worker(df, config, comparison_column, value_a, value_b, n_bootstraps_per_con
 
 
 @cached_df(
-    lambda runs, comparison_column, value_a, value_b, *args, **kwargs: f"bootstrapped_{comparison_column}_{value_a}_vs_{value_b}_{kwargs.get('n_bootstraps_per_config', 25)}_{hash_df(runs)}"
+    lambda runs, comparison_column, value_a, value_b, *args, **kwargs: f"bootstrapped_{comparison_column}_{value_a}_vs_{value_b}_{kwargs.get('n_bootstraps_per_config', 25)}_{hash_df(runs[['wandb_id']])}",
+    legacy_table_name=lambda runs, comparison_column, value_a, value_b, *args, **kwargs: f"bootstrapped_{comparison_column}_{value_a}_vs_{value_b}_{kwargs.get('n_bootstraps_per_config', 25)}_{_legacy_hash_df(runs)}",
 )
 def compare_bootstraps(
-    runs: pd.DataFrame, comparison_column, value_a, value_b, *, n_bootstraps_per_config: int = 25, n_workers: int = 16
+    runs: pd.DataFrame, comparison_column, value_a, value_b, *, n_bootstraps_per_config: int = 25, n_workers: int = 1
 ):
-    # runs is a dataframe of runs to compare, obtained from load_results()
+    # runs is a dataframe of runs to compare, obtained from load_results(). The cached table is keyed by the runs only
+    # (their INDEX_COLS and wandb ids), so it is the same whether runs come from the results index or from wandb. Tables
+    # cached as CSV before were keyed by all columns of runs, including the runtime, which differs between the index and
+    # wandb; they are therefore only found for runs loaded with load_results(source="wandb").
 
     keep_fixed = ["magnification", "augmentations", "feature_extractor", "model", "target"]
     assert comparison_column in keep_fixed and comparison_column != "target"
@@ -3,13 +3,14 @@ import pandas as pd
 from loguru import logger
 from tqdm import tqdm
 from pathlib import Path
-from itertools import product
 from tqdm.contrib.concurrent import process_map
 import numpy as np
 import math
 from functools import reduce, partial
 
-from histaug.utils import cached_df, RunningStats
+from histaug.utils import cached_df
+from histaug.utils.statistics import max_minus_value_stats
+from histaug.analysis.results_index import update_results_index, summarize_config, format_dataset_name
 
 INDEX_COLS = [
     "magnification",
@@ -28,10 +29,6 @@ def filter_runs(runs, filters: dict):
     return [run for run in runs if all(getattr(run, key, None) == value for key, value in filters.items())]
 
 
-def format_dataset_name(name: str) -> str:
-    return name.replace("_mpp0.5", "")
-
-
 def summarize_run(run):
     history = run.history().groupby("epoch").first()
     best = history[~history.index.isna()].sort_values("val/loss", ascending=True).iloc[0]
@@ -42,15 +39,7 @@ def summarize_run(run):
         test_auroc = history[f"test/{column}/auroc"].max()
     try:
         return dict(
-            wandb_id=run.id,
-            magnification=run.config["settings"].get("magnification", "low"),
-            target=column,
-            train_dataset=format_dataset_name(run.config["dataset"]["name"]),
-            test_dataset=format_dataset_name(run.config["test"]["dataset"]["name"]),
-            model=run.config["model"]["_target_"].split(".")[-1],
-            feature_extractor=run.config["settings"]["feature_extractor"],
-            augmentations=run.config["dataset"]["augmentations"]["name"],
-            seed=run.config["seed"],
+            **summarize_config(run.config, run.id),
             train_auroc=best[f"train/{column}/auroc"],
             val_auroc=best[f"val/{column}/auroc"],
             test_auroc=test_auroc,
@@ -61,7 +50,7 @@ def summarize_run(run):
 
 
 @cached_df(lambda: "results")
-def load_results():
+def load_results_from_wandb():
     logger.info("Loading runs")
 
     api = wandb.Api()
@@ -77,21 +66,26 @@ def load_results():
     return df
 
 
-def compute_norm_diff_auroc(sub_df, show_progress: bool = False, compare_across: str = "feature_extractor"):
-    """Function to compute average offset from best for a given subset of data."""
-    pivot_data = sub_df.pivot(index="seed", columns=compare_across, values="test_auroc")
-    feature_extractors = pivot_data.columns.values
-    seeds = pivot_data.index.values
-    combinations = product(*pivot_data.values.T)
-    n_combinations = int(len(seeds) ** len(feature_extractors))
-    stats_by_feature_extractor = {fe: RunningStats() for fe in feature_extractors}
+def load_results(source: str = "index"):
+    """Load the summaries of all finished runs, from the local results index (see histaug.analysis.results_index),
+    which is updated with the runs that finished since the last call, or from wandb (cached in RESULTS_DIR)."""
+    if source == "wandb":
+        return load_results_from_wandb()
+    assert source == "index", f"unknown results source {source!r}"
+    df = update_results_index().drop(columns=["run_dir", "overrides"])
+    df = df.set_index(INDEX_COLS).sort_index().drop_duplicates()
+    return df
+
 
-    for auroc_values in tqdm(combinations, total=n_combinations) if show_progress else combinations:
-        diffs = np.array(auroc_values).max() - np.array(auroc_values)
-        for fe, diff in zip(feature_extractors, diffs):
-            stats_by_feature_extractor[fe].update(diff)
+def compute_norm_diff_auroc(sub_df, compare_across: str = "feature_extractor"):
+    """Function to compute average offset from best for a given subset of data.
 
-    return {fe: stats.compute() for fe, stats in stats_by_feature_extractor.items()}
+    The offset from best is averaged over all combinations of seeds (one seed per compared value), which is computed in
+    closed form (see max_minus_value_stats).
+    """
+    pivot_data = sub_df.pivot(index="seed", columns=compare_across, values="test_auroc")
+    stats = max_minus_value_stats(pivot_data.values)
+    return dict(zip(pivot_data.columns.values, stats))
 
 
 def compute_norm_diff_auroc_worker(args, compare_across: str = "feature_extractor"):
@@ -113,9 +107,10 @@ def compute_results_table(
     test_aurocs: pd.Series,
     keep_fixed=("magnification", "augmentations", "model", "target"),
     vary="feature_extractor",
-    n_workers: int = 32,
+    n_workers: int = 1,
 ):
-    """Compute average offsets from best for each (target, model, augmentation) pair using multiprocessing."""
+    """Compute average offsets from best for each (target, model, augmentation) pair, using multiprocessing if
+    n_workers > 1."""
     keep_fixed = list(keep_fixed)
     d = test_aurocs.reset_index()
 
@@ -132,7 +127,10 @@ def compute_results_table(
 
     # Use multiprocessing Pool to compute results in parallel
     worker = partial(compute_norm_diff_auroc_worker, compare_across=vary)
-    results_list = process_map(worker, args_list, max_workers=n_workers, tqdm_class=tqdm, desc="Computing results")
+    if n_workers > 1:
+        results_list = process_map(worker, args_list, max_workers=n_workers, tqdm_class=tqdm, desc="Computing results")
+    else:
+        results_list = [worker(args) for args in tqdm(args_list, desc="Computing results")]
 
     # Convert list of results into dictionary
     results = {config: result for config, result in results_list}
@@ -0,0 +1,152 @@
+"""Local index of finished training runs, so that results can be analyzed without querying wandb.
+
+Each finished run writes a run.json (with its wandb id, command line overrides, runtime, and resolved config) to its
+output directory, next to the metrics.csv of its CSVLogger. The index is a SQLite table with one row per run directory
+(see summarize_run_dir()); updating it only reads the run directories that are not in the index yet.
+
+Example:
+    python -m histaug.analysis.results_index  # update the index
+    python -m histaug.analysis.results_index --from-wandb  # first write run.json for runs trained before it existed
+"""
+
+from pathlib import Path
+from typing import Any, Mapping, Union
+import json
+import sqlite3
+import pandas as pd
+from loguru import logger
+from tqdm import tqdm
+
+__all__ = ["update_results_index", "summarize_config", "summarize_run_dir", "RESULTS_INDEX", "TRAIN_DIR"]
+
+TRAIN_DIR = Path("/data/histaug/train")
+RESULTS_INDEX = Path("/app/results/results_index.sqlite")
+RUN_INFO_NAME = "run.json"
+INDEX_COLUMNS = [
+    "run_dir",
+    "wandb_id",
+    "magnification",
+    "target",
+    "train_dataset",
+    "test_dataset",
+    "model",
+    "feature_extractor",
+    "augmentations",
+    "seed",
+    "train_auroc",
+    "val_auroc",
+    "test_auroc",
+    "runtime",
+    "overrides",
+]  # columns of summarize_run_dir()
+
+
+def format_dataset_name(name: str) -> str:
+    return name.replace("_mpp0.5", "")
+
+
+def summarize_config(config: Mapping[str, Any], wandb_id: str) -> dict:
+    """The settings that identify a run (see histaug.analysis.collect_results.INDEX_COLS), from its config."""
+    return dict(
+        wandb_id=wandb_id,
+        magnification=config["settings"].get("magnification", "low"),
+        target=config["dataset"]["targets"][0]["column"],
+        train_dataset=format_dataset_name(config["dataset"]["name"]),
+        test_dataset=format_dataset_name(config["test"]["dataset"]["name"]),
+        model=config["model"]["_target_"].split(".")[-1],
+        feature_extractor=config["settings"]["feature_extractor"],
+        augmentations=config["dataset"]["augmentations"]["name"],
+        seed=config["seed"],
+    )
+
+
+def summarize_run_dir(run_dir: Path) -> dict:
+    """Summarize a finished run from its run.json and the metrics.csv of its CSVLogger, like summarize_run() does with
+    the run's wandb history."""
+    with (run_dir / RUN_INFO_NAME).open("r") as f:
+        info = json.load(f)
+    metrics_files = sorted(
+        run_dir.glob("lightning_logs/version_*/metrics.csv"), key=lambda p: int(p.parent.name[len("version_") :])
+    )
+    assert metrics_files, f"no metrics.csv in {run_dir}"
+    history = pd.read_csv(metrics_files[-1]).groupby("epoch").first()
+    best = history.sort_values("val/loss", ascending=True).iloc[0]
+    summary = summarize_config(info["config"], info["wandb_id"])
+    column = summary["target"]
+    return dict(
+        run_dir=str(run_dir),
+        **summary,
+        train_auroc=best[f"train/{column}/auroc"],
+        val_auroc=best[f"val/{column}/auroc"],
+        test_auroc=history[f"test/{column}/auroc"].max() if f"test/{column}/auroc" in history else float("nan"),
+        runtime=info.get("runtime", None),
+        overrides=info.get("overrides", ""),
+    )
+
+
+def update_results_index(
+    train_dir: Union[str, Path] = TRAIN_DIR, index_path: Union[str, Path] = RESULTS_INDEX
+) -> pd.DataFrame:
+    """Add the finished runs in train_dir that are not in the index yet, and return all indexed runs.
+
+    Returns:
+        pd.DataFrame: One row per run directory, with the columns of summarize_run_dir().
+    """
+    index_path = Path(index_path)
+    index_path.parent.mkdir(parents=True, exist_ok=True)
+    with sqlite3.connect(index_path) as connection:
+        has_table = connection.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='runs'").fetchone()
+        indexed = pd.read_sql("SELECT * FROM runs", connection) if has_table else pd.DataFrame(columns=INDEX_COLUMNS)
+        known = set(indexed.run_dir)
+        new_run_dirs = [p.parent for p in sorted(Path(train_dir).rglob(RUN_INFO_NAME)) if str(p.parent) not in known]
+
+        rows = []
+        for run_dir in tqdm(new_run_dirs, desc="Indexing runs", disable=not new_run_dirs):
+            try:
+                rows.append(summarize_run_dir(run_dir))
+            except Exception as e:  # e.g. an incomplete run directory; it is retried on the next update
+                logger.warning(f"Could not index {run_dir}: {e!r}")
+        if rows:
+            new = pd.DataFrame(rows)
+            new.to_sql("runs", connection, if_exists="append", index=False)
+            indexed = pd.concat([indexed, new], ignore_index=True) if has_table else new
+    logger.info(f"Indexed {len(rows)} new runs; {len(indexed)} runs in {index_path}")
+    return indexed
+
+
+def backfill_from_wandb(train_dir: Union[str, Path] = TRAIN_DIR, project: str = "histaug"):
+    """Write run.json for the finished wandb runs whose output directory exists but was written before run.json was."""
+    import wandb
+
+    train_dir = Path(train_dir)
+    # Output directories are <dataset>/<version>, or <dataset>/<crossval_id>/fold<fold>_<version> for cross-validation
+    run_dirs = {p.name.split("_")[-1]: p for p in [*train_dir.glob("*/*"), *train_dir.glob("*/*/fold*")] if p.is_dir()}
+    for run in tqdm(wandb.Api().runs(project, order="+created_at", per_page=1000), desc="Checking wandb"):
+        run_dir = run_dirs.get(run.id, None)
+        if run.state != "finished" or run_dir is None or (run_dir / RUN_INFO_NAME).exists():
+            continue
+        config = {k: v for k, v in run.config.items() if k not in ("overrides", "crossval_id", "crossval_fold")}
+        with (run_dir / RUN_INFO_NAME).open("w") as f:
+            json.dump(
+                dict(
+                    wandb_id=run.id,
+                    overrides=run.config.get("overrides", ""),
+                    runtime=run.summary.get("_runtime", None),
+                    config=config,
+                ),
+                f,
+            )
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Update the local index of finished training runs")
+    parser.add_argument("--train-dir", type=Path, default=TRAIN_DIR)
+    parser.add_argument("--index", type=Path, default=RESULTS_INDEX)
+    parser.add_argument("--from-wandb", action="store_true", help="First write run.json for runs that lack one")
+    args = parser.parse_args()
+
+    if args.from_wandb:
+        backfill_from_wandb(args.train_dir)
+    update_results_index(args.train_dir, args.index)
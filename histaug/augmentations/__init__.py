@@ -11,10 +11,11 @@ from functools import partial
 
 import histaug
 from .macenko_torchstain import TorchMacenkoNormalizer, FullyTransparentException
+from .stain_cache import SlideStainCache, sample_slide_pixels
 
 PATCH_SIZE = 224
 
-__all__ = ["load_augmentations", "Augmentations"]
+__all__ = ["load_augmentations", "Augmentations", "MacenkoSlidewise", "SlideStainCache"]
 
 
 class Macenko(nn.Module):
@@ -29,19 +30,82 @@ class Macenko(nn.Module):
         self.normalizer = TorchMacenkoNormalizer()
         logger.info(f"Fitting Macenko normalizer to {target_image}")
         self.normalizer.fit(target)
+        self.num_passed_through = 0  # number of images that could not be normalized, and were returned unchanged
 
     def forward_image(self, image: torch.Tensor) -> torch.Tensor:
-        try:
-            Inorm, H, E = self.normalizer.normalize((image * 255).type(torch.uint8))
-            return Inorm.type_as(image) / 255.0
-        except FullyTransparentException as e:
+        """Normalize a single image of shape [C, H, W] (through the batched path of forward())."""
+        return self(image.unsqueeze(0))[0]
+
+    def forward(self, images: torch.Tensor) -> torch.Tensor:
+        Inorm, valid = self.normalizer.normalize_batch((images * 255).type(torch.uint8))
+        return self._keep_invalid(images, Inorm, valid)
+
+    def _keep_invalid(self, images: torch.Tensor, Inorm: torch.Tensor, valid: torch.Tensor) -> torch.Tensor:
+        """Return the normalized images, or the original images where they could not be normalized (with a warning)."""
+        num_invalid = (~valid).sum().item()
+        if num_invalid:
+            self.num_passed_through += num_invalid
             logger.warning(
-                f"Attempting to Macenko normalize fully transparent image ({str(e)}). Returning original image."
+                f"Attempting to Macenko normalize {num_invalid} fully transparent image(s). Returning original image(s)."
             )
-            return image
+        return torch.where(valid.view(-1, 1, 1, 1), Inorm.type_as(images) / 255.0, images)
+
+
+class MacenkoSlidewise(Macenko):
+    """Macenko normalization using stain matrices that are estimated once per slide (from a random subsample of the
+    slide's pixels) instead of once per patch. Call fit_slide() before normalizing the patches of a slide.
+
+    This augmentation is opt-in (see _optional_augmentations): it is only loaded if requested by name, e.g. with
+    --aug "Macenko slidewise". Its features are stored like any other augmentation's, not as the NORMALIZED features
+    that conf/augmentations/macenko_slidewise.yaml trains on."""
+
+    def __init__(
+        self,
+        target_image: Path = Path(histaug.__file__).parent.parent / "normalization_template.jpg",
+        n_patches: int = 256,
+        n_pixels: int = 2**20,
+        stain_cache: Optional[SlideStainCache] = None,
+    ):
+        super().__init__(target_image)
+        self.n_patches = n_patches
+        self.n_pixels = n_pixels
+        self.stain_cache = stain_cache
+        self.register_buffer("HE", None)
+        self.register_buffer("maxC", None)
+        self.slide_name = None
+
+    @staticmethod
+    def stain_cache_key(slide) -> str:
+        """Key of a slide in the stain cache: its dataset directory and name, so that a stain cache shared between
+        datasets does not mix up slides of the same name."""
+        return f"{Path(slide.path).parent.resolve()}/{slide.name}"
+
+    def fit_slide(self, slide) -> None:
+        """Estimate (or load from the stain cache) the stain matrices of a slide, given as a SlideDataset."""
+        params = dict(n_patches=self.n_patches, n_pixels=self.n_pixels)
+        key = self.stain_cache_key(slide)
+        stains = self.stain_cache.get(key, params) if self.stain_cache is not None else None
+        if stains is None:
+            pixels = sample_slide_pixels(slide.zarr_group["patches"], n_patches=self.n_patches, n_pixels=self.n_pixels)
+            try:
+                stains = self.normalizer.compute_stains(pixels.to(self.normalizer.HERef.device))
+            except FullyTransparentException as e:
+                logger.warning(
+                    f"Could not estimate slide-wise stain matrices for {slide.name} ({str(e)}). Falling back to patch-wise estimation."
+                )
+                stains = (None, None)
+            else:
+                if self.stain_cache is not None:
+                    self.stain_cache.set(key, *stains, params=params)
+        HE, maxC = stains
+        self.HE = HE.to(self.normalizer.HERef.device) if HE is not None else None
+        self.maxC = maxC.to(self.normalizer.HERef.device) if maxC is not None else None
+        self.slide_name = slide.name
 
     def forward(self, images: torch.Tensor) -> torch.Tensor:
-        return torch.stack([self.forward_image(img) for img in images])
+        assert self.slide_name is not None, "fit_slide() must be called before normalizing patches"
+        Inorm, valid = self.normalizer.normalize_batch((images * 255).type(torch.uint8), HE=self.HE, maxC=self.maxC)
+        return self._keep_invalid(images, Inorm, valid)
 
 
 def EnlargeAndCenterCrop(zoom_factor: Union[float, int] = 2, patch_size=PATCH_SIZE):
@@ -94,6 +158,12 @@ class Augmentations(nn.Module):
         for key, value in items.items():
             self.__setitem__(key, value)
 
+    def fit_slide(self, slide):
+        """Prepare slide-level augmentations (such as slide-wise Macenko normalization) for the patches of a slide."""
+        for value in self.values():
+            if hasattr(value, "fit_slide"):
+                value.fit_slide(slide)
+
 
 _unloaded_augmentations: Mapping[str, Callable[[], Any]] = {
     "Macenko": lambda: Macenko(),
@@ -133,6 +203,11 @@ _unloaded_augmentations: Mapping[str, Callable[[], Any]] = {
     # "gaussian noise": lambda: T.Lambda(lambda x: x + torch.randn_like(x) * 0.1),
 }
 
+# Augmentations that are only loaded if requested by name, and are not among the augmentations stored by default
+_optional_augmentations: Mapping[str, Callable[[], Any]] = {
+    "Macenko slidewise": lambda: MacenkoSlidewise(),
+}
+
 
 def load_augmentations(
     keys: Optional[Iterable[str]] = None,
@@ -140,9 +215,8 @@ def load_augmentations(
         "rotate random angle and zoom 1.5x"  # exclude this because this is just for an ablation study
     ],
 ) -> Augmentations:
-    return Augmentations(
-        {k: v() for k, v in _unloaded_augmentations.items() if ((not keys or k in keys) and k not in excluded_keys)}
-    )
+    unloaded = {**_unloaded_augmentations, **{k: v for k, v in _optional_augmentations.items() if keys and k in keys}}
+    return Augmentations({k: v() for k, v in unloaded.items() if ((not keys or k in keys) and k not in excluded_keys)})
 
 
 def augmentation_names() -> Sequence[str]:
@@ -6,6 +6,7 @@ from torch import nn
 """
 This code is modified from https://github.com/EIDOSLAB/torchstain in order to support GPU, and to ensure the image is returned in the proper format.
 Also added a check for fully transparent images, which would otherwise cause an error.
+Finally, added a batched version of normalize() that processes a whole batch of patches at once.
 """
 
 
@@ -19,6 +20,26 @@ def percentile(t, q):
     return _percentile(t, q)
 
 
+def masked_percentile(t, mask, q):
+    """Row-wise version of `percentile` for a [B, N] tensor, only considering the entries where mask is True.
+
+    Uses the same (non-interpolated) definition as `percentile`, i.e. the k-th smallest value with
+    k = 1 + round(q / 100 * (n - 1)), where n is the number of valid entries in each row.
+    Instead of sorting each row, only the values up to the requested rank are selected using topk, which is much
+    cheaper for the extreme percentiles used by the Macenko method.
+    """
+    n = mask.sum(dim=-1)
+    k = torch.round(0.01 * float(q) * (n - 1).clamp(min=0).double()).long()  # zero-based rank from the bottom
+    if q <= 50:
+        values = torch.where(mask, t, torch.full_like(t, torch.inf))
+        values = values.topk(int(k.max()) + 1, dim=-1, largest=False).values  # ascending
+    else:
+        k = (n - 1 - k).clamp(min=0)  # zero-based rank from the top
+        values = torch.where(mask, t, torch.full_like(t, -torch.inf))
+        values = values.topk(int(k.max()) + 1, dim=-1, largest=True).values  # descending
+    return values.gather(-1, k.unsqueeze(-1)).squeeze(-1)
+
+
 class TorchMacenkoNormalizer(HENormalizer, nn.Module):
     def __init__(self):
         super().__init__()
@@ -91,11 +112,16 @@ class TorchMacenkoNormalizer(HENormalizer, nn.Module):
         return HE, C, maxC
 
     def fit(self, I, Io=240, alpha=1, beta=0.15):
-        HE, _, maxC = self.__compute_matrices(I, Io, alpha, beta)
+        HE, maxC = self.compute_stains(I, Io, alpha, beta)
 
         self.HERef = HE
         self.maxCRef = maxC
 
+    def compute_stains(self, I, Io=240, alpha=1, beta=0.15):
+        """Estimate the stain matrix HE and the maximum stain concentrations maxC of an image of shape [C, H, W]."""
+        HE, _, maxC = self.__compute_matrices(I, Io, alpha, beta)
+        return HE, maxC
+
     def normalize(self, I, Io=240, alpha=1, beta=0.15, stains=True):
         """Normalize staining appearence of H&E stained images
 
@@ -142,3 +168,96 @@ class TorchMacenkoNormalizer(HENormalizer, nn.Module):
             E = E.reshape(c, h, w).type_as(I)
 
         return Inorm, H, E
+
+    def __convert_rgb2od_batch(self, I, Io):
+        # calculate optical density, shape [B, C, N] (channels first, so no permute/copy is needed)
+        B, c, h, w = I.shape
+        return -torch.log((I.reshape(B, c, -1).float() + 1) / Io)
+
+    def __compute_matrices_batch(self, I, Io, alpha, beta):
+        B, c, h, w = I.shape
+
+        OD = self.__convert_rgb2od_batch(I, Io)
+
+        # mask out transparent pixels (instead of removing them, so that all images keep the same shape)
+        mask = OD.amin(dim=1) >= beta  # B, N
+        n = mask.sum(dim=-1)  # B
+
+        # compute masked covariance matrices, shape [B, C, C]
+        mean = (OD * mask.unsqueeze(1)).sum(dim=-1) / n.clamp(min=1).unsqueeze(-1)
+        centered = (OD - mean.unsqueeze(-1)) * mask.unsqueeze(1)
+        covs = centered @ centered.transpose(1, 2) / (n - 1).clamp(min=1).view(B, 1, 1)
+
+        # images with fewer than two non-transparent pixels have no well-defined stain matrix
+        valid = (n >= 2) & covs.isfinite().all(dim=-1).all(dim=-1)
+        covs = torch.where(valid.view(B, 1, 1), covs, torch.eye(c, dtype=covs.dtype, device=covs.device))
+
+        # compute eigenvectors corresponding to the two largest eigenvalues
+        _, eigvecs = torch.linalg.eigh(covs)
+        eigvecs = eigvecs[:, :, [1, 2]]  # B, C, 2
+
+        # project on the plane spanned by the eigenvectors
+        That = eigvecs.transpose(1, 2) @ OD  # B, 2, N
+        phi = torch.atan2(That[:, 1], That[:, 0])  # B, N
+
+        minPhi = masked_percentile(phi, mask, alpha)
+        maxPhi = masked_percentile(phi, mask, 100 - alpha)
+
+        vMin = (eigvecs @ torch.stack((torch.cos(minPhi), torch.sin(minPhi)), dim=-1).unsqueeze(-1)).squeeze(-1)
+        vMax = (eigvecs @ torch.stack((torch.cos(maxPhi), torch.sin(maxPhi)), dim=-1).unsqueeze(-1)).squeeze(-1)
+
+        # a heuristic to make the vector corresponding to hematoxylin first and the
+        # one corresponding to eosin second
+        HE = torch.where(
+            (vMin[:, 0] > vMax[:, 0]).view(B, 1, 1),
+            torch.stack((vMin, vMax), dim=-1),
+            torch.stack((vMax, vMin), dim=-1),
+        )  # B, C, 2
+        HE = torch.where(valid.view(B, 1, 1), HE, self.HERef.expand_as(HE))
+
+        # determine concentrations of the individual stains (the least squares solution, computed via the
+        # pseudo-inverse of the 3x2 stain matrices which is much cheaper than a batched lstsq over all pixels)
+        C = torch.linalg.pinv(HE) @ OD  # B, 2, N
+
+        maxC = masked_percentile(C, torch.ones_like(C, dtype=torch.bool), 99)  # B, 2
+
+        return HE, C, maxC, valid
+
+    def normalize_batch(self, I, Io=240, alpha=1, beta=0.15, HE=None, maxC=None):
+        """Normalize staining appearence of a batch of H&E stained images.
+
+        This is equivalent to calling normalize() on each image separately, but computes the stain matrices of all
+        images at once using batched tensor operations.
+
+        Input:
+            I: RGB input images: tensor of shape [B, C, H, W] and type uint8
+            Io: (optional) transmitted light intensity
+            alpha: percentile
+            beta: transparency threshold
+            HE, maxC: (optional) stain matrix of shape [C, 2] and maximum stain concentrations of shape [2] to use for
+                all images instead of estimating them per image (e.g. the ones of the whole slide, see compute_stains)
+
+        Output:
+            Inorm: normalized images, of shape [B, C, H, W]
+            valid: boolean mask of shape [B] indicating which images could be normalized; the remaining (fully
+                transparent) images are returned unchanged
+        """
+        B, c, h, w = I.shape
+
+        if HE is None or maxC is None:
+            HE, C, maxC, valid = self.__compute_matrices_batch(I, Io, alpha, beta)
+        else:
+            OD = self.__convert_rgb2od_batch(I, Io)
+            C = torch.linalg.pinv(HE) @ OD  # B, 2, N
+            valid = (OD.amin(dim=1) >= beta).any(dim=-1)  # fully transparent images are returned unchanged
+
+        # normalize stain concentrations
+        C = C * (self.maxCRef / maxC).unsqueeze(-1)
+
+        # recreate the images using reference mixing matrix
+        Inorm = Io * torch.exp(-torch.matmul(self.HERef, C))
+        Inorm = Inorm.clamp(max=255)
+        Inorm = Inorm.reshape(B, c, h, w).type_as(I)
+        Inorm = torch.where(valid.view(B, 1, 1, 1), Inorm, I)
+
+        return Inorm, valid
@@ -0,0 +1,66 @@
+import json
+import os
+from pathlib import Path
+from typing import Any, Mapping, Optional, Tuple, Union
+import numpy as np
+import torch
+import zarr
+
+__all__ = ["sample_slide_pixels", "SlideStainCache"]
+
+
+def sample_slide_pixels(
+    patches: zarr.Array, n_patches: int = 256, n_pixels: int = 2**20, seed: int = 0
+) -> torch.Tensor:
+    """Sample a random subset of pixels from the patches of a slide.
+
+    Args:
+        patches (zarr.Array): Patches of the slide, of shape [N, H, W, C] and type uint8.
+        n_patches (int, optional): Number of patches to read. Defaults to 256.
+        n_pixels (int, optional): Number of pixels to sample from these patches. Defaults to 2**20.
+        seed (int, optional): Random seed, so that the same pixels are sampled for a slide every time. Defaults to 0.
+
+    Returns:
+        torch.Tensor: The sampled pixels as an image of shape [C, 1, n_pixels].
+    """
+    rng = np.random.default_rng(seed)
+    num_patches = patches.shape[0]
+    indices = np.sort(rng.choice(num_patches, size=min(n_patches, num_patches), replace=False))  # sorted for locality
+    pixels = patches.get_orthogonal_selection((indices,)).reshape(-1, patches.shape[-1])
+    pixels = pixels[rng.choice(len(pixels), size=min(n_pixels, len(pixels)), replace=False)]
+    return torch.from_numpy(pixels).T.unsqueeze(1)
+
+
+class SlideStainCache:
+    """Sidecar index of per-slide Macenko stain matrices, stored as a small JSON file keyed by slide name.
+
+    Each entry also records the parameters the stain matrices were estimated with, and is only reused if they match.
+    Writes are atomic, but concurrent writers may drop each other's entries (which just means they are re-estimated).
+    """
+
+    def __init__(self, path: Union[str, Path]):
+        self.path = Path(path)
+
+    def _read(self) -> dict:
+        if not self.path.exists():
+            return dict()
+        with self.path.open("r") as f:
+            return json.load(f)
+
+    def get(self, name: str, params: Mapping[str, Any] = {}) -> Optional[Tuple[torch.Tensor, torch.Tensor]]:
+        entry = self._read().get(name, None)
+        if entry is None or entry["params"] != dict(params):
+            return None
+        return torch.tensor(entry["HE"]), torch.tensor(entry["maxC"])
+
+    def set(self, name: str, HE: torch.Tensor, maxC: torch.Tensor, params: Mapping[str, Any] = {}):
+        index = self._read()
+        index[name] = dict(HE=HE.tolist(), maxC=maxC.tolist(), params=dict(params))
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.path.with_name(f".{self.path.name}.{os.getpid()}.tmp")
+        with tmp_path.open("w") as f:
+            json.dump(index, f, indent=2)
+        os.replace(tmp_path, self.path)
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._read()
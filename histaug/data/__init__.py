@@ -1,3 +1,5 @@
 from .kather100k import Kather100k
-from .slide_dataset import SlidesDataset, SlideDataset
+from .slide_dataset import SlidesDataset, SlideDataset, SlidesLoader
 from .feature_dataset import FeatureDataset, CachedFeatureDataset
+from .feature_store import FeatureStore, build_feature_store
+from .sampler import LengthBucketedBatchSampler
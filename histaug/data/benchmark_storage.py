@@ -0,0 +1,150 @@
+"""Benchmark feature storage settings (compressor, chunk rows, encoding) on synthetic features.
+
+For each combination of settings, synthetic slides are written with save_features(), and random bags are gathered
+through FeatureDataset, i.e. with the same access pattern as during training. Note that random features compress worse
+than real ones, and that the gather latency is measured with a warm page cache.
+
+Example:
+    python -m histaug.data.benchmark_storage --compressors default lz4 zstd:3:bitshuffle none --chunk-rows 256 2048
+"""
+
+from pathlib import Path
+from typing import Sequence
+import itertools
+import tempfile
+import shutil
+import time
+import numpy as np
+import pandas as pd
+from loguru import logger
+
+from ..utils.saving import save_features
+from .feature_dataset import FeatureDataset, ORIGINAL_FEATURES
+
+
+def _directory_size(path: Path) -> int:
+    return sum(f.stat().st_size for f in path.rglob("*") if f.is_file())
+
+
+def synthetic_features(num_patches: int, dim: int, rng: np.random.Generator) -> np.ndarray:
+    """Random features with a different scale and offset per dimension, roughly like those of a real extractor."""
+    scale = rng.uniform(0.1, 2.0, size=dim).astype(np.float32)
+    offset = rng.normal(size=dim).astype(np.float32)
+    return rng.standard_normal((num_patches, dim), dtype=np.float32) * scale + offset
+
+
+def benchmark_storage(
+    root: Path,
+    compressors: Sequence[str] = ("default",),
+    chunk_rows: Sequence[int] = (2048,),
+    encodings: Sequence[str] = ("float32",),
+    num_slides: int = 4,
+    num_patches: int = 8192,
+    dim: int = 768,
+    num_augmentations: int = 8,
+    instances_per_bag: int = 2048,
+    num_bags: int = 16,
+    seed: int = 0,
+) -> pd.DataFrame:
+    """Measure write throughput, size on disk, and random bag gather latency for each combination of settings.
+
+    Returns:
+        pd.DataFrame: One row per combination of settings.
+    """
+    rng = np.random.default_rng(seed)
+    augmentations = [f"aug{i}" for i in range(num_augmentations)]
+    slides = [
+        (
+            synthetic_features(num_patches, dim, rng),
+            {aug: synthetic_features(num_patches, dim, rng) for aug in augmentations},
+        )
+        for _ in range(num_slides)
+    ]
+    coords = rng.integers(0, 100_000, size=(num_patches, 2))
+    raw_bytes = num_slides * (1 + num_augmentations) * num_patches * dim * 4
+
+    results = []
+    for compressor, chunk_size, encoding in itertools.product(compressors, chunk_rows, encodings):
+        out_dir = root / f"{compressor.replace(':', '_')}-{chunk_size}-{encoding}"
+        shutil.rmtree(out_dir, ignore_errors=True)
+        out_dir.mkdir(parents=True)
+
+        start = time.perf_counter()
+        for i, (feats, feats_augs) in enumerate(slides):
+            save_features(
+                out_dir / f"slide{i}.zarr",
+                feats,
+                feats_augs,
+                coords,
+                chunk_size=chunk_size,
+                encoding=encoding,
+                compressor=compressor,
+            )
+        write_time = time.perf_counter() - start
+
+        ds = FeatureDataset(
+            patient_ids=[f"patient{i}" for i in range(num_slides)],
+            bags=[[out_dir / f"slide{i}.zarr"] for i in range(num_slides)],
+            targets=None,
+            instances_per_bag=instances_per_bag,
+            augmentations=[ORIGINAL_FEATURES, *augmentations],
+        )
+        np.random.seed(seed)
+        gather_times = []
+        for bag in range(num_bags):
+            start = time.perf_counter()
+            ds[bag % num_slides]
+            gather_times.append(time.perf_counter() - start)
+
+        size = _directory_size(out_dir)
+        results.append(
+            dict(
+                compressor=compressor,
+                chunk_rows=chunk_size,
+                encoding=encoding,
+                write_mb_per_s=raw_bytes / write_time / 1e6,
+                size_mb=size / 1e6,
+                compression_ratio=raw_bytes / size,
+                gather_ms_median=np.median(gather_times) * 1e3,
+                gather_ms_max=np.max(gather_times) * 1e3,
+            )
+        )
+        logger.info(f"{results[-1]}")
+        shutil.rmtree(out_dir)
+    return pd.DataFrame(results)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--compressors", nargs="+", default=["default", "lz4", "zstd:3", "zstd:3:bitshuffle", "none"])
+    parser.add_argument("--chunk-rows", nargs="+", type=int, default=[256, 1024, 2048])
+    parser.add_argument("--encodings", nargs="+", default=["float32"])
+    parser.add_argument("--num-slides", type=int, default=4)
+    parser.add_argument("--num-patches", type=int, default=8192, help="Number of patches per slide")
+    parser.add_argument("--dim", type=int, default=768, help="Feature dimension")
+    parser.add_argument("--num-augmentations", type=int, default=8)
+    parser.add_argument("--instances-per-bag", type=int, default=2048)
+    parser.add_argument("--num-bags", type=int, default=16, help="Number of bags to gather per setting")
+    parser.add_argument("--dir", type=Path, default=None, help="Directory to write to (default: a temporary directory)")
+    parser.add_argument("--output", type=Path, default=None, help="CSV file to save the results to")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(dir=args.dir) as root:
+        df = benchmark_storage(
+            Path(root),
+            compressors=args.compressors,
+            chunk_rows=args.chunk_rows,
+            encodings=args.encodings,
+            num_slides=args.num_slides,
+            num_patches=args.num_patches,
+            dim=args.dim,
+            num_augmentations=args.num_augmentations,
+            instances_per_bag=args.instances_per_bag,
+            num_bags=args.num_bags,
+        )
+    with pd.option_context("display.float_format", "{:.1f}".format, "display.max_columns", None, "display.width", 200):
+        print(df.to_string(index=False))
+    if args.output is not None:
+        df.to_csv(args.output, index=False)
@@ -1,12 +1,15 @@
 from torch.utils.data import Dataset
 from pathlib import Path
-from typing import Union, Optional, Sequence, Mapping, Any
+from typing import Union, Optional, Sequence, Mapping, Any, Dict, Tuple
+import json
 import torch
 import zarr
 import numpy as np
 from loguru import logger
 
 from ..augmentations import augmentation_names
+from .feature_store import FeatureStore, STORE_NAME
+from ..utils.saving import decode_features
 
 ORIGINAL_FEATURES = "ORIGINAL"
 NORMALIZED_FEATURES = "NORMALIZED"
@@ -20,6 +23,7 @@ class FeatureDataset(Dataset):
         targets: Optional[Mapping[str, torch.Tensor]],
         instances_per_bag: Optional[int] = None,
         augmentations: Sequence[str] = (ORIGINAL_FEATURES, *augmentation_names()),
+        backend: str = "zarr",
     ):
         """This dataset yields feature vectors for one slide at a time.
 
@@ -28,6 +32,7 @@ class FeatureDataset(Dataset):
             bags (Sequence[Union[str, Path]]): Paths to bags of features.
             instances_per_bag (Optional[int], optional): Number of instances to sample from each bag. Defaults to None (all instances).
             augmentations (Sequence[str], optional): Augmentations to apply. Be sure to include None as an augmentation; this is the original feature vector with no augmentation applied.
+            backend (str, optional): Where to read the features from (see open_slide_features()). Defaults to "zarr".
         """
 
         if ORIGINAL_FEATURES not in augmentations:
@@ -43,22 +48,18 @@ class FeatureDataset(Dataset):
         self.instances_per_bag = instances_per_bag
         self.pad = pad
         self.augmentations = augmentations
+        self.backend = backend
         self.slides = list(sorted(Path(b) for b in bag) for bag in bags)
         self.targets = targets
 
-    @staticmethod
-    def _group_name_for_aug(aug) -> str:
-        if aug == ORIGINAL_FEATURES:
-            return "feats"
-        elif aug == NORMALIZED_FEATURES:
-            return "feats_norm"
-        else:
-            return f"feats_augs/{aug}"
+    def sample_indices(self, index) -> np.ndarray:
+        """Sample the patches (and the augmentation of each patch) of a bag, without loading any features.
 
-    def __getitem__(self, index):
+        Returns:
+            np.ndarray: (slide_index, patch_index, augmentation_index) triples of shape [num_patches, 3].
+        """
         slides = self.slides[index]  # we may have multiple slides per patient
-        features = [zarr.open_group(str(slide), mode="r") for slide in slides]
-        num_patches_per_slide = [f["feats"].shape[0] for f in features]
+        num_patches_per_slide = [open_slide_features(slide, self.backend)["feats"].shape[0] for slide in slides]
         total_num_patches = sum(num_patches_per_slide)
         num_patches = min(total_num_patches, self.instances_per_bag or float("inf"))
         augmentations_per_patch = np.random.randint(len(self.augmentations), size=(num_patches,))
@@ -75,19 +76,24 @@ class FeatureDataset(Dataset):
         indices = np.concatenate(
             [indices, np.expand_dims(augmentations_per_patch, axis=-1)], axis=-1
         )  # indices are now (slide_index, patch_index, augmentation_index) triples
+        return indices
 
-        feats = []
-        coords = []
-
-        for slide_index, f in enumerate(features):
-            slide_indices = indices[indices[:, 0] == slide_index]
-            for augmentation_index, augmentation in enumerate(self.augmentations):
-                augmentation_indices = slide_indices[slide_indices[:, 2] == augmentation_index]
-                feats.append(f[self._group_name_for_aug(augmentation)][:][augmentation_indices[:, 1]])
-                coords.append(f["coords"][:][augmentation_indices[:, 1]])
+    def bag_lengths(self) -> np.ndarray:
+        """Number of instances of each bag, read from the shapes of the feature arrays (see LengthBucketedBatchSampler)."""
+        return np.array(
+            [
+                min(
+                    sum(open_slide_features(slide, self.backend)["feats"].shape[0] for slide in slides),
+                    self.instances_per_bag or float("inf"),
+                )
+                for slides in self.slides
+            ],
+            dtype=int,
+        )
 
-        feats = np.concatenate(feats)
-        coords = np.concatenate(coords)
+    def __getitem__(self, index):
+        indices = self.sample_indices(index)
+        feats, coords = gather_features(self.slides[index], self.augmentations, indices, backend=self.backend)
         labels = {label: target[index] for label, target in self.targets.items()} if self.targets else None
 
         return feats, coords, labels, self.patient_ids[index]
@@ -106,8 +112,8 @@ class FeatureDataset(Dataset):
         feats, coords, labels, patient_ids = zip(*batch)
         n_per_instance = [f.shape[0] for f in feats]
         n_max = max(n_per_instance)
-        feats = np.stack([pad(f, n_max, axis=0) for f in feats])
-        coords = np.stack([pad(c, n_max, axis=0) for c in coords])
+        feats = pad_stack(feats, n_max, dtype=np.float32)
+        coords = pad_stack(coords, n_max)
         labels = {label: torch.stack([l[label] for l in labels]) for label in labels[0]} if len(labels) > 0 else None
         mask = torch.arange(n_max) < torch.tensor(n_per_instance).unsqueeze(-1)
         return (
@@ -118,8 +124,25 @@ class FeatureDataset(Dataset):
             patient_ids,
         )
 
-    def dummy_batch(self, batch_size: int):
-        """Create a dummy batch of the largest possible size"""
+    def collate_packed(self, batch):
+        """Collate a batch of features into packed tensors, without padding.
+
+        The instances of all bags are concatenated, and the mask is replaced by the offsets of the bags (of shape
+        [B + 1]), so that the instances of bag i are feats[offsets[i] : offsets[i + 1]] (see histaug.train.models.segment).
+        """
+        feats, coords, labels, patient_ids = zip(*batch)
+        offsets = torch.tensor(np.cumsum([0, *(f.shape[0] for f in feats)]), dtype=torch.long)
+        labels = {label: torch.stack([l[label] for l in labels]) for label in labels[0]} if len(labels) > 0 else None
+        return (
+            torch.from_numpy(np.concatenate(feats)).float(),
+            torch.from_numpy(np.concatenate(coords)).int(),
+            offsets,
+            labels,
+            patient_ids,
+        )
+
+    def dummy_batch(self, batch_size: int, packed: bool = False):
+        """Create a dummy batch of the largest possible size (packed like collate_packed() if packed is True)"""
         sample_feats, sample_coords, sample_labels, *_ = self[0]
         d_model = sample_feats.shape[-1]
         instances_per_bag = getattr(self, "instances_per_bag", sample_feats.shape[-2])
@@ -128,9 +151,122 @@ class FeatureDataset(Dataset):
         labels = {label: value.expand(batch_size, *value.shape) for label, value in sample_labels.items()}
         indices = torch.arange(batch_size, dtype=torch.long)
         mask = torch.ones((batch_size, instances_per_bag), dtype=torch.bool)
+        if packed:
+            offsets = torch.arange(batch_size + 1, dtype=torch.long) * instances_per_bag
+            return tile_tokens.flatten(0, 1), tile_positions.flatten(0, 1), offsets, labels, indices
         return tile_tokens, tile_positions, mask, labels, indices
 
 
+def _group_name_for_aug(aug) -> str:
+    if aug == ORIGINAL_FEATURES:
+        return "feats"
+    elif aug == NORMALIZED_FEATURES:
+        return "feats_norm"
+    else:
+        return f"feats_augs/{aug}"
+
+
+class ZarrSlide:
+    """The feature groups of a slide's zarr feature file, like StoredSlide for the consolidated store.
+
+    Arrays and the encoding attributes of each group are read once, when first used, rather than for every sample.
+    """
+
+    def __init__(self, path: Union[str, Path]):
+        self.group = zarr.open_group(str(path), mode="r")
+        self._arrays = dict()
+        self._encodings = dict()
+
+    def __getitem__(self, group: str) -> zarr.Array:
+        if group not in self._arrays:
+            self._arrays[group] = self.group[group]
+        return self._arrays[group]
+
+    def __contains__(self, group: str) -> bool:
+        return group in self.group
+
+    def encoding(self, group: str) -> Dict[str, Any]:
+        if group not in self._encodings:
+            self._encodings[group] = self[group].attrs.asdict()
+        return self._encodings[group]
+
+
+_feature_stores = dict()  # path -> FeatureStore, opened once per process
+_zarr_slides = dict()  # path -> ZarrSlide, opened once per process
+
+
+def open_slide_features(slide: Union[str, Path], backend: str = "zarr"):
+    """Open the features of a slide, given the path to its feature file.
+
+    Args:
+        slide (Union[str, Path]): Path to the slide's feature file (<feature_dir>/<slide>.zarr).
+        backend (str, optional): "zarr" to open the feature file itself, or "store" to open the slide in the
+            consolidated FeatureStore of its feature directory (see histaug.data.feature_store). Defaults to "zarr".
+
+    Returns:
+        The slide's feature groups (e.g. "feats", "feats_augs/<aug>", "coords"), as a ZarrSlide or a StoredSlide.
+    """
+    slide = Path(slide)
+    if backend == "zarr":
+        if slide not in _zarr_slides:
+            _zarr_slides[slide] = ZarrSlide(slide)
+        return _zarr_slides[slide]
+    assert backend == "store", f"unknown feature backend {backend!r}"
+    store_path = slide.parent / STORE_NAME
+    if store_path not in _feature_stores:
+        _feature_stores[store_path] = FeatureStore(store_path)
+    return _feature_stores[store_path][slide.stem]
+
+
+def gather_features(
+    slides: Sequence[Union[str, Path]], augmentations: Sequence[str], indices: np.ndarray, backend: str = "zarr"
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Load the features and coordinates of the given (slide_index, patch_index, augmentation_index) triples.
+
+    The selected rows of each (slide, augmentation) pair are scattered into preallocated outputs, reading only the
+    chunks that contain selected rows (so that the cost scales with the number of triples rather than the slide size).
+    """
+    features = [open_slide_features(slide, backend) for slide in slides]
+    num_patches = len(indices)
+    feats = np.empty((num_patches, *features[0]["feats"].shape[1:]), dtype=np.float32)
+    coords = np.empty((num_patches, *features[0]["coords"].shape[1:]), dtype=features[0]["coords"].dtype)
+    for slide_index, f in enumerate(features):
+        in_slide = np.flatnonzero(indices[:, 0] == slide_index)
+        gather_rows(f["coords"], indices[in_slide, 1], coords, in_slide)
+        for augmentation_index, augmentation in enumerate(augmentations):
+            in_augmentation = in_slide[indices[in_slide, 2] == augmentation_index]
+            group = _group_name_for_aug(augmentation)
+            gather_rows(f[group], indices[in_augmentation, 1], feats, in_augmentation, f.encoding(group))
+    return feats, coords
+
+
+def gather_rows(
+    array: Union[zarr.Array, np.ndarray],
+    rows: np.ndarray,
+    out: np.ndarray,
+    out_rows: np.ndarray,
+    encoding: Optional[Mapping[str, Any]] = None,
+):
+    """Write array[rows] to out[out_rows], decompressing only the chunks of array that contain any of the rows.
+
+    Args:
+        array (Union[zarr.Array, np.ndarray]): Array to read from (a zarr array, or a slice of a memory-mapped store).
+        rows (np.ndarray): Unique indices of the rows to read.
+        out (np.ndarray): Preallocated output array.
+        out_rows (np.ndarray): Indices of the rows of out to write to.
+        encoding (Optional[Mapping[str, Any]], optional): Attributes of encoded features, which are decoded to float32
+            (see histaug.utils.saving.decode_features). Defaults to None (rows are copied as they are).
+    """
+    if len(rows) == 0:
+        return
+    order = np.argsort(rows)  # read the chunks in order
+    if isinstance(array, np.ndarray):
+        values = array[rows[order]]
+    else:
+        values = array.get_orthogonal_selection((rows[order],))
+    out[out_rows[order]] = decode_features(values, encoding) if encoding is not None else values
+
+
 def pad(x: np.ndarray, size: int, axis: int, fill_value: Any = 0):
     """Pad an array with zeros to a given size along a given axis"""
     if x.shape[axis] >= size:
@@ -140,32 +276,87 @@ def pad(x: np.ndarray, size: int, axis: int, fill_value: Any = 0):
     return np.pad(x, pad_width=pad_width, mode="constant", constant_values=fill_value)
 
 
+def pad_stack(arrays: Sequence[np.ndarray], size: int, dtype=None) -> np.ndarray:
+    """Stack arrays of shape [n_i, ...] into a zero-padded array of shape [len(arrays), size, ...]"""
+    out = np.zeros((len(arrays), size, *arrays[0].shape[1:]), dtype=dtype or arrays[0].dtype)
+    for i, x in enumerate(arrays):
+        out[i, : len(x)] = x
+    return out
+
+
 class CachedFeatureDataset(Dataset):
-    """Cached version of FeatureDataset that loads cached batches that were pre-computed using histaug.train.cache."""
+    """Cached version of FeatureDataset that loads cached batches that were pre-computed using histaug.train.cache.
 
-    def __init__(self, patient_ids: Sequence[str], targets: Optional[Mapping[str, torch.Tensor]], cache_dir: Path):
+    The cache stores, per epoch, the sampled (slide_index, patch_index, augmentation_index) triples of all patients in
+    a single packed array (indices.npy), along with an index (index.json) of the offset and length of each patient's
+    triples and the slides and augmentations they refer to. The packed array is memory-mapped, and the features are
+    gathered from the original feature files.
+    """
+
+    def __init__(
+        self,
+        patient_ids: Sequence[str],
+        targets: Optional[Mapping[str, torch.Tensor]],
+        cache_dir: Path,
+        backend: str = "zarr",
+    ):
         self._cache_dir = Path(cache_dir)
+        self.backend = backend
         self.patient_ids = patient_ids
         self.targets = targets
         self.epoch = 0  # will be overwritten by the trainer every epoch
+        self._loaded_epoch = None  # (epoch, index, memory-mapped indices) of the most recently used epoch
 
     @property
     def cache_dir(self):
         return self._cache_dir / f"epoch_{self.epoch:03d}"
 
+    def _load_epoch(self) -> Tuple[dict, np.ndarray]:
+        if self._loaded_epoch is None or self._loaded_epoch[0] != self.epoch:
+            with (self.cache_dir / "index.json").open("r") as f:
+                index = json.load(f)
+            self._loaded_epoch = (self.epoch, index, np.load(self.cache_dir / "indices.npy", mmap_mode="r"))
+        return self._loaded_epoch[1:]
+
     def __getitem__(self, index):
         patient_id = self.patient_ids[index]
         # logger.debug(f"Loading cached batch for patient {patient_id} at epoch {self.epoch}")
-        z = zarr.open_group(self.cache_dir / f"{patient_id}.zarr", mode="r")
+        if (self.cache_dir / "index.json").exists():
+            epoch_index, indices = self._load_epoch()
+            entry = epoch_index["patients"][str(patient_id)]
+            indices = indices[entry["offset"] : entry["offset"] + entry["length"]]
+            feats, coords = gather_features(
+                entry["slides"], epoch_index["augmentations"], indices, backend=self.backend
+            )
+        else:  # caches created before epochs were packed contain one zarr group per patient
+            z = zarr.open_group(self.cache_dir / f"{patient_id}.zarr", mode="r")
+            if "indices" in z:
+                feats, coords = gather_features(
+                    z.attrs["slides"], z.attrs["augmentations"], z["indices"][:], backend=self.backend
+                )
+            else:  # caches created before only the indices were stored contain the features themselves
+                feats, coords = z["feats"][:], z["coords"][:]
         return (
-            z["feats"][:],
-            z["coords"][:],
+            feats,
+            coords,
             {label: target[index] for label, target in self.targets.items()} if self.targets else None,
             patient_id,
         )
 
+    def bag_lengths(self) -> np.ndarray:
+        """Number of instances of each bag in the current epoch (see LengthBucketedBatchSampler)."""
+        if (self.cache_dir / "index.json").exists():
+            epoch_index, _ = self._load_epoch()
+            return np.array([epoch_index["patients"][str(p)]["length"] for p in self.patient_ids], dtype=int)
+        lengths = []
+        for patient_id in self.patient_ids:
+            z = zarr.open_group(self.cache_dir / f"{patient_id}.zarr", mode="r")
+            lengths.append((z["indices"] if "indices" in z else z["feats"]).shape[0])
+        return np.array(lengths, dtype=int)
+
     def __len__(self):
         return len(self.patient_ids)
 
     collate_fn = FeatureDataset.collate_fn
+    collate_packed = FeatureDataset.collate_packed
     dummy_batch = FeatureDataset.dummy_batch
@@ -0,0 +1,170 @@
+from pathlib import Path
+from typing import Union, Dict, Tuple, Iterable, Optional, Any
+import json
+import shutil
+import zarr
+import numpy as np
+from loguru import logger
+from tqdm import tqdm
+
+from ..utils.saving import FEATURES_VERSION, check_version, encode_features, decode_features
+
+__all__ = ["FeatureStore", "build_feature_store", "STORE_NAME"]
+
+STORE_NAME = "store"  # name of the store directory inside a feature directory
+STORE_VERSION = "0.1"
+
+
+class FeatureStore:
+    """Features of all slides in a feature directory, consolidated into one memory-mapped array per feature group.
+
+    The store is a directory containing
+        - index.json: the (offset, length) of each slide's rows, and the names of the feature groups;
+        - <group>.npy: the rows of all slides, concatenated (e.g. feats.npy, feats_augs/<aug>.npy, coords.npy).
+    Opening a slide only slices the memory-mapped arrays, without touching the filesystem. The features of all slides
+    are stored with the same encoding (see histaug.utils.saving.encode_features), recorded in the index.
+
+    Args:
+        path (Union[str, Path]): Path to the store (see build_feature_store()).
+    """
+
+    def __init__(self, path: Union[str, Path]):
+        self.path = Path(path)
+        with (self.path / "index.json").open("r") as f:
+            index = json.load(f)
+        assert index["version"] == STORE_VERSION, f"unsupported feature store version {index['version']}"
+        self.groups = index["groups"]
+        self.encodings = index.get("encodings", dict())  # group -> attributes to decode its features
+        self.slides: Dict[str, Tuple[int, int]] = {name: tuple(rows) for name, rows in index["slides"].items()}
+        self._arrays = dict()
+
+    def array(self, group: str) -> np.ndarray:
+        if group not in self._arrays:
+            self._arrays[group] = np.load(self.path / f"{group}.npy", mmap_mode="r")
+        return self._arrays[group]
+
+    def __contains__(self, slide_name: str) -> bool:
+        return slide_name in self.slides
+
+    def __getitem__(self, slide_name: str) -> "StoredSlide":
+        return StoredSlide(self, *self.slides[slide_name])
+
+    def __len__(self) -> int:
+        return len(self.slides)
+
+
+class StoredSlide:
+    """The features of a single slide in a FeatureStore, indexed like the slide's zarr group (e.g. slide["feats"])."""
+
+    def __init__(self, store: FeatureStore, offset: int, length: int):
+        self.store = store
+        self.offset = offset
+        self.length = length
+
+    def __getitem__(self, group: str) -> np.ndarray:
+        return self.store.array(group)[self.offset : self.offset + self.length]
+
+    def __contains__(self, group: str) -> bool:
+        return group in self.store.groups
+
+    def encoding(self, group: str) -> Dict[str, Any]:
+        return self.store.encodings.get(group, dict())
+
+
+def _list_groups(f: zarr.Group) -> Iterable[str]:
+    for name, array in f.arrays():
+        yield name
+    if "feats_augs" in f:
+        for name, array in f["feats_augs"].arrays():
+            yield f"feats_augs/{name}"
+
+
+def build_feature_store(
+    feature_dir: Union[str, Path],
+    output: Optional[Union[str, Path]] = None,
+    version: str = FEATURES_VERSION,
+    encoding: str = "float32",
+) -> FeatureStore:
+    """Consolidate the per-slide feature files (<slide>.zarr) of a feature directory into a FeatureStore.
+
+    Slides whose features are incomplete (or have a different version) are skipped. Only the feature groups that all
+    slides have in common are stored.
+
+    Args:
+        feature_dir (Union[str, Path]): Directory containing the per-slide feature files.
+        output (Optional[Union[str, Path]], optional): Path of the store. Defaults to <feature_dir>/store.
+        version (str, optional): Expected version of the feature files. Defaults to FEATURES_VERSION.
+        encoding (str, optional): Encoding of the features in the store; float32, float16 or bfloat16 (int8 is not
+            supported, as its per-dimension scales differ between slides). Defaults to "float32".
+    """
+    assert encoding in ("float32", "float16", "bfloat16"), f"unsupported feature store encoding {encoding!r}"
+    feature_dir = Path(feature_dir)
+    output = Path(output) if output is not None else feature_dir / STORE_NAME
+
+    slides = dict()  # name -> zarr group
+    for file in sorted(feature_dir.glob("*.zarr")):
+        if not check_version(file, version, throw=False):
+            logger.warning(f"Skipping {file}, which is incomplete or has a different version")
+            continue
+        slides[file.stem] = zarr.open_group(str(file), mode="r")
+    assert slides, f"no features found in {feature_dir}"
+
+    groups = set.intersection(*(set(_list_groups(f)) for f in slides.values()))
+    groups = sorted(groups - {"labels", "files"})  # per-slide metadata of the tile datasets
+    lengths = {name: f["feats"].shape[0] for name, f in slides.items()}
+    offsets = dict(zip(lengths, np.cumsum([0, *lengths.values()])[:-1].tolist()))
+    num_patches = sum(lengths.values())
+
+    # Write to a temporary directory first, so that an interrupted build does not leave a broken store behind
+    tmp_output = output.with_name(f".{output.name}.tmp")
+    shutil.rmtree(tmp_output, ignore_errors=True)
+    encodings = dict()
+    for group in groups:
+        path = tmp_output / f"{group}.npy"
+        path.parent.mkdir(parents=True, exist_ok=True)
+        array = None
+        for name, f in tqdm(slides.items(), desc=f"Consolidating {group}", leave=False):
+            data = f[group][:]
+            if group != "coords":  # re-encode the features of each slide with the encoding of the store
+                data, encodings[group] = encode_features(decode_features(data, f[group].attrs), encoding)
+            if array is None:
+                array = np.lib.format.open_memmap(
+                    path, mode="w+", dtype=data.dtype, shape=(num_patches, *data.shape[1:])
+                )
+            array[offsets[name] : offsets[name] + lengths[name]] = data
+        array.flush()
+        del array
+    with (tmp_output / "index.json").open("w") as f:
+        json.dump(
+            dict(
+                version=STORE_VERSION,
+                features_version=version,
+                groups=groups,
+                encodings=encodings,
+                slides={name: [offsets[name], lengths[name]] for name in slides},
+            ),
+            f,
+        )
+    shutil.rmtree(output, ignore_errors=True)
+    tmp_output.rename(output)
+    logger.info(f"Consolidated {len(slides)} slides ({num_patches} patches, {len(groups)} groups) into {output}")
+    return FeatureStore(output)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description="Consolidate the per-slide feature files of a feature directory into a memory-mapped store"
+    )
+    parser.add_argument("feature_dirs", type=Path, nargs="+", help="Feature directories (containing <slide>.zarr)")
+    parser.add_argument(
+        "--encoding",
+        choices=["float32", "float16", "bfloat16"],
+        default="float32",
+        help="Encoding of the features in the store (float16/bfloat16 halve the memory needed to keep it cached)",
+    )
+    args = parser.parse_args()
+
+    for feature_dir in args.feature_dirs:
+        build_feature_store(feature_dir, encoding=args.encoding)
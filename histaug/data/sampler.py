@@ -0,0 +1,70 @@
+from typing import Iterator, List, Optional, Sequence
+import numpy as np
+from torch.utils.data import Sampler
+
+__all__ = ["LengthBucketedBatchSampler"]
+
+
+class LengthBucketedBatchSampler(Sampler[List[int]]):
+    """Batch sampler that groups bags of similar length, so that batches of more than one bag waste little padding.
+
+    The bags are sorted by length and split into buckets of bucket_size consecutive bags. Each bucket is divided into
+    batches of as many bags as fit into the padded-token budget (batch size * length of the longest bag in the bucket
+    <= max_tokens; a bag that is longer than the budget on its own forms a batch of one). When shuffling, bags of equal
+    length are assigned to buckets at random, bags are shuffled within their bucket, and the order of the batches is
+    shuffled, so that batches differ from epoch to epoch while the number of batches stays the same.
+
+    Args:
+        lengths (Sequence[int]): Number of instances of each bag (see FeatureDataset.bag_lengths()).
+        max_tokens (int): Maximum number of instances per batch, including padding.
+        max_batch_size (Optional[int], optional): Maximum number of bags per batch. Defaults to None (no maximum).
+        bucket_size (int, optional): Number of bags per bucket. Larger buckets give more random batches, but more
+            padding when the bag lengths vary. Defaults to 64.
+        shuffle (bool, optional): Whether to shuffle the batches every epoch (using np.random). Defaults to True.
+    """
+
+    def __init__(
+        self,
+        lengths: Sequence[int],
+        max_tokens: int,
+        max_batch_size: Optional[int] = None,
+        bucket_size: int = 64,
+        shuffle: bool = True,
+    ):
+        assert max_tokens > 0 and bucket_size > 0
+        self.lengths = np.asarray(lengths)
+        self.max_tokens = max_tokens
+        self.max_batch_size = max_batch_size
+        self.bucket_size = bucket_size
+        self.shuffle = shuffle
+
+    def _bucket_batch_size(self, max_length: int) -> int:
+        batch_size = max(1, self.max_tokens // max(max_length, 1))
+        return min(batch_size, self.max_batch_size) if self.max_batch_size else batch_size
+
+    def batches(self) -> List[List[int]]:
+        """The batches of one epoch, as lists of bag indices."""
+        order = np.random.permutation(len(self.lengths)) if self.shuffle else np.arange(len(self.lengths))
+        order = order[np.argsort(self.lengths[order], kind="stable")]  # ties stay in random order
+        batches = []
+        for start in range(0, len(order), self.bucket_size):
+            bucket = order[start : start + self.bucket_size]
+            batch_size = self._bucket_batch_size(self.lengths[bucket].max())
+            if self.shuffle:
+                bucket = np.random.permutation(bucket)
+            batches.extend(bucket[i : i + batch_size].tolist() for i in range(0, len(bucket), batch_size))
+        if self.shuffle:
+            batches = [batches[i] for i in np.random.permutation(len(batches))]
+        return batches
+
+    def __iter__(self) -> Iterator[List[int]]:
+        yield from self.batches()
+
+    def __len__(self) -> int:
+        sorted_lengths = np.sort(self.lengths)
+        if len(sorted_lengths) == 0:
+            return 0
+        return sum(
+            -(-len(bucket) // self._bucket_batch_size(bucket.max()))
+            for bucket in np.split(sorted_lengths, range(self.bucket_size, len(sorted_lengths), self.bucket_size))
+        )
@@ -1,12 +1,66 @@
-from torch.utils.data import Dataset
+from torch import nn
+from torch.utils.data import Dataset, DataLoader
 from pathlib import Path
-from typing import Union, Optional
+from typing import Union, Optional, Iterable, Iterator, List, Tuple, Callable
+from collections import OrderedDict
 import zarr
 import torch
 import math
+import numpy as np
 from torchvision import transforms as T
 
 
+def patches_to_tensor(patches: np.ndarray) -> torch.Tensor:
+    """Convert uint8 patches of shape [N, H, W, C] to float tensors of shape [N, C, H, W] in [0, 1]."""
+    return (torch.from_numpy(patches).float() / 255.0).permute(0, 3, 1, 2)
+
+
+def tensor_to_patches(patches: torch.Tensor) -> torch.Tensor:
+    return (patches * 255).byte().permute(0, 2, 3, 1)
+
+
+def chunk_aligned_batch_size(batch_size: int, chunk_rows: int) -> int:
+    """Adjust a batch size so that batch boundaries coincide with the boundaries of chunks of chunk_rows patches.
+
+    Batches of at least one chunk are rounded down to whole chunks. Smaller batches are reduced to the largest divisor
+    of chunk_rows (as long as that does not more than halve the batch size), so that no batch straddles two chunks.
+    """
+    if batch_size >= chunk_rows:
+        return batch_size // chunk_rows * chunk_rows
+    divisor = max(d for d in range(1, batch_size + 1) if chunk_rows % d == 0)
+    return divisor if 2 * divisor >= batch_size else batch_size
+
+
+class _ChunkedReader:
+    """Reads row ranges of a zarr array chunk by chunk, keeping the last decoded chunk so that consecutive reads that
+    share a chunk only decompress it once. Counts the number of decompressed bytes."""
+
+    def __init__(self, array: zarr.Array):
+        self.array = array
+        self.chunk_rows = array.chunks[0]
+        self.chunk_nbytes = int(np.prod(array.chunks)) * array.dtype.itemsize
+        self.decompressed_bytes = 0
+        self._cached_chunk = None  # (chunk index, decoded rows)
+
+    def __getitem__(self, rows: slice) -> np.ndarray:
+        start, end = rows.start, rows.stop
+        if end <= start:
+            return self.array[start:end]
+        first_chunk, last_chunk = start // self.chunk_rows, (end - 1) // self.chunk_rows
+        parts = []
+        if self._cached_chunk is not None and self._cached_chunk[0] == first_chunk:
+            parts.append(self._cached_chunk[1])
+            first_chunk += 1
+        if first_chunk <= last_chunk:
+            decoded = self.array[first_chunk * self.chunk_rows : (last_chunk + 1) * self.chunk_rows]
+            self.decompressed_bytes += (last_chunk - first_chunk + 1) * self.chunk_nbytes
+            parts.append(decoded)
+            self._cached_chunk = (last_chunk, decoded[(last_chunk - first_chunk) * self.chunk_rows :])
+        rows = parts[0] if len(parts) == 1 else np.concatenate(parts)
+        offset = start - start // self.chunk_rows * self.chunk_rows
+        return rows[offset : offset + end - start]
+
+
 class SlideDataset(Dataset):
     def __init__(
         self,
@@ -14,35 +68,76 @@ class SlideDataset(Dataset):
         transform,
         inverse_transform,
         batch_size: Optional[int] = None,
+        align_to_chunks: bool = True,
     ):
+        """Batches of patches of a single slide.
+
+        Args:
+            slide (Union[str, Path]): Path to the slide's zarr group.
+            transform, inverse_transform: Transforms applied to the patches (see SlidesDataset).
+            batch_size (Optional[int], optional): Number of patches per batch. Defaults to None (all patches).
+            align_to_chunks (bool, optional): Whether to adjust the batch size to the chunk layout of the patches (see
+                chunk_aligned_batch_size), so that no batch straddles two chunks. Together with batch_groups(), this
+                ensures that no chunk has to be decompressed by two workers. Defaults to True.
+        """
         slide = Path(slide)
+        self.path = slide
         self.zarr_group = zarr.open_group(str(slide), mode="r")
-        self.batch_size = batch_size
+        self.patches = _ChunkedReader(self.zarr_group["patches"])
+        self.norm_patches = (
+            _ChunkedReader(self.zarr_group["normalized_patches"]) if "normalized_patches" in self.zarr_group else None
+        )
         self.num_patches = self.zarr_group["patches"].shape[0]
+        if batch_size and align_to_chunks:
+            batch_size = chunk_aligned_batch_size(batch_size, self.patches.chunk_rows)
+        self.batch_size = batch_size
         self.num_batches = math.ceil(self.num_patches / self.batch_size) if self.batch_size else 1
         self.name = slide.stem
         self.transform = transform
         self.inverse_transform = inverse_transform
 
     def __getitem__(self, index):
-        start = index * self.batch_size
-        end = min(start + self.batch_size, self.num_patches)
+        start = index * self.batch_size if self.batch_size else 0
+        end = min(start + self.batch_size, self.num_patches) if self.batch_size else self.num_patches
         coords = self.zarr_group["coords"][start:end]
-        patches = self.zarr_group["patches"][start:end]
-        patches = self.transform(patches)
-        norm_patches = (
-            self.zarr_group["normalized_patches"][start:end] if "normalized_patches" in self.zarr_group else None
-        )
-        norm_patches = self.transform(norm_patches) if norm_patches is not None else None
+        patches = self.transform(self.patches[start:end])
+        norm_patches = self.transform(self.norm_patches[start:end]) if self.norm_patches is not None else None
         return patches, torch.from_numpy(coords), norm_patches
 
     def __len__(self):
         return self.num_batches
 
+    def batch_groups(self, start_batch: int = 0) -> List[range]:
+        """The batches from start_batch on, grouped by the chunk of patches they start in, so that the batches of a
+        chunk can be read by the same worker (batches of at least one chunk each form a group of their own)."""
+        chunk_rows = self.patches.chunk_rows
+        if not self.batch_size or self.batch_size >= chunk_rows:
+            return [range(i, i + 1) for i in range(start_batch, len(self))]
+        groups = []
+        for i in range(start_batch, len(self)):
+            if groups and groups[-1].start * self.batch_size // chunk_rows == i * self.batch_size // chunk_rows:
+                groups[-1] = range(groups[-1].start, i + 1)
+            else:
+                groups.append(range(i, i + 1))
+        return groups
+
     @property
     def coords(self):
         return self.zarr_group["coords"][:]
 
+    @property
+    def decompressed_bytes(self) -> int:
+        """Number of bytes of patches (and normalized patches) decompressed so far by this process."""
+        return self.patches.decompressed_bytes + (
+            self.norm_patches.decompressed_bytes if self.norm_patches is not None else 0
+        )
+
+    @property
+    def patch_nbytes(self) -> int:
+        """Uncompressed size of a single patch (and its normalized version) in bytes."""
+        nbytes = lambda reader: int(np.prod(reader.array.shape[1:])) * reader.array.dtype.itemsize
+        return nbytes(self.patches) + (nbytes(self.norm_patches) if self.norm_patches is not None else 0)
+
 
 class SlidesDataset:
     def __init__(
@@ -51,6 +146,8 @@ class SlidesDataset:
         batch_size: Optional[int] = None,
         start: int = 0,
         end: int = None,
+        align_to_chunks: bool = True,
+        uint8: bool = False,
     ):
         """This dataset is a collection of patches from the slides in the root directory.
         Each element of the dataset is a batch of patches from a single slide.
@@ -60,6 +157,11 @@ class SlidesDataset:
             batch_size (Optional[int], optional): Number of patches per iteration. Defaults to None (all patches).
             start (int, optional): Index of the first slide to include. Defaults to 0.
             end (int, optional): Index of the last slide to include. Defaults to None (all slides).
+            align_to_chunks (bool, optional): Whether to align the batches to the chunk layout of each slide (see
+                SlideDataset). Defaults to True.
+            uint8 (bool, optional): Whether to keep the patches as uint8 of shape [N, H, W, C] (as stored), so that 4x
+                less data is passed between processes and copied to the device. They are converted to floats on the
+                device (see histaug.utils.images.to_float_patches). Defaults to False.
         """
         super().__init__()
 
@@ -68,10 +170,15 @@ class SlidesDataset:
         end = end or len(slides)
         self.slides = slides[start:end]
         self.batch_size = batch_size
-        self.transform = T.Lambda(
-            lambda patches: (torch.from_numpy(patches).float() / 255.0).permute(0, 3, 1, 2)
-        )  # we will normalize later (in the feature extractor's forward() method)
-        self.inverse_transform = T.Lambda(lambda patches: (patches * 255).byte().permute(0, 2, 3, 1))
+        self.align_to_chunks = align_to_chunks
+        if uint8:
+            self.transform = T.Lambda(torch.from_numpy)
+            self.inverse_transform = nn.Identity()
+        else:
+            self.transform = T.Lambda(
+                patches_to_tensor
+            )  # we will normalize later (in the feature extractor's forward() method)
+            self.inverse_transform = T.Lambda(tensor_to_patches)
 
     def __getitem__(self, index) -> SlideDataset:
         return SlideDataset(
@@ -79,6 +186,7 @@ class SlidesDataset:
             batch_size=self.batch_size,
             transform=self.transform,
             inverse_transform=self.inverse_transform,
+            align_to_chunks=self.align_to_chunks,
         )
 
     def __len__(self):
@@ -87,3 +195,148 @@ class SlidesDataset:
     def __iter__(self):
         for i in range(len(self)):
             yield self[i]
+
+
+class SlideBatchesDataset(Dataset):
+    """Dataset whose indices are (slide path, batch size, transform, batch indices) tuples, so that a single DataLoader
+    can read batches from many slides. Each index is a group of consecutive batches (see SlideDataset.batch_groups()),
+    which are all read by the same worker. Each worker keeps its most recently used slides open.
+
+    Along with the batches, the number of bytes the worker decompressed to read them is returned."""
+
+    def __init__(self, max_open_slides: int = 4):
+        self.max_open_slides = max_open_slides
+        self._open_slides = OrderedDict()
+
+    def _open(self, path: str, batch_size: Optional[int], transform: Callable) -> SlideDataset:
+        key = (path, batch_size)
+        if key in self._open_slides:
+            self._open_slides.move_to_end(key)
+        else:
+            self._open_slides[key] = SlideDataset(
+                path,
+                transform=transform,
+                inverse_transform=None,
+                batch_size=batch_size,
+                align_to_chunks=False,  # the batch size was already aligned when the index was generated
+            )
+            while len(self._open_slides) > self.max_open_slides:
+                self._open_slides.popitem(last=False)
+        return self._open_slides[key]
+
+    def __getitem__(self, index: Tuple[str, Optional[int], Callable, range]):
+        path, batch_size, transform, batch_indices = index
+        slide = self._open(path, batch_size, transform)
+        decompressed_bytes = slide.decompressed_bytes
+        batches = [(batch_index, *slide[batch_index]) for batch_index in batch_indices]
+        return path, batches, slide.decompressed_bytes - decompressed_bytes
+
+
+class PinnedBufferRing:
+    """A ring of reusable page-locked buffers for host-to-device copies.
+
+    Instead of pinning a freshly allocated tensor for every batch, each batch is copied into the next buffer of the
+    ring. A buffer is only reused after len(ring) - 1 further batches, by which time its previous (non-blocking) copy
+    to the device has long completed because the features of that batch have been copied back.
+    """
+
+    def __init__(self, size: int = 3):
+        self.size = size
+        self._buffers = dict()  # (dtype, shape[1:]) -> list of buffers
+        self._next = dict()
+
+    def __call__(self, x: torch.Tensor) -> torch.Tensor:
+        key = (x.dtype, tuple(x.shape[1:]))
+        buffers = self._buffers.setdefault(key, [])
+        i = self._next.get(key, 0)
+        self._next[key] = (i + 1) % self.size
+        if i >= len(buffers) or buffers[i].shape[0] < x.shape[0]:
+            buffer = torch.empty_like(x, device="cpu").pin_memory()
+            if i >= len(buffers):
+                buffers.append(buffer)
+            else:
+                buffers[i] = buffer
+        buffer = buffers[i][: x.shape[0]]
+        buffer.copy_(x)
+        return buffer
+
+
+class SlidesLoader:
+    """Reads the batches of a (lazily generated) sequence of slides through a single DataLoader.
+
+    Unlike one DataLoader per slide, the worker processes stay alive across slides, and the first batches of the next
+    slide are prefetched while the current slide is still being processed. The slides are only requested from the
+    iterable when the DataLoader needs to prefetch their batches. Batches smaller than a chunk of patches are read in
+    groups of one chunk by a single worker (see SlideDataset.batch_groups()), so that workers do not decompress the same
+    chunks.
+
+    Args:
+        slides (Iterable[Tuple[SlideDataset, int]]): (slide, index of the first batch to read) pairs.
+        num_workers (int, optional): Number of worker processes. Defaults to 8.
+        prefetch_factor (int, optional): Number of batches prefetched per worker. Defaults to 2.
+        pin_memory (bool, optional): Whether to copy the patches into reusable page-locked buffers. Defaults to False.
+
+    Yields:
+        (slide, batch_index, patches, coords, norm_patches) tuples, in order.
+
+    Attributes:
+        decompressed_bytes (int): Number of bytes decompressed by the workers to read the batches yielded so far.
+        patch_bytes (int): Uncompressed size of the patches yielded so far, i.e. the minimum for decompressed_bytes.
+        num_patches_read (int): Number of patches yielded so far.
+    """
+
+    def __init__(
+        self,
+        slides: Iterable[Tuple[SlideDataset, int]],
+        num_workers: int = 8,
+        prefetch_factor: int = 2,
+        pin_memory: bool = False,
+    ):
+        self.slides = slides
+        self.num_workers = num_workers
+        self.prefetch_factor = prefetch_factor
+        self.pin = PinnedBufferRing() if pin_memory else None
+        self.dataset = SlideBatchesDataset()
+        self.decompressed_bytes = 0
+        self.patch_bytes = 0
+        self.num_patches_read = 0
+
+    @property
+    def decompressed_bytes_per_patch(self) -> float:
+        return self.decompressed_bytes / max(self.num_patches_read, 1)
+
+    @property
+    def decompression_overhead(self) -> float:
+        """Ratio of decompressed bytes to the size of the patches read (1 if every chunk is decompressed once)."""
+        return self.decompressed_bytes / max(self.patch_bytes, 1)
+
+    def __iter__(self) -> Iterator[Tuple[SlideDataset, int, torch.Tensor, torch.Tensor, Optional[torch.Tensor]]]:
+        slides_by_path = dict()
+
+        def indices():
+            for slide, start_batch in self.slides:
+                slides_by_path[str(slide.path)] = slide
+                for batch_indices in slide.batch_groups(start_batch):
+                    yield str(slide.path), slide.batch_size, slide.transform, batch_indices
+
+        loader = DataLoader(
+            self.dataset,
+            batch_size=None,
+            sampler=indices(),
+            num_workers=self.num_workers,
+            prefetch_factor=self.prefetch_factor if self.num_workers > 0 else None,
+        )  # the sampler yields the batches in order, and the DataLoader keeps them in order
+        current_path = None
+        for path, batches, decompressed_bytes in loader:
+            if path != current_path:
+                slides_by_path.pop(current_path, None)
+                current_path = path
+            slide = slides_by_path[path]
+            self.decompressed_bytes += decompressed_bytes
+            for batch_index, patches, coords, norm_patches in batches:
+                self.patch_bytes += len(patches) * slide.patch_nbytes
+                self.num_patches_read += len(patches)
+                if self.pin is not None:
+                    patches = self.pin(patches)
+                    norm_patches = self.pin(norm_patches) if norm_patches is not None else None
+                yield slide, batch_index, patches, coords, norm_patches
@@ -1 +1 @@
-from .augmented_feature_extractor import AugmentedFeatureExtractor
+from .augmented_feature_extractor import AugmentedFeatureExtractor, MultiAugmentedFeatureExtractor
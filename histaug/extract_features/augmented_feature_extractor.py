@@ -1,23 +1,133 @@
 from torch import nn
 import torch
-from typing import Dict, Tuple
+from collections import defaultdict
+from typing import Dict, Tuple, Sequence, Optional, Iterable, Iterator, Mapping
 
 
 from ..augmentations import Augmentations
+from ..data.feature_dataset import ORIGINAL_FEATURES, NORMALIZED_FEATURES
+from ..utils.images import to_float_patches
+
+ExtractedFeatures = Tuple[torch.Tensor, Dict[str, torch.Tensor], Optional[torch.Tensor]]
+
+
+def iter_views(augmentations: Augmentations, patches, norm_patches=None) -> Iterator[Tuple[str, torch.Tensor]]:
+    """Lazily generate the (name, patches) views of a batch: the original patches, each augmentation, and the
+    normalized patches (if available). Augmentations are only computed when the view is requested.
+
+    Patches may be given as uint8 of shape [N, H, W, C], in which case they are converted (on their device) first."""
+    patches = to_float_patches(patches)
+    norm_patches = to_float_patches(norm_patches) if norm_patches is not None else None
+    yield ORIGINAL_FEATURES, patches
+    for aug_name, aug in augmentations.items():
+        yield aug_name, aug(patches)
+    if norm_patches is not None:
+        yield NORMALIZED_FEATURES, norm_patches
+
+
+def embed_views(
+    feature_extractors: Mapping[str, nn.Module],
+    views: Iterable[Tuple[str, torch.Tensor]],
+    micro_batch_size: Optional[int] = None,
+) -> Dict[str, Dict[str, torch.Tensor]]:
+    """Pass views of a batch through multiple feature extractors, concatenating the views into micro-batches.
+
+    Consecutive views are packed (and split, if needed) into micro-batches of exactly micro_batch_size patches, so each
+    feature extractor runs once per micro-batch and only one micro-batch of augmented patches is alive at any time.
+    The features are then split back per view.
+
+    Args:
+        feature_extractors (Mapping[str, nn.Module]): Feature extractors by name.
+        views (Iterable[Tuple[str, torch.Tensor]]): (name, patches) pairs, see iter_views().
+        micro_batch_size (Optional[int], optional): Number of patches per forward pass. Defaults to None (one forward
+            pass per view).
+
+    Returns:
+        Dict[str, Dict[str, torch.Tensor]]: Features by feature extractor name and view name.
+    """
+    outputs = {name: defaultdict(list) for name in feature_extractors}
+    pending = []  # (view name, patches) pieces of the current micro-batch
+    pending_size = 0
+
+    def flush():
+        nonlocal pending_size
+        if not pending:
+            return
+        sizes = [len(piece) for _, piece in pending]
+        micro_batch = torch.cat([piece for _, piece in pending]) if len(pending) > 1 else pending[0][1]
+        for name, feature_extractor in feature_extractors.items():
+            for (view_name, _), feats in zip(pending, feature_extractor(micro_batch).split(sizes)):
+                outputs[name][view_name].append(feats)
+        pending.clear()
+        pending_size = 0
+
+    for view_name, view in views:
+        start = 0
+        while start < len(view):
+            n = (
+                len(view) - start
+                if micro_batch_size is None
+                else min(len(view) - start, micro_batch_size - pending_size)
+            )
+            pending.append((view_name, view[start : start + n]))
+            pending_size += n
+            start += n
+            if micro_batch_size is None or pending_size >= micro_batch_size:
+                flush()
+    flush()
+
+    return {
+        name: {view_name: torch.cat(feats) if len(feats) > 1 else feats[0] for view_name, feats in view_feats.items()}
+        for name, view_feats in outputs.items()
+    }
+
+
+def _split_views(view_feats: Dict[str, torch.Tensor]) -> ExtractedFeatures:
+    feats_augs = dict(view_feats)
+    feats = feats_augs.pop(ORIGINAL_FEATURES)
+    feats_norm = feats_augs.pop(NORMALIZED_FEATURES, None)
+    return feats, feats_augs, feats_norm
 
 
 class AugmentedFeatureExtractor(nn.Module):
-    def __init__(self, feature_extractor: nn.Module, augmentations: Augmentations):
+    def __init__(
+        self, feature_extractor: nn.Module, augmentations: Augmentations, micro_batch_size: Optional[int] = None
+    ):
         super().__init__()
         self.feature_extractor = feature_extractor
         self.augmentations = augmentations
+        self.micro_batch_size = micro_batch_size
 
-    def forward(self, patches, norm_patches=None) -> Tuple[torch.Tensor, Dict[str, torch.Tensor]]:
-        feats = self.feature_extractor(patches)
+    def forward(self, patches, norm_patches=None) -> ExtractedFeatures:
+        views = iter_views(self.augmentations, patches, norm_patches)
+        view_feats = embed_views({"": self.feature_extractor}, views, micro_batch_size=self.micro_batch_size)[""]
+        return _split_views(view_feats)
 
-        augs = {aug_name: aug(patches) for aug_name, aug in self.augmentations.items()}
-        feats_augs = {aug_name: self.feature_extractor(aug) for aug_name, aug in augs.items()}
 
-        feats_norm = self.feature_extractor(norm_patches) if norm_patches is not None else None
+class MultiAugmentedFeatureExtractor(nn.Module):
+    """Applies the augmentations once per batch, and passes the (augmented) patches through multiple feature extractors.
+
+    The same augmented views are used for all feature extractors, so random augmentations are consistent across them.
+    """
+
+    def __init__(
+        self,
+        feature_extractors: Sequence[nn.Module],
+        augmentations: Augmentations,
+        micro_batch_size: Optional[int] = None,
+    ):
+        super().__init__()
+        self.augmentations = augmentations
+        self.feature_extractors = nn.ModuleDict({fe.name: fe for fe in feature_extractors})
+        self.micro_batch_size = micro_batch_size
 
-        return feats, feats_augs, feats_norm
+    def forward(
+        self, patches, norm_patches=None, names: Optional[Sequence[str]] = None
+    ) -> Dict[str, ExtractedFeatures]:
+        names = names if names is not None else list(self.feature_extractors.keys())
+        if not names:
+            return dict()
+        views = iter_views(self.augmentations, patches, norm_patches)
+        feature_extractors = {name: self.feature_extractors[name] for name in names}
+        outputs = embed_views(feature_extractors, views, micro_batch_size=self.micro_batch_size)
+        return {name: _split_views(view_feats) for name, view_feats in outputs.items()}
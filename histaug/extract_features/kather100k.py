@@ -5,17 +5,26 @@ import itertools
 from tqdm import tqdm
 from pathlib import Path
 from loguru import logger
+from typing import Optional
 
 from ..data import Kather100k
 from ..augmentations import load_augmentations, Augmentations
 from ..feature_extractors import load_feature_extractor, FEATURE_EXTRACTORS
 from ..utils import save_features
+from ..utils.saving import FEATURE_ENCODINGS
 from .augmented_feature_extractor import AugmentedFeatureExtractor
 
 
 @torch.no_grad()
-def process_dataset(loader, model: nn.Module, augmentations: Augmentations, device="cuda", n_batches: int = None):
-    augmented_feature_extractor = AugmentedFeatureExtractor(model, augmentations)
+def process_dataset(
+    loader,
+    model: nn.Module,
+    augmentations: Augmentations,
+    device="cuda",
+    n_batches: int = None,
+    micro_batch_size: Optional[int] = None,
+):
+    augmented_feature_extractor = AugmentedFeatureExtractor(model, augmentations, micro_batch_size)
     augmented_feature_extractor.to(device)
 
     all_labels = []
@@ -67,7 +76,32 @@ if __name__ == "__main__":
         default="ctranspath",
         help="Feature extractor model",
     )
+    parser.add_argument(
+        "--micro-batch-size",
+        type=int,
+        default=None,
+        help="Number of (augmented) images per forward pass (default: one forward pass per augmentation)",
+    )
     parser.add_argument("--n-batches", type=int, default=None, help="Number of batches to process. Defaults to all.")
+    parser.add_argument(
+        "--encoding",
+        choices=FEATURE_ENCODINGS,
+        default="float32",
+        help="Storage encoding of the features (see python -m histaug.extract_features.verify_encoding for the error of each encoding)",
+    )
+    parser.add_argument(
+        "--chunk-rows",
+        dest="chunk_size",
+        type=int,
+        default=2048,
+        help="Number of images per chunk of the feature arrays; smaller chunks make random access cheaper (see python -m histaug.data.benchmark_storage)",
+    )
+    parser.add_argument(
+        "--compressor",
+        type=str,
+        default="default",
+        help="Compressor of the feature arrays, as <codec>[:<level>[:<shuffle>]] (e.g. lz4, zstd:3:bitshuffle, none; default: zarr's default)",
+    )
     parser.add_argument("--device", type=str, default="cuda", help="Device to use for feature extraction")
     args = parser.parse_args()
 
@@ -85,7 +119,12 @@ if __name__ == "__main__":
 
     logger.info("Processing dataset")
     feats, feats_augs, labels, files = process_dataset(
-        loader, model, augmentations, device=args.device, n_batches=args.n_batches or (len(ds) // args.batch_size)
+        loader,
+        model,
+        augmentations,
+        device=args.device,
+        n_batches=args.n_batches or (len(ds) // args.batch_size),
+        micro_batch_size=args.micro_batch_size,
     )
 
     logger.info(f"Saving features to {output_folder}")
@@ -97,4 +136,7 @@ if __name__ == "__main__":
         labels=labels,
         files=files,
         classes=ds.classes,
+        encoding=args.encoding,
+        chunk_size=args.chunk_size,
+        compressor=args.compressor,
     )
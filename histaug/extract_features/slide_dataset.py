@@ -1,63 +1,148 @@
-from torch.utils.data import DataLoader
+import hashlib
+import json
 import torch
 from torch import nn
 from tqdm import tqdm
 from pathlib import Path
 from loguru import logger
-import shutil
-from collections import defaultdict
+from typing import Sequence, Union, Optional, Iterable, Callable
 
-from ..data import SlidesDataset
-from ..augmentations import load_augmentations, Augmentations
+from ..data import SlidesDataset, SlideDataset, SlidesLoader
+from ..augmentations import load_augmentations, Augmentations, MacenkoSlidewise, SlideStainCache
 from ..feature_extractors import load_feature_extractor, FEATURE_EXTRACTORS, FeatureExtractor
-from ..utils import save_features, check_version
-from .augmented_feature_extractor import AugmentedFeatureExtractor
+from ..utils import FeatureWriter, check_version
+from ..utils.saving import FEATURE_ENCODINGS
+from ..utils.work_queue import WorkQueue
+from .augmented_feature_extractor import MultiAugmentedFeatureExtractor
+
+
+def work_queue_dir(queue_root: Path, model_names: Sequence[str], augmentation_names: Iterable[str]) -> Path:
+    """Work queue directory of an extraction job within a shared queue directory.
+
+    Slides are marked as done per combination of feature extractors and augmentations, so that a job with other models
+    or augmentations that uses the same queue directory does not skip the slides finished by this one.
+    """
+    augmentations_hash = hashlib.md5(json.dumps(sorted(augmentation_names)).encode()).hexdigest()[:8]
+    return Path(queue_root) / f"{'+'.join(sorted(model_names))}_augs-{augmentations_hash}"
 
 
 @torch.no_grad()
 def process_dataset(
-    ds: SlidesDataset,
-    model: FeatureExtractor,
+    ds: Union[SlidesDataset, Iterable[SlideDataset]],
+    models: Union[FeatureExtractor, Sequence[FeatureExtractor]],
     augmentations: Augmentations,
     output_folder: Path,
     device="cuda",
     num_workers: int = 8,
+    micro_batch_size: Optional[int] = None,
+    on_slide_done: Optional[Callable[[SlideDataset], None]] = None,
+    encoding: str = "float32",
+    chunk_size: int = 2048,
+    compressor: str = "default",
 ):
-    augmented_feature_extractor = AugmentedFeatureExtractor(model, augmentations)
+    """Extract features for all slides in the dataset, saving them to output_folder/<model name>/<slide name>.zarr.
+
+    Features are written to disk batch by batch, and partially written slides are resumed where they left off.
+    All slides are read through a single SlidesLoader, so the next slide is prefetched while the current one is
+    processed. on_slide_done is called once all features of a slide have been written.
+
+    If multiple models are given, each batch of patches is read and augmented only once, and then passed through all
+    of the models. The augmented views are embedded in micro-batches of micro_batch_size patches (see embed_views).
+    Features are stored with the given encoding, in chunks of chunk_size rows compressed with the given compressor (see
+    histaug.utils.saving.encode_features and make_compressor).
+    """
+    models = [models] if isinstance(models, nn.Module) else list(models)
+    augmented_feature_extractor = MultiAugmentedFeatureExtractor(models, augmentations, micro_batch_size)
     augmented_feature_extractor.to(device)
+    model_names = ", ".join(model.name for model in models)
+
+    writers = dict()  # slide name -> {model name -> FeatureWriter}
 
-    for slide in tqdm(ds, desc=f"Processing slides with {model.name}", position=0, leave=True):
-        output_file = output_folder / f"{slide.name}.zarr"
-        if output_file.exists() and check_version(output_file, throw=False):
-            logger.info(f"Skipping slide {slide.name}, output file {output_file} already exists")
-            continue
+    def slides_to_process():
+        for slide in ds:
+            slide_writers = dict()
+            for model in models:
+                output_file = output_folder / model.name / f"{slide.name}.zarr"
+                if output_file.exists() and check_version(output_file, throw=False):
+                    logger.info(
+                        f"Skipping slide {slide.name} for {model.name}, output file {output_file} already exists"
+                    )
+                    continue
+                slide_writers[model.name] = FeatureWriter(
+                    output_file,
+                    num_patches=slide.num_patches,
+                    coords=slide.coords,
+                    encoding=encoding,
+                    chunk_size=chunk_size,
+                    compressor=compressor,
+                )
 
-        shutil.rmtree(output_file, ignore_errors=True)
+            if not slide_writers:
+                if on_slide_done is not None:
+                    on_slide_done(slide)
+                continue
 
-        all_feats = []
-        all_feats_augs = defaultdict(list)
-        all_feats_norm = []
+            # Resume partially written slides from the first batch that is missing for any of the models
+            batch_size = slide.batch_size or max(slide.num_patches, 1)
+            start_batch = min(writer.num_written for writer in slide_writers.values()) // batch_size
+            writers[slide.name] = slide_writers
+            if start_batch >= len(slide):  # nothing left to read (e.g. a slide without patches)
+                finish_slide(slide)
+                continue
+            if start_batch > 0:
+                logger.info(f"Resuming slide {slide.name} from patch {start_batch * batch_size}/{slide.num_patches}")
+            yield slide, start_batch
 
-        loader = DataLoader(
-            slide, batch_size=None, shuffle=False, num_workers=num_workers, pin_memory=True
-        )  # shuffle must be False to keep patches in order (so that we save them in order, as they are saved per slide)
+    def finish_slide(slide):
+        for writer in writers.pop(slide.name).values():
+            writer.close()
+        if on_slide_done is not None:
+            on_slide_done(slide)
 
-        for patches, coords, norm_patches in tqdm(
-            loader, desc=f"Processing patches in {slide.name}", position=1, leave=False
+    loader = SlidesLoader(
+        slides_to_process(),
+        num_workers=num_workers,
+        pin_memory=str(device).startswith("cuda"),
+    )  # batches are yielded in order (so that we save them in order, as they are saved per slide)
+
+    current_slide = None
+    with tqdm(desc=f"Processing slides with {model_names}", position=0, leave=True) as slides_pbar:
+        for slide, batch_index, patches, coords, norm_patches in tqdm(
+            loader, desc="Processing patches", position=1, leave=False
         ):
-            imgs = patches.to(device)
-            norm_imgs = norm_patches.to(device) if norm_patches is not None else None
-            feats, feats_augs, feats_norm = augmented_feature_extractor(patches=imgs, norm_patches=norm_imgs)
+            if slide is not current_slide:
+                if current_slide is not None:
+                    finish_slide(current_slide)
+                    slides_pbar.update()
+                current_slide = slide
+                augmentations.fit_slide(slide)
+                slides_pbar.set_postfix(
+                    decompressed=f"{loader.decompressed_bytes_per_patch / 1024:.0f} KiB/patch",
+                    overhead=f"{loader.decompression_overhead:.2f}x",
+                )
+
+            imgs = patches.to(device, non_blocking=True)
+            norm_imgs = norm_patches.to(device, non_blocking=True) if norm_patches is not None else None
+            slide_writers = writers[slide.name]
+            results = augmented_feature_extractor(patches=imgs, norm_patches=norm_imgs, names=list(slide_writers))
 
-            all_feats.append(feats.detach().cpu())
-            all_feats_norm.append(feats_norm.detach().cpu() if feats_norm is not None else None)
-            for aug_name, feats_aug in feats_augs.items():
-                all_feats_augs[aug_name].append(feats_aug.detach().cpu())
+            batch_size = slide.batch_size or max(slide.num_patches, 1)
+            for name, (feats, feats_augs, feats_norm) in results.items():
+                slide_writers[name].write(
+                    batch_index * batch_size,
+                    feats.detach().cpu(),
+                    {aug_name: feats_aug.detach().cpu() for aug_name, feats_aug in feats_augs.items()},
+                    feats_norm=feats_norm.detach().cpu() if feats_norm is not None else None,
+                )
 
-        feats = torch.cat(all_feats)
-        feats_augs = {aug_name: torch.cat(feats_augs) for aug_name, feats_augs in all_feats_augs.items()}
-        feats_norm = None if any(f is None for f in all_feats_norm) else torch.cat(all_feats_norm)
-        save_features(output_file, feats, feats_augs, slide.coords, feats_norm=feats_norm)
+        if current_slide is not None:
+            finish_slide(current_slide)
+            slides_pbar.update()
+
+    logger.info(
+        f"Read {loader.num_patches_read} patches, decompressing {loader.decompressed_bytes_per_patch / 1024:.1f} KiB per "
+        f"patch ({loader.decompression_overhead:.2f}x the uncompressed patch size)"
+    )
 
 
 if __name__ == "__main__":
@@ -79,34 +164,111 @@ if __name__ == "__main__":
     )
     parser.add_argument(
         "--model",
+        "-m",
+        dest="models",
         type=str,
+        nargs="+",
         choices=list(FEATURE_EXTRACTORS.keys()),
-        default="ctranspath",
-        help="Feature extractor model",
+        default=["ctranspath"],
+        help="Feature extractor model(s); if multiple are given, each slide is read and augmented only once",
+    )
+    parser.add_argument(
+        "--micro-batch-size",
+        type=int,
+        default=None,
+        help="Number of (augmented) patches per forward pass; augmented views are concatenated/split to this size, bounding peak memory (default: one forward pass per augmentation)",
+    )
+    parser.add_argument(
+        "--no-align-batches",
+        dest="align_batches",
+        action="store_false",
+        help="Do not adjust the batch size to the chunk layout of the patches (by default, batches are aligned to whole chunks so that no chunk is decompressed twice)",
+    )
+    parser.add_argument(
+        "--uint8",
+        action="store_true",
+        help="Pass patches to the device as uint8 and convert them to floats there, which is 4x less data to pass between worker processes and copy to the device",
+    )
+    parser.add_argument(
+        "--encoding",
+        choices=FEATURE_ENCODINGS,
+        default="float32",
+        help="Storage encoding of the features (see python -m histaug.extract_features.verify_encoding for the error of each encoding)",
+    )
+    parser.add_argument(
+        "--chunk-rows",
+        dest="chunk_size",
+        type=int,
+        default=2048,
+        help="Number of patches per chunk of the feature arrays; smaller chunks make random access cheaper (see python -m histaug.data.benchmark_storage)",
+    )
+    parser.add_argument(
+        "--compressor",
+        type=str,
+        default="default",
+        help="Compressor of the feature arrays, as <codec>[:<level>[:<shuffle>]] (e.g. lz4, zstd:3:bitshuffle, none; default: zarr's default)",
     )
     parser.add_argument("--device", type=str, default="cuda", help="Device to use for feature extraction")
     parser.add_argument("--start", type=int, default=0, help="Index of the first slide to process")
     parser.add_argument("--end", type=int, default=None, help="Index of the last slide to process")
+    parser.add_argument(
+        "--queue",
+        type=Path,
+        default=None,
+        help="Shared work queue directory; any number of processes (or nodes) started with the same --queue, models and augmentations split the slides between them, and interrupted runs resume at slide granularity (each combination of models and augmentations has its own queue in a subdirectory)",
+    )
     parser.add_argument(
         "--aug", "-a", dest="augs", nargs="+", default=None, help="Augmentations to apply (default all)"
     )
+    parser.add_argument(
+        "--stain-cache",
+        type=Path,
+        default=None,
+        help="Path to the per-slide stain matrix index used by slide-wise Macenko normalization (default: <output>/macenko_stains.json, shared between feature extractors)",
+    )
     args = parser.parse_args()
 
-    output_folder = args.output / args.model
-    output_folder.mkdir(parents=True, exist_ok=True)
+    for model_name in args.models:
+        (args.output / model_name).mkdir(parents=True, exist_ok=True)
 
     ds = SlidesDataset(
         args.dataset,
         batch_size=args.batch_size,
         start=args.start,
         end=args.end,
+        align_to_chunks=args.align_batches,
+        uint8=args.uint8,
     )  # dataset already loads patches in batches
 
-    logger.info(f"Loaded dataset with {len(ds)} slides, will process in batches of {args.batch_size} patches")
+    batch_size = ds[0].batch_size if len(ds) > 0 else args.batch_size  # aligned to the chunks of the (first) slide
+    logger.info(f"Loaded dataset with {len(ds)} slides, will process in batches of {batch_size} patches")
 
-    model = load_feature_extractor(args.model)
+    models = [load_feature_extractor(model_name) for model_name in args.models]
     augmentations = load_augmentations(args.augs)
+    for aug in augmentations.values():
+        if isinstance(aug, MacenkoSlidewise):
+            aug.stain_cache = SlideStainCache(args.stain_cache or args.output / "macenko_stains.json")
     logger.info(f"Using augmentations: {', '.join(sorted(augmentations.keys()))}")
 
-    logger.info(f"Processing dataset, saving features to {output_folder}")
-    process_dataset(ds, model, augmentations, output_folder, device=args.device, num_workers=8)
+    logger.info(f"Processing dataset, saving features to {args.output}/{{{','.join(args.models)}}}")
+    slides, on_slide_done = ds, None
+    if args.queue is not None:
+        queue_dir = work_queue_dir(args.queue, args.models, augmentations.keys())
+        queue = WorkQueue(queue_dir, keys=[slide.stem for slide in ds.slides])
+        logger.info(f"Using work queue {queue_dir} ({queue.summary()})")
+        slides = (ds[index] for index in queue.claims())
+        on_slide_done = lambda slide: queue.release(slide.name, done=True)
+
+    process_dataset(
+        slides,
+        models,
+        augmentations,
+        args.output,
+        device=args.device,
+        num_workers=8,
+        micro_batch_size=args.micro_batch_size,
+        on_slide_done=on_slide_done,
+        encoding=args.encoding,
+        chunk_size=args.chunk_size,
+        compressor=args.compressor,
+    )
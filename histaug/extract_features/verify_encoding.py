@@ -0,0 +1,82 @@
+from pathlib import Path
+from typing import Sequence, Iterator, Tuple
+import numpy as np
+import pandas as pd
+import zarr
+from loguru import logger
+
+from ..utils.saving import FEATURE_ENCODINGS, encode_features, decode_features
+
+
+def cosine_error(reference: np.ndarray, approximation: np.ndarray) -> np.ndarray:
+    """1 - cosine similarity between corresponding rows of two arrays."""
+    dot = (reference * approximation).sum(axis=-1)
+    norms = np.linalg.norm(reference, axis=-1) * np.linalg.norm(approximation, axis=-1)
+    return 1 - dot / np.maximum(norms, np.finfo(np.float32).tiny)
+
+
+def _iter_feature_arrays(files: Sequence[Path], max_rows: int) -> Iterator[Tuple[str, np.ndarray]]:
+    for file in files:
+        f = zarr.open_group(str(file), mode="r")
+        arrays = [("feats", f["feats"])] + [(f"feats_augs/{k}", v) for k, v in f["feats_augs"].arrays()]
+        if "feats_norm" in f:
+            arrays.append(("feats_norm", f["feats_norm"]))
+        for name, array in arrays:
+            assert array.attrs.get("encoding", "float32") == "float32", f"{file}/{name} is not stored as float32"
+            yield name, array[:max_rows]
+
+
+def verify_encodings(
+    files: Sequence[Path], encodings: Sequence[str] = FEATURE_ENCODINGS, max_rows: int = 4096
+) -> pd.DataFrame:
+    """Measure the error of storing float32 features with each encoding.
+
+    Each feature array (of each file) is encoded and decoded on its own, like save_features() and FeatureWriter do.
+
+    Args:
+        files (Sequence[Path]): Feature files (zarr) stored as float32.
+        encodings (Sequence[str], optional): Encodings to compare. Defaults to FEATURE_ENCODINGS.
+        max_rows (int, optional): Maximum number of rows to read from each array. Defaults to 4096.
+
+    Returns:
+        pd.DataFrame: Bytes per value and cosine error statistics (mean, 99th percentile, max) per encoding.
+    """
+    errors = {encoding: [] for encoding in encodings}
+    bytes_per_value = dict()
+    for name, feats in _iter_feature_arrays(files, max_rows):
+        for encoding in encodings:
+            encoded, attrs = encode_features(feats, encoding)
+            errors[encoding].append(cosine_error(feats, decode_features(encoded, attrs)))
+            bytes_per_value[encoding] = encoded.dtype.itemsize
+    rows = []
+    for encoding, encoding_errors in errors.items():
+        encoding_errors = np.concatenate(encoding_errors)
+        rows.append(
+            dict(
+                encoding=encoding,
+                bytes_per_value=bytes_per_value[encoding],
+                mean_cosine_error=encoding_errors.mean(),
+                p99_cosine_error=np.percentile(encoding_errors, 99),
+                max_cosine_error=encoding_errors.max(),
+            )
+        )
+    return pd.DataFrame(rows).set_index("encoding")
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description="Report the cosine error of storing features in each encoding, relative to float32"
+    )
+    parser.add_argument("features", type=Path, nargs="+", help="Feature files (zarr) or directories containing them")
+    parser.add_argument("--encodings", nargs="+", choices=FEATURE_ENCODINGS, default=list(FEATURE_ENCODINGS))
+    parser.add_argument("--max-files", type=int, default=16, help="Maximum number of feature files to read")
+    parser.add_argument("--max-rows", type=int, default=4096, help="Maximum number of rows to read per array")
+    args = parser.parse_args()
+
+    files = [file for path in args.features for file in (sorted(path.glob("*.zarr")) if path.is_dir() else [path])]
+    files = files[: args.max_files]
+    logger.info(f"Comparing encodings on {len(files)} feature files")
+    with pd.option_context("display.float_format", "{:.2e}".format, "display.max_columns", None, "display.width", 200):
+        print(verify_encodings(files, args.encodings, max_rows=args.max_rows))
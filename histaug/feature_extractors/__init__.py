@@ -19,7 +19,7 @@ from .retccl import RetCCL
 from .owkin import Owkin
 from .lunit import resnet50 as lunit_resnet50, vit_small as lunit_vit_small
 from .uni import UNI
-from ..utils.images import IMAGENET_MEAN, IMAGENET_STD, LUNIT_MEAN, LUNIT_STD
+from ..utils.images import IMAGENET_MEAN, IMAGENET_STD, LUNIT_MEAN, LUNIT_STD, to_float_patches
 
 __all__ = [
     "load_feature_extractor",
@@ -103,7 +103,9 @@ class FeatureExtractor(nn.Module):
         self.name = name or model.__class__.__name__
 
     def forward(self, x):
-        return self.model(self.transform(x))
+        """Extract features from patches given either as floats of shape [N, C, H, W] in [0, 1], or in the stored
+        format as uint8 of shape [N, H, W, C] (which are converted on the device of x)."""
+        return self.model(self.transform(to_float_patches(x)))
 
 
 _imagenet_transform = T.Normalize(mean=IMAGENET_MEAN, std=IMAGENET_STD)
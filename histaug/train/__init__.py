@@ -16,6 +16,9 @@ from textwrap import indent
 from loguru import logger
 import numpy as np
 import functools
+import tempfile
+import json
+import time
 
 os.environ["HYDRA_FULL_ERROR"] = "1"
 
@@ -26,7 +29,8 @@ from .utils import (
     flatten_batched_dicts,
     make_preds_df,
 )
-from ..data import FeatureDataset, CachedFeatureDataset
+from ..data import FeatureDataset, CachedFeatureDataset, LengthBucketedBatchSampler
+from .cache import BackgroundEpochCache
 from .targets import TargetEncoder
 from .metrics import create_metrics_for_target
 from .utils import summarize_dataset
@@ -102,6 +106,8 @@ class LitMilTransformer(pl.LightningModule):
         loss = sum(losses.values())
 
         if step_name:
+            # Number of bags; Lightning would infer the number of instances from packed feats ([sum(N_i), D])
+            batch_size = len(next(iter(targets.values())))
             self.log(
                 f"{step_name}/loss",
                 loss,
@@ -109,12 +115,14 @@ class LitMilTransformer(pl.LightningModule):
                 on_epoch=True,
                 prog_bar=True,
                 sync_dist=True,
+                batch_size=batch_size,
             )
             self.log_dict(
                 {f"{step_name}/loss/{column}": l for column, l in losses.items()},
                 on_step=False,
                 on_epoch=True,
                 sync_dist=True,
+                batch_size=batch_size,
             )
 
             # Update target-wise metrics
@@ -127,6 +135,7 @@ class LitMilTransformer(pl.LightningModule):
                     on_step=False,
                     on_epoch=True,
                     sync_dist=True,
+                    batch_size=batch_size,
                 )
 
         return loss
@@ -194,6 +203,22 @@ class UpdateEpochInDatasetCallback(Callback):
             # logger.debug(f"Updated epoch in dataset to {self.dataset.epoch}")
 
 
+class WaitForEpochCacheCallback(Callback):
+    def __init__(self, background_cache: BackgroundEpochCache) -> None:
+        super().__init__()
+        self.background_cache = background_cache
+
+    def on_train_epoch_start(self, trainer: pl.Trainer, model: LitMilTransformer) -> None:
+        self.background_cache.wait_for(model.current_epoch)
+
+
+def train_batch_size(cfg: DictConfig) -> int:
+    """Number of bags per training batch; with a padded-token budget, that of a batch of full bags."""
+    if max_tokens := cfg.dataset.get("max_tokens_per_batch", None):
+        return max(1, max_tokens // cfg.dataset.instances_per_bag)
+    return cfg.dataset.batch_size
+
+
 def make_trainer(
     cfg: DictConfig,
     dummy_batch: torch.Tensor,
@@ -255,7 +280,7 @@ def make_trainer(
         accelerator="gpu",
         devices=cfg.device or 1,
         accumulate_grad_batches=(
-            cfg.accumulate_grad_samples // cfg.dataset.batch_size if cfg.accumulate_grad_samples else 1
+            max(1, cfg.accumulate_grad_samples // train_batch_size(cfg)) if cfg.accumulate_grad_samples else 1
         ),
         gradient_clip_val=cfg.grad_clip,
         logger=[CSVLogger(save_dir=out_dir), wandb_logger],
@@ -316,6 +341,7 @@ def train_fold(
     crossval_fold: Optional[int] = None,
     run_prefix: str = "",
 ):
+    start_time = time.time()
     logger.info(
         f"Using fold {crossval_fold} for validation, contains {(folds == crossval_fold).mean()*100:.1f}% of patients"
     )
@@ -338,13 +364,44 @@ def train_fold(
     train_targets = {t: encoder.fit(train_df) for t, encoder in encoders.items()}
     valid_targets = {t: encoder(valid_df) for t, encoder in encoders.items()}
 
+    max_tokens_per_batch = cfg.dataset.get("max_tokens_per_batch", None)
+    background_cache = None
     if cfg.dataset.cache_dir and (dataset_cache_dir := Path(cfg.dataset.cache_dir)).exists():
-        assert cfg.dataset.batch_size == 1, "batch_size must be 1 when using cached dataset"
+        assert (
+            cfg.dataset.batch_size == 1 or max_tokens_per_batch
+        ), "batch_size must be 1 when using cached dataset; set max_tokens_per_batch to batch bags of similar length"
         logger.info(f"Using cached dataset from {dataset_cache_dir}")
         train_ds = CachedFeatureDataset(
             patient_ids=train_df.index,
             targets=train_targets,
             cache_dir=dataset_cache_dir,
+            backend=cfg.dataset.get("backend", "zarr"),
+        )
+    elif cfg.dataset.get("background_cache", False):
+        assert (
+            cfg.dataset.batch_size == 1 or max_tokens_per_batch
+        ), "batch_size must be 1 when using cached dataset; set max_tokens_per_batch to batch bags of similar length"
+        background_cache = BackgroundEpochCache(
+            FeatureDataset(
+                patient_ids=train_df.index,
+                bags=train_df.path.values,
+                targets=None,
+                instances_per_bag=cfg.dataset.instances_per_bag,
+                augmentations=cfg.dataset.augmentations.train,
+                backend=cfg.dataset.get("backend", "zarr"),
+            ),
+            cache_dir=tempfile.mkdtemp(prefix="histaug-epoch-cache-"),
+            max_epochs=cfg.max_epochs,
+            epochs_ahead=cfg.dataset.get("cache_epochs_ahead", 2),
+            seed=torch.initial_seed() % 2**31,
+        )
+        logger.info(f"Generating the cached dataset in the background in {background_cache.cache_dir}")
+        background_cache.wait_for(0)  # the first epoch is needed for the dummy batch
+        train_ds = CachedFeatureDataset(
+            patient_ids=train_df.index,
+            targets=train_targets,
+            cache_dir=background_cache.cache_dir,
+            backend=cfg.dataset.get("backend", "zarr"),
         )
     else:
         logger.info(f"Not using cached dataset; empty {cfg.dataset.cache_dir} directory")
@@ -354,15 +411,34 @@ def train_fold(
             targets=train_targets,
             instances_per_bag=cfg.dataset.instances_per_bag,
             augmentations=cfg.dataset.augmentations.train,
+            backend=cfg.dataset.get("backend", "zarr"),
+        )
+    if max_tokens_per_batch:
+        # Batches of bags of similar length, so that they are padded as little as possible
+        train_sampler = LengthBucketedBatchSampler(
+            train_ds.bag_lengths(),
+            max_tokens=max_tokens_per_batch,
+            bucket_size=cfg.dataset.get("bucket_size", 64),
+        )
+        logger.info(
+            f"Batching {len(train_ds)} bags into {len(train_sampler)} batches of at most {max_tokens_per_batch} instances"
+        )
+        train_dl = DataLoader(
+            train_ds,
+            batch_sampler=train_sampler,
+            num_workers=cfg.dataset.num_workers,
+            pin_memory=True,
+            collate_fn=train_ds.collate_packed if cfg.dataset.get("packed", False) else train_ds.collate_fn,
+        )
+    else:
+        train_dl = DataLoader(
+            train_ds,
+            batch_size=cfg.dataset.batch_size,
+            num_workers=cfg.dataset.num_workers,
+            shuffle=True,
+            pin_memory=True,
+            collate_fn=train_ds.collate_packed if cfg.dataset.get("packed", False) else train_ds.collate_fn,
         )
-    train_dl = DataLoader(
-        train_ds,
-        batch_size=cfg.dataset.batch_size,
-        num_workers=cfg.dataset.num_workers,
-        shuffle=True,
-        pin_memory=True,
-        collate_fn=train_ds.collate_fn,
-    )
 
     valid_ds = FeatureDataset(
         patient_ids=valid_df.index,
@@ -370,13 +446,14 @@ def train_fold(
         targets=valid_targets,
         instances_per_bag=cfg.dataset.instances_per_bag,
         augmentations=cfg.dataset.augmentations.val,
+        backend=cfg.dataset.get("backend", "zarr"),
     )
     valid_dl = DataLoader(
         valid_ds,
         batch_size=cfg.dataset.batch_size,
         num_workers=cfg.dataset.num_workers,
         pin_memory=True,
-        collate_fn=valid_ds.collate_fn,
+        collate_fn=valid_ds.collate_packed if cfg.dataset.get("packed", False) else valid_ds.collate_fn,
     )
 
     model_checkpoint_callback = ModelCheckpoint(
@@ -388,11 +465,15 @@ def train_fold(
 
     model, trainer, out_dir, wandb_logger = make_trainer(
         cfg,
-        dummy_batch=train_ds.dummy_batch(cfg.dataset.batch_size),
+        dummy_batch=train_ds.dummy_batch(train_batch_size(cfg), packed=cfg.dataset.get("packed", False)),
         crossval_fold=crossval_fold,
         crossval_id=crossval_id,
         run_prefix=run_prefix,
-        callbacks=[model_checkpoint_callback, UpdateEpochInDatasetCallback(train_ds)],
+        callbacks=[
+            model_checkpoint_callback,
+            UpdateEpochInDatasetCallback(train_ds),
+            *([WaitForEpochCacheCallback(background_cache)] if background_cache is not None else []),
+        ],
     )
     print(model)
 
@@ -401,7 +482,11 @@ def train_fold(
         tuner.lr_find(model=model, train_dataloaders=train_dl, val_dataloaders=valid_dl)
         logger.info(f"Best learning rate: {model.learning_rate}")
 
-    trainer.fit(model=model, train_dataloaders=train_dl, val_dataloaders=valid_dl)
+    try:
+        trainer.fit(model=model, train_dataloaders=train_dl, val_dataloaders=valid_dl)
+    finally:
+        if background_cache is not None:
+            background_cache.close()
 
     torch.save(model_checkpoint_callback.state_dict(), out_dir / "checkpoints.pth")
 
@@ -420,6 +505,18 @@ def train_fold(
     if cfg.test.enabled:
         test(cfg, model, trainer, encoders, out_dir)
 
+    # Record the finished run, so that it can be found without wandb (see histaug.analysis.results_index)
+    with (out_dir / "run.json").open("w") as f:
+        json.dump(
+            dict(
+                wandb_id=wandb_logger.experiment.id,
+                overrides=" ".join(sys.argv[1:]),
+                runtime=time.time() - start_time,
+                config=OmegaConf.to_container(cfg, resolve=True),
+            ),
+            f,
+        )
+
     wandb_logger.experiment.finish()
 
     return model, trainer, out_dir, wandb_logger
@@ -440,13 +537,14 @@ def test(
         targets=test_targets,
         instances_per_bag=cfg.dataset.instances_per_bag,
         augmentations=cfg.dataset.augmentations.test,
+        backend=cfg.test.dataset.get("backend", "zarr"),
     )
     test_dl = DataLoader(
         test_ds,
         batch_size=cfg.dataset.batch_size,
         num_workers=cfg.dataset.num_workers,
         pin_memory=True,
-        collate_fn=test_ds.collate_fn,
+        collate_fn=test_ds.collate_packed if cfg.dataset.get("packed", False) else test_ds.collate_fn,
     )
 
     trainer.test(model=model, dataloaders=test_dl)
@@ -1,18 +1,108 @@
 import hydra
 from pathlib import Path
 from omegaconf import DictConfig
-from torch.utils.data import DataLoader
 from tqdm import tqdm
 import pytorch_lightning as pl
-from typing import Sequence
-import zarr
+from typing import Sequence, Union
+import multiprocessing as mp
 import shutil
+import time
+import os
+import json
+import numpy as np
 
 import histaug
 from .utils import make_dataset_df, pathlist
 from ..data import FeatureDataset
 
 
+def write_epoch(ds: FeatureDataset, epoch_cache_dir: Path, epoch: int, progress: bool = True):
+    """Sample the bags of all patients for one epoch and cache their (slide_index, patch_index, augmentation_index)
+    triples in epoch_cache_dir, packed into a single array with an index of each patient's offset and length (see
+    CachedFeatureDataset). The epoch is written to a temporary directory first, so it only appears once complete.
+    """
+    tmp_dir = epoch_cache_dir.with_name(f".{epoch_cache_dir.name}.tmp")
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    tmp_dir.mkdir(parents=True)
+    patients = dict()
+    indices = []
+    offset = 0
+    for index, patient_id in enumerate(
+        tqdm(ds.patient_ids, desc="Patients", position=1, leave=False, disable=not progress)
+    ):
+        indices.append(ds.sample_indices(index).astype(np.int32))
+        slides = [str(slide.absolute()) for slide in ds.slides[index]]
+        patients[str(patient_id)] = dict(offset=offset, length=len(indices[-1]), slides=slides)
+        offset += len(indices[-1])
+    np.save(tmp_dir / "indices.npy", np.concatenate(indices) if indices else np.empty((0, 3), dtype=np.int32))
+    with (tmp_dir / "index.json").open("w") as f:
+        json.dump(dict(epoch=epoch, augmentations=list(ds.augmentations), patients=patients), f)
+    shutil.rmtree(epoch_cache_dir, ignore_errors=True)
+    os.rename(tmp_dir, epoch_cache_dir)
+
+
+def _produce_epochs(ds: FeatureDataset, cache_dir: Path, max_epochs: int, epochs_ahead: int, consumed_epoch, seed: int):
+    for epoch in range(max_epochs):
+        while epoch - consumed_epoch.value >= epochs_ahead:
+            time.sleep(0.5)
+        for old_epoch_cache_dir in cache_dir.glob("epoch_*"):
+            if int(old_epoch_cache_dir.name[len("epoch_") :]) < consumed_epoch.value:
+                shutil.rmtree(old_epoch_cache_dir, ignore_errors=True)
+        np.random.seed(seed + epoch)
+        write_epoch(ds, cache_dir / f"epoch_{epoch:03d}", epoch, progress=False)
+
+
+class BackgroundEpochCache:
+    """Generates the epoch cache (see main()) in a background process while the model is being trained.
+
+    The producer runs at most epochs_ahead epochs ahead of the trainer, and deletes the epochs that the trainer has
+    finished with, so only a bounded number of epochs is on disk at any time. The trainer must call wait_for(epoch)
+    at the start of each epoch (see WaitForEpochCacheCallback).
+
+    Args:
+        ds (FeatureDataset): Dataset to sample the bags from.
+        cache_dir (Union[str, Path]): Directory to write the epochs to (which is deleted by close()).
+        max_epochs (int): Number of epochs to generate.
+        epochs_ahead (int, optional): Maximum number of epochs on disk. Defaults to 2.
+        seed (int, optional): Random seed; epoch i is sampled with seed + i. Defaults to 0.
+    """
+
+    def __init__(
+        self,
+        ds: FeatureDataset,
+        cache_dir: Union[str, Path],
+        max_epochs: int,
+        epochs_ahead: int = 2,
+        seed: int = 0,
+    ):
+        assert epochs_ahead >= 1, "the producer must be able to write at least the current epoch"
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.max_epochs = max_epochs
+        self._consumed_epoch = mp.Value("i", 0)
+        self._process = mp.Process(
+            target=_produce_epochs,
+            args=(ds, self.cache_dir, max_epochs, epochs_ahead, self._consumed_epoch, seed),
+            daemon=True,
+        )
+        self._process.start()
+
+    def wait_for(self, epoch: int, poll_interval: float = 0.5):
+        """Mark the previous epochs as consumed, and block until the given epoch has been written."""
+        assert epoch < self.max_epochs, f"only {self.max_epochs} epochs are generated"
+        self._consumed_epoch.value = epoch
+        while not (self.cache_dir / f"epoch_{epoch:03d}").exists():
+            if not self._process.is_alive():
+                raise RuntimeError(f"epoch cache producer exited with code {self._process.exitcode}")
+            time.sleep(poll_interval)
+
+    def close(self):
+        if self._process.is_alive():
+            self._process.terminate()
+        self._process.join()
+        shutil.rmtree(self.cache_dir, ignore_errors=True)
+
+
 @hydra.main(config_path=str(Path(histaug.__file__).parent.with_name("conf")), config_name="config", version_base="1.3")
 def main(cfg: DictConfig):
     pl.seed_everything(42)
@@ -31,29 +121,14 @@ def main(cfg: DictConfig):
         targets=None,
         instances_per_bag=cfg.dataset.instances_per_bag,
         augmentations=augmentations,
-    )
-    loader = DataLoader(
-        ds,
-        batch_size=None,
-        num_workers=cfg.dataset.num_workers,
-        pin_memory=False,
-        shuffle=False,
+        backend=cfg.dataset.get("backend", "zarr"),
     )
     cache_dir = Path(cfg.dataset.cache_dir)
     shutil.rmtree(cache_dir, ignore_errors=True)
 
+    # Only the sampled (slide_index, patch_index, augmentation_index) triples are cached, not the features themselves
     for epoch in tqdm(range(cfg.max_epochs), desc="Epochs", position=0):
-        epoch_cache_dir = cache_dir / f"epoch_{epoch:03d}"
-        epoch_cache_dir.mkdir(parents=True, exist_ok=True)
-        for feats, coords, _, patient_id in tqdm(loader, desc="Batches", position=1):
-            batch_cache_file = epoch_cache_dir / f"{patient_id}.zarr"
-            batch_cache_file.parent.mkdir(parents=True, exist_ok=True)
-            f = zarr.open(str(batch_cache_file), mode="w")
-            f.attrs["patient_id"] = patient_id
-            f.attrs["epoch"] = epoch
-            f.attrs["augmentations"] = sorted(augmentations)
-            f.create_dataset("feats", data=feats.numpy(), chunks=-1)
-            f.create_dataset("coords", data=coords.numpy(), chunks=-1)
+        write_epoch(ds, cache_dir / f"epoch_{epoch:03d}", epoch)
 
 
 if __name__ == "__main__":
@@ -3,11 +3,30 @@ from torch import nn
 from omegaconf import ListConfig
 from typing import Optional
 import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
+
+from .segment import is_packed, segment_ids, segment_softmax, segment_sum
 
 
 class AttentionMIL(nn.Module):
-    def __init__(self, targets: ListConfig, d_features: int, hidden_dim: Optional[int] = 256, batchnorm: bool = True):
+    def __init__(
+        self,
+        targets: ListConfig,
+        d_features: int,
+        hidden_dim: Optional[int] = 256,
+        batchnorm: bool = True,
+        chunk_size: Optional[int] = None,
+    ):
+        """Attention-based MIL pooling (Ilse et al., 2018).
+
+        Args:
+            chunk_size (Optional[int], optional): If given, the instances are encoded and pooled in chunks of this many
+                instances, combined with an online softmax, and the activations of each chunk are recomputed during the
+                backward pass instead of being stored. The activation memory then no longer depends on the number of
+                instances per bag. Defaults to None (all instances at once).
+        """
         super().__init__()
+        self.chunk_size = chunk_size
         self.encoder = nn.Sequential(nn.Linear(d_features, hidden_dim), nn.ReLU())
         self.attention = nn.Sequential(nn.Linear(hidden_dim, hidden_dim // 2), nn.Tanh(), nn.Linear(hidden_dim // 2, 1))
         self.pre_head = nn.Sequential(nn.BatchNorm1d(hidden_dim), nn.Dropout()) if batchnorm else nn.Dropout()
@@ -23,12 +42,82 @@ class AttentionMIL(nn.Module):
         self.targets = targets
 
     def forward(self, feats, coords, mask, *args, **kwargs):
+        if self.chunk_size:
+            return self._heads(self._chunked_pool(feats, mask))
+
+        if is_packed(feats):  # mask holds the offsets of the bags (see FeatureDataset.collate_packed)
+            embeddings = self.encoder(feats)  # sum(N_i), D
+            attention = segment_softmax(self.attention(embeddings).squeeze(-1), mask)  # sum(N_i)
+            slide_tokens = segment_sum(embeddings * attention.unsqueeze(-1), mask)  # B, D
+            return self._heads(slide_tokens)
+
         embeddings = self.encoder(feats)  # B, N, D
         attention = self.attention(embeddings).squeeze(-1)  # B, N
         attention = torch.masked_fill(attention, ~mask, -torch.inf)  # B, N
         attention = F.softmax(attention, dim=-1)  # B, N
         embeddings = embeddings * attention.unsqueeze(-1)  # B, N, D
         slide_tokens = embeddings.sum(dim=-2)  # B, D
+        return self._heads(slide_tokens)
+
+    def _pool_chunk(self, feats, mask_or_ids, num_bags: int):
+        """Attention pooling of a chunk of instances, without normalizing the attention.
+
+        Returns:
+            Tuple[torch.Tensor, torch.Tensor, torch.Tensor]: For each bag, the maximum attention score in the chunk [B],
+                and the sum of the attention weights [B] and of the weighted embeddings [B, D] relative to it.
+        """
+        embeddings = self.encoder(feats)
+        attention = self.attention(embeddings).squeeze(-1)
+        lowest = torch.finfo(attention.dtype).min  # instead of -inf, so that chunks of only padding give weights of 0
+        if is_packed(feats):  # mask_or_ids holds the bag index of each instance
+            max_attention = attention.new_full((num_bags,), lowest)
+            max_attention = max_attention.scatter_reduce(0, mask_or_ids, attention.detach(), reduce="amax")
+            weights = torch.exp(attention - max_attention[mask_or_ids])  # C
+            weight_sums = weights.new_zeros(num_bags).index_add(0, mask_or_ids, weights)
+            weighted_sums = embeddings.new_zeros((num_bags, embeddings.shape[-1]))
+            weighted_sums = weighted_sums.index_add(0, mask_or_ids, embeddings * weights.unsqueeze(-1))
+            return max_attention, weight_sums, weighted_sums
+        attention = torch.masked_fill(attention, ~mask_or_ids, -torch.inf)  # B, C
+        max_attention = attention.detach().amax(dim=-1).clamp(min=lowest)  # B
+        weights = torch.exp(attention - max_attention.unsqueeze(-1))  # B, C
+        return max_attention, weights.sum(dim=-1), (embeddings * weights.unsqueeze(-1)).sum(dim=-2)
+
+    def _chunked_pool(self, feats, mask):
+        if is_packed(feats):  # mask holds the offsets of the bags
+            num_bags = len(mask) - 1
+            ids = segment_ids(mask, len(feats))
+            chunks = [
+                (feats[i : i + self.chunk_size], ids[i : i + self.chunk_size])
+                for i in range(0, len(feats), self.chunk_size)
+            ]
+        else:
+            num_bags = len(feats)
+            chunks = [
+                (feats[:, i : i + self.chunk_size], mask[:, i : i + self.chunk_size])
+                for i in range(0, feats.shape[1], self.chunk_size)
+            ]
+
+        # Online softmax: rescale the running sums whenever a chunk has a higher maximum attention score
+        max_attention, weight_sum, weighted_sum = None, None, None
+        for chunk_feats, chunk_mask_or_ids in chunks:
+            if torch.is_grad_enabled():
+                chunk = checkpoint(self._pool_chunk, chunk_feats, chunk_mask_or_ids, num_bags, use_reentrant=False)
+            else:
+                chunk = self._pool_chunk(chunk_feats, chunk_mask_or_ids, num_bags)
+            if max_attention is None:
+                max_attention, weight_sum, weighted_sum = chunk
+                continue
+            chunk_max_attention, chunk_weight_sum, chunk_weighted_sum = chunk
+            new_max_attention = torch.maximum(max_attention, chunk_max_attention)
+            scale, chunk_scale = torch.exp(max_attention - new_max_attention), torch.exp(
+                chunk_max_attention - new_max_attention
+            )
+            weight_sum = weight_sum * scale + chunk_weight_sum * chunk_scale
+            weighted_sum = weighted_sum * scale.unsqueeze(-1) + chunk_weighted_sum * chunk_scale.unsqueeze(-1)
+            max_attention = new_max_attention
+        return weighted_sum / weight_sum.clamp(min=torch.finfo(weight_sum.dtype).tiny).unsqueeze(-1)  # B, D
+
+    def _heads(self, slide_tokens):
         slide_tokens = self.pre_head(slide_tokens)  # B, D
 
         # Apply the corresponding head to each slide-level token
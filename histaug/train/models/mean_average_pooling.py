@@ -2,6 +2,8 @@ from torch import nn
 from omegaconf import ListConfig
 from typing import Optional
 
+from .segment import is_packed, segment_mean
+
 
 class MeanAveragePooling(nn.Module):
     def __init__(self, targets: ListConfig, d_features: int, hidden_dim: Optional[int] = None):
@@ -20,9 +22,14 @@ class MeanAveragePooling(nn.Module):
         )
         self.targets = targets
 
-    def forward(self, feats, *args, **kwargs):
+    def forward(self, feats, coords=None, mask=None, *args, **kwargs):
         embeddings = self.encoder(feats)
-        slide_tokens = embeddings.mean(dim=-2)
+        if is_packed(feats):  # mask holds the offsets of the bags (see FeatureDataset.collate_packed)
+            slide_tokens = segment_mean(embeddings, mask)
+        elif mask is not None:
+            slide_tokens = (embeddings * mask.unsqueeze(-1)).sum(dim=-2) / mask.sum(dim=-1, keepdim=True).clamp(min=1)
+        else:
+            slide_tokens = embeddings.mean(dim=-2)
         slide_tokens = self.pre_head(slide_tokens)
 
         # Apply the corresponding head to each slide-level token
@@ -0,0 +1,40 @@
+"""Operations on packed bags: the instances of all bags of a batch concatenated into one [sum(N_i), ...] tensor, with
+offsets [B + 1] such that the instances of bag i are x[offsets[i] : offsets[i + 1]] (see FeatureDataset.collate_packed).
+"""
+
+import torch
+
+__all__ = ["is_packed", "segment_ids", "segment_sum", "segment_mean", "segment_softmax"]
+
+
+def is_packed(feats: torch.Tensor) -> bool:
+    """Whether a batch of features is packed ([sum(N_i), D]) rather than padded ([B, N, D])."""
+    return feats.dim() == 2
+
+
+def segment_ids(offsets: torch.Tensor, num_instances: int) -> torch.Tensor:
+    """Index of the bag of each instance, of shape [sum(N_i)]."""
+    return torch.repeat_interleave(
+        torch.arange(len(offsets) - 1, device=offsets.device), offsets.diff(), output_size=num_instances
+    )
+
+
+def segment_sum(x: torch.Tensor, offsets: torch.Tensor) -> torch.Tensor:
+    """Sum of the instances of each bag: [sum(N_i), ...] -> [B, ...]"""
+    out = x.new_zeros((len(offsets) - 1, *x.shape[1:]))
+    return out.index_add(0, segment_ids(offsets, len(x)), x)
+
+
+def segment_mean(x: torch.Tensor, offsets: torch.Tensor) -> torch.Tensor:
+    """Mean of the instances of each bag: [sum(N_i), ...] -> [B, ...]"""
+    lengths = offsets.diff().clamp(min=1).to(x.dtype)
+    return segment_sum(x, offsets) / lengths.view(-1, *([1] * (x.dim() - 1)))
+
+
+def segment_softmax(scores: torch.Tensor, offsets: torch.Tensor) -> torch.Tensor:
+    """Softmax over the instances of each bag: [sum(N_i)] -> [sum(N_i)]"""
+    ids = segment_ids(offsets, len(scores))
+    max_scores = scores.new_full((len(offsets) - 1,), -torch.inf)
+    max_scores = max_scores.scatter_reduce(0, ids, scores.detach(), reduce="amax")
+    exp = torch.exp(scores - max_scores[ids])
+    return exp / exp.new_zeros(len(offsets) - 1).index_add(0, ids, exp)[ids]
@@ -1,8 +1,11 @@
+import torch
 from torch import nn
 from omegaconf import ListConfig
 from typing import Optional
 import torch.nn.functional as F
 
+from .segment import is_packed
+
 
 class Transformer(nn.Module):
     def __init__(
@@ -14,8 +17,19 @@ class Transformer(nn.Module):
         num_heads: int = 8,
         num_layers: int = 2,
         feedforward_dim: Optional[int] = None,
+        attention_window: Optional[int] = None,
     ):
+        """Transformer over the instances of a bag, followed by a (masked) mean pool.
+
+        Args:
+            attention_window (Optional[int], optional): If given, each instance only attends to the instances in its
+                window: the instances are ordered along a z-order curve of their coordinates (so that nearby tiles are
+                close in the order) and split into windows of this many instances. The memory needed for attention then
+                grows linearly rather than quadratically with the number of instances. Defaults to None (global
+                attention).
+        """
         super().__init__()
+        self.attention_window = attention_window
         feedforward_dim = feedforward_dim or hidden_dim
         self.encoder = nn.Sequential(nn.Linear(d_features, hidden_dim), nn.ReLU())
         self.transformer = nn.TransformerEncoder(
@@ -44,11 +58,61 @@ class Transformer(nn.Module):
         self.dropout = nn.Dropout(dropout)
 
     def forward(self, feats, coords, mask, *args, **kwargs):
+        assert not is_packed(feats), "the Transformer needs padded bags; set dataset.packed=false"
         embeddings = self.encoder(feats)  # B, N, D
         embeddings = self.dropout(embeddings)
-        embeddings = self.transformer(embeddings)  # B, N, D
-        slide_tokens = embeddings.mean(dim=-2)  # B, D
+        if self.attention_window:
+            embeddings, mask = to_windows(embeddings, coords, mask, self.attention_window)  # B * N / W, W, D
+        # Padded instances are masked out as keys. Sequences (or windows) that only contain padding would attend to
+        # nothing and give NaNs, so they attend to their first instance instead, which the mean pool ignores anyway
+        padding_mask = ~mask
+        padding_mask[:, 0] &= mask.any(dim=-1)
+        embeddings = self.transformer(embeddings, src_key_padding_mask=padding_mask)  # B, N, D
+        slide_tokens = masked_mean(
+            embeddings.reshape(len(feats), -1, embeddings.shape[-1]), mask.reshape(len(feats), -1)
+        )
 
         # Apply the corresponding head to each slide-level token
         logits = {target.column: self.heads[target.column](slide_tokens).squeeze(-1) for target in self.targets}
         return logits
+
+
+def masked_mean(x: torch.Tensor, mask: torch.Tensor) -> torch.Tensor:
+    """Mean over the instances of each bag ([B, N, D] -> [B, D]), ignoring the padded ones"""
+    return (x * mask.unsqueeze(-1)).sum(dim=-2) / mask.sum(dim=-1, keepdim=True).clamp(min=1)
+
+
+def _spread_bits(x: torch.Tensor) -> torch.Tensor:
+    """Insert a zero bit between each of the lower 32 bits of x"""
+    x = (x | (x << 16)) & 0x0000FFFF0000FFFF
+    x = (x | (x << 8)) & 0x00FF00FF00FF00FF
+    x = (x | (x << 4)) & 0x0F0F0F0F0F0F0F0F
+    x = (x | (x << 2)) & 0x3333333333333333
+    x = (x | (x << 1)) & 0x5555555555555555
+    return x
+
+
+def z_order(coords: torch.Tensor, mask: torch.Tensor) -> torch.Tensor:
+    """Order of the instances of each bag along a z-order curve of their coordinates, padded instances last ([B, N])"""
+    coords = coords.long()
+    coords = coords - torch.where(mask.unsqueeze(-1), coords, coords.max()).amin(dim=-2, keepdim=True)
+    codes = _spread_bits(coords[..., 0].clamp(0, 2**31 - 1)) | (_spread_bits(coords[..., 1].clamp(0, 2**31 - 1)) << 1)
+    codes = torch.where(mask, codes, torch.iinfo(torch.long).max)
+    return codes.argsort(dim=-1)
+
+
+def to_windows(x: torch.Tensor, coords: torch.Tensor, mask: torch.Tensor, window: int):
+    """Split the instances of each bag into windows of spatially close instances.
+
+    Returns:
+        Tuple[torch.Tensor, torch.Tensor]: The instances and mask, of shape [B * N / window, window, D] and
+            [B * N / window, window] (N is padded to a multiple of window). The instances are reordered within each bag.
+    """
+    B, N, D = x.shape
+    order = z_order(coords, mask)
+    x = x.gather(1, order.unsqueeze(-1).expand(-1, -1, D))
+    mask = mask.gather(1, order)
+    num_padded = -N % window
+    x = nn.functional.pad(x, (0, 0, 0, num_padded)).reshape(-1, window, D)
+    mask = nn.functional.pad(mask, (0, num_padded)).reshape(-1, window)
+    return x, mask
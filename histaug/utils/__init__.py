@@ -1,4 +1,4 @@
-from .saving import save_features, load_features, LoadedFeatures, check_version
+from .saving import save_features, load_features, LoadedFeatures, check_version, FeatureWriter
 from .statistics import RunningStats
-from .caching import cached_df
+from .caching import cached_df, hash_df
 from .figures import savefig, rcparams, rc_context
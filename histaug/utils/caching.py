@@ -1,13 +1,102 @@
 import pandas as pd
 import functools
+import hashlib
+import os
+from collections import OrderedDict
 from pathlib import Path
 import json
-from typing import Union
+from typing import Callable, Optional, Tuple, Union
 from loguru import logger
 
+__all__ = ["cached_df", "hash_df", "clear_memory_cache"]
 
-def cached_df(args_to_table_name: callable, cache_dir: Union[Path, str] = Path("/app/results")):
-    """Decorator for caching a dataframe to disk, and loading it if it exists."""
+
+def hash_df(df: pd.DataFrame) -> str:
+    """Fast content hash of a dataframe (its values, index, column names and dtypes), e.g. for cache keys."""
+    h = hashlib.md5(pd.util.hash_pandas_object(df, index=True).values.tobytes())
+    h.update(repr((list(df.columns), list(df.index.names), [str(dtype) for dtype in df.dtypes])).encode())
+    return h.hexdigest()
+
+
+class _MemoryCache:
+    """Least recently used cache of dataframes, bounded by their total memory usage."""
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._items: "OrderedDict[Tuple[Path, str], Tuple[pd.DataFrame, int]]" = OrderedDict()
+        self._bytes = 0
+
+    def get(self, key) -> Optional[pd.DataFrame]:
+        if key not in self._items:
+            return None
+        self._items.move_to_end(key)
+        return self._items[key][0]
+
+    def put(self, key, df: pd.DataFrame):
+        self.pop(key)
+        size = int(df.memory_usage(deep=True, index=True).sum())
+        if size > self.max_bytes:
+            return
+        self._items[key] = (df, size)
+        self._bytes += size
+        while self._bytes > self.max_bytes:
+            _, (_, evicted_size) = self._items.popitem(last=False)
+            self._bytes -= evicted_size
+
+    def pop(self, key):
+        if key in self._items:
+            self._bytes -= self._items.pop(key)[1]
+
+    def clear(self):
+        self._items.clear()
+        self._bytes = 0
+
+
+_memory_cache = _MemoryCache(max_bytes=2**30)
+
+
+def clear_memory_cache():
+    """Drop the dataframes that cached_df() keeps in memory (the files on disk are kept)."""
+    _memory_cache.clear()
+
+
+def _read_csv_table(cache_dir: Path, table_name: str) -> pd.DataFrame:
+    """Read a table cached as CSV (with a JSON sidecar of its read_csv arguments), as before tables were Parquet."""
+    read_kwargs = dict()
+    if (cache_dir / f"{table_name}.json").exists():
+        with (cache_dir / f"{table_name}.json").open("r") as f:
+            read_kwargs = json.load(f)
+    return pd.read_csv(cache_dir / f"{table_name}.csv", **read_kwargs)
+
+
+def _write_parquet(df: pd.DataFrame, path: Path):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+    df.to_parquet(tmp_path)
+    os.replace(tmp_path, path)  # atomically, so that concurrent readers never see a partial file
+
+
+def cached_df(
+    args_to_table_name: Callable[..., str],
+    cache_dir: Union[Path, str] = Path("/app/results"),
+    legacy_table_name: Optional[Callable[..., str]] = None,
+    memoize: bool = True,
+):
+    """Decorator for caching a dataframe to disk, and loading it if it exists.
+
+    Tables are stored as Parquet, which preserves dtypes and (multi-)indices of rows and columns. Tables cached as CSV
+    before are still read (and converted to Parquet). Loaded tables are also kept in memory (see _MemoryCache), so
+    repeated calls do not read them again; a copy is returned, so callers can modify it.
+
+    Args:
+        args_to_table_name (Callable[..., str]): Maps the arguments of the function to the name of its table. Hash large
+            arguments with hash_df().
+        cache_dir (Union[Path, str], optional): Directory of the cached tables. Defaults to /app/results.
+        legacy_table_name (Optional[Callable[..., str]], optional): Maps the arguments to the name of a table cached as
+            CSV under a previous naming scheme, which is used if there is no table named by args_to_table_name.
+            Defaults to None.
+        memoize (bool, optional): Whether to keep loaded tables in memory. Defaults to True.
+    """
 
     cache_dir = Path(cache_dir)
 
@@ -16,25 +105,33 @@ def cached_df(args_to_table_name: callable, cache_dir: Union[Path, str] = Path("
         @functools.wraps(func)
         def wrapper(*args, **kwargs):
             table_name = args_to_table_name(*args, **kwargs)
-            if (cache_dir / f"{table_name}.csv").exists():
+            key = (cache_dir, table_name)
+            df = _memory_cache.get(key) if memoize else None
+            if df is not None:
+                return df.copy()
+
+            path = cache_dir / f"{table_name}.parquet"
+            if path.exists():
                 logger.debug(f"Loading {table_name} from cache")
+                df = pd.read_parquet(path)
+            elif (cache_dir / f"{table_name}.csv").exists():
+                logger.debug(f"Loading {table_name} from CSV cache, and converting it to Parquet")
+                df = _read_csv_table(cache_dir, table_name)
+                _write_parquet(df, path)
+            elif (
+                legacy_table_name is not None
+                and (cache_dir / f"{(legacy_name := legacy_table_name(*args, **kwargs))}.csv").exists()
+            ):
+                logger.debug(f"Loading {table_name} from CSV cache {legacy_name}, and converting it to Parquet")
+                df = _read_csv_table(cache_dir, legacy_name)
+                _write_parquet(df, path)
             else:
                 df = func(*args, **kwargs)
-                df.to_csv(cache_dir / f"{table_name}.csv")
-                with (cache_dir / f"{table_name}.json").open("w") as f:
-                    # Write kwargs for reading
-                    json.dump(
-                        dict(
-                            index_col=list(range(len(getattr(df.index, "levels", " ")))),
-                            header=list(range(len(getattr(df.columns, "levels", " ")))),
-                        ),
-                        f,
-                    )
-            read_kwargs = dict()
-            if (cache_dir / f"{table_name}.json").exists():
-                with (cache_dir / f"{table_name}.json").open("r") as f:
-                    read_kwargs = json.load(f)
-            return pd.read_csv(cache_dir / f"{table_name}.csv", **read_kwargs)
+                _write_parquet(df, path)
+
+            if memoize:
+                _memory_cache.put(key, df)
+            return df.copy()
 
         return wrapper
 
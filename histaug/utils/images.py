@@ -1,3 +1,4 @@
+import torch
 from torchvision import transforms as T
 
 # Mean and standard deviation used for ImageNet normalization.
@@ -14,3 +15,14 @@ class UnNormalize(T.Normalize):
         new_mean = [-m / s for m, s in zip(mean, std)]
         new_std = [1 / s for s in std]
         super().__init__(new_mean, new_std, *args, **kwargs)
+
+
+def to_float_patches(patches: torch.Tensor) -> torch.Tensor:
+    """Convert uint8 patches of shape [N, H, W, C] to float patches of shape [N, C, H, W] in [0, 1].
+
+    Float patches are returned unchanged, so this can be applied wherever patches may still be in their stored format
+    (e.g. after copying uint8 patches to the GPU, which is 4x less data than copying float patches).
+    """
+    if patches.dtype != torch.uint8:
+        return patches
+    return patches.permute(0, 3, 1, 2).float().div_(255.0)
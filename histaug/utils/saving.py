@@ -1,10 +1,14 @@
 import torch
 from pathlib import Path
-from typing import List, Dict, NamedTuple, Sequence, Optional
+from typing import List, Dict, NamedTuple, Sequence, Optional, Tuple, Mapping, Any, Union
 import numpy as np
 import zarr
+from numcodecs import Blosc, blosc
+from numcodecs.abc import Codec
+import shutil
 
 FEATURES_VERSION = "0.1"
+FEATURE_ENCODINGS = ("float32", "float16", "bfloat16", "int8")
 
 
 class VersionMismatchError(Exception):
@@ -15,7 +19,7 @@ def check_version(path: Path, version: str = FEATURES_VERSION, throw: bool = Tru
     f = zarr.open_group(str(path), mode="r")
     result = f.attrs.get("version", None) == version
     if throw and not result:
-        raise VersionMismatchError(f"Version mismatch: expected {version}, got {f.attrs['version']}")
+        raise VersionMismatchError(f"Version mismatch: expected {version}, got {f.attrs.get('version', None)}")
     return result
 
 
@@ -23,6 +27,90 @@ def ensure_numpy(x):
     return x.numpy() if isinstance(x, torch.Tensor) else x
 
 
+def int8_scale(feats: np.ndarray) -> np.ndarray:
+    """Per-dimension scale that maps the largest absolute value of each dimension to 127."""
+    scale = np.abs(ensure_numpy(feats)).max(axis=0).astype(np.float32) / 127
+    return np.where(scale > 0, scale, 1.0).astype(np.float32)
+
+
+def encode_features(
+    feats, encoding: str = "float32", scale: Optional[np.ndarray] = None
+) -> Tuple[np.ndarray, Dict[str, Any]]:
+    """Encode features for storage.
+
+    Args:
+        feats: Features of shape [N, D].
+        encoding (str, optional): One of FEATURE_ENCODINGS. bfloat16 is stored as the upper 16 bits of the float32 values
+            (rounded to nearest even), and int8 as the values divided by a per-dimension scale. Defaults to "float32".
+        scale (Optional[np.ndarray], optional): Per-dimension scale for int8 encoding. Defaults to None (see int8_scale).
+
+    Returns:
+        Tuple[np.ndarray, Dict[str, Any]]: The encoded features, and the attributes needed to decode them.
+    """
+    feats = np.asarray(ensure_numpy(feats), dtype=np.float32)
+    if encoding == "float32":
+        return feats, dict()
+    elif encoding == "float16":
+        return feats.astype(np.float16), dict(encoding=encoding)
+    elif encoding == "bfloat16":
+        bits = feats.view(np.uint32)
+        rounded = (bits + np.uint32(0x7FFF) + ((bits >> 16) & 1)) >> 16
+        return np.where(np.isnan(feats), 0x7FC0, rounded).astype(np.uint16), dict(encoding=encoding)
+    elif encoding == "int8":
+        scale = int8_scale(feats) if scale is None else np.asarray(scale, dtype=np.float32)
+        encoded = np.clip(np.rint(feats / scale), -127, 127).astype(np.int8)
+        return encoded, dict(encoding=encoding, scale=scale.tolist())
+    raise ValueError(f"Unknown feature encoding {encoding!r}, expected one of {FEATURE_ENCODINGS}")
+
+
+def decode_features(data: np.ndarray, attrs: Mapping[str, Any] = {}) -> np.ndarray:
+    """Decode features stored by encode_features() to float32, given the attributes of the array they were read from."""
+    encoding = attrs.get("encoding", "float32")
+    if encoding == "bfloat16":
+        return (data.astype(np.uint32) << 16).view(np.float32)
+    elif encoding == "int8":
+        return data.astype(np.float32) * np.asarray(attrs["scale"], dtype=np.float32)
+    return data.astype(np.float32, copy=False)
+
+
+_BLOSC_SHUFFLES = dict(noshuffle=Blosc.NOSHUFFLE, shuffle=Blosc.SHUFFLE, bitshuffle=Blosc.BITSHUFFLE)
+
+
+def make_compressor(spec: Union[str, Codec, None] = "default") -> Union[str, Codec, None]:
+    """Create a zarr compressor from a specification of the form <codec>[:<level>[:<shuffle>]].
+
+    The codec is one of "lz4", "lz4hc", "zstd", "zlib" or "blosclz" (all through Blosc), "default" for zarr's default
+    compressor, or "none" for no compression; the shuffle is one of "noshuffle", "shuffle" (the default) or "bitshuffle".
+    For example, "zstd:3:bitshuffle". Codec instances (and None) are returned unchanged.
+    """
+    if not isinstance(spec, str) or spec == "default":
+        return spec
+    if spec == "none":
+        return None
+    cname, *options = spec.split(":")
+    assert (
+        cname in blosc.list_compressors()
+    ), f"unknown compressor {cname!r}, expected one of {blosc.list_compressors()}"
+    assert len(options) <= 2, f"invalid compressor specification {spec!r}"
+    clevel = int(options[0]) if len(options) > 0 else 5
+    shuffle = options[1] if len(options) > 1 else "shuffle"
+    assert shuffle in _BLOSC_SHUFFLES, f"unknown shuffle {shuffle!r}, expected one of {list(_BLOSC_SHUFFLES)}"
+    return Blosc(cname=cname, clevel=clevel, shuffle=_BLOSC_SHUFFLES[shuffle])
+
+
+def _compressor_config(compressor: Union[str, Codec, None]) -> Union[str, Dict[str, Any], None]:
+    """JSON serializable description of a compressor returned by make_compressor()."""
+    return compressor.get_config() if isinstance(compressor, Codec) else compressor
+
+
+def _create_feature_array(group: zarr.Group, name: str, feats, encoding: str, chunk_size: int, compressor):
+    encoded, attrs = encode_features(feats, encoding)
+    array = group.create_dataset(
+        name, data=encoded, chunks=(chunk_size, *encoded.shape[1:]), compressor=make_compressor(compressor)
+    )
+    array.attrs.update(attrs)
+
+
 def save_features(
     file: Path,
     feats: torch.Tensor,
@@ -35,23 +123,153 @@ def save_features(
     classes: Optional[List[str]] = None,
     chunk_size: int = 2048,
     version: str = FEATURES_VERSION,
+    encoding: str = "float32",
+    compressor: Union[str, Codec, None] = "default",
 ):
+    """Save features to a zarr group.
+
+    The feature arrays are stored in chunks of chunk_size rows, with the given encoding (see encode_features()) and
+    compressor (see make_compressor()). Smaller chunks mean less data is decompressed when gathering random rows.
+    """
     f = zarr.open_group(str(file), mode="w")
     f.attrs["version"] = version
+    f.attrs["encoding"] = encoding
     if classes is not None:
         f.attrs["classes"] = classes
     if labels is not None:
         f.create_dataset("labels", data=ensure_numpy(labels), chunks=False)
     if files is not None:
         f.create_dataset("files", data=np.array(files, dtype=str), chunks=False)
-    f.create_dataset("feats", data=ensure_numpy(feats), chunks=(chunk_size, *feats.shape[1:]))
+    _create_feature_array(f, "feats", feats, encoding, chunk_size, compressor)
     if coords is not None:
         f.create_dataset("coords", data=ensure_numpy(coords), chunks=-1)
     aug_group = f.create_group("feats_augs")
     for aug_name, feats_aug in feats_augs.items():
-        aug_group.create_dataset(aug_name, data=ensure_numpy(feats_aug), chunks=(chunk_size, *feats_aug.shape[1:]))
+        _create_feature_array(aug_group, aug_name, feats_aug, encoding, chunk_size, compressor)
     if feats_norm is not None:
-        f.create_dataset("feats_norm", data=ensure_numpy(feats_norm), chunks=(chunk_size, *feats_norm.shape[1:]))
+        _create_feature_array(f, "feats_norm", feats_norm, encoding, chunk_size, compressor)
+
+
+class FeatureWriter:
+    """Incrementally writes features to a zarr group with the same layout as save_features(), one batch at a time.
+
+    The feature arrays are pre-allocated from the known number of patches when the first batch arrives. After every
+    batch, the number of patches written so far is recorded in the group's attributes, so a partially written file can
+    be resumed from there. The version attribute is only set by close(), so check_version() fails for incomplete files.
+
+    With int8 encoding, the features are written as float32 first, and each array is encoded by close() with a scale
+    computed from all of its values (like save_features() does), so that values of later batches are never clipped.
+    """
+
+    def __init__(
+        self,
+        file: Path,
+        num_patches: int,
+        coords: Optional[torch.Tensor] = None,
+        *,
+        chunk_size: int = 2048,
+        version: str = FEATURES_VERSION,
+        resume: bool = True,
+        encoding: str = "float32",
+        compressor: Union[str, Codec, None] = "default",
+    ):
+        assert encoding in FEATURE_ENCODINGS, f"unknown feature encoding {encoding!r}"
+        self.file = Path(file)
+        self.num_patches = num_patches
+        self.chunk_size = chunk_size
+        self.version = version
+        self.encoding = encoding
+        self.compressor = make_compressor(compressor)
+
+        layout = dict(
+            num_patches=num_patches,
+            encoding=encoding,
+            chunk_size=chunk_size,
+            compressor=_compressor_config(self.compressor),
+        )
+        if resume and self._is_resumable(self.file, layout):
+            self.f = zarr.open_group(str(self.file), mode="r+")
+        else:
+            shutil.rmtree(self.file, ignore_errors=True)
+            self.f = zarr.open_group(str(self.file), mode="w")
+            self.f.attrs.update(num_written=0, **layout)
+            if coords is not None:
+                self.f.create_dataset("coords", data=ensure_numpy(coords), chunks=-1)
+            self.f.create_group("feats_augs")
+
+    @staticmethod
+    def _is_resumable(file: Path, layout: Mapping[str, Any]) -> bool:
+        """Whether file is a partially written file with the same number of patches, encoding, chunk size and
+        compressor, so that resuming it does not mix different settings."""
+        if not file.exists():
+            return False
+        try:
+            attrs = zarr.open_group(str(file), mode="r").attrs.asdict()
+        except (zarr.errors.GroupNotFoundError, ValueError):
+            return False
+        return (
+            "version" not in attrs
+            and "num_written" in attrs
+            and all(attrs.get(key, None) == value for key, value in layout.items())
+        )
+
+    @property
+    def num_written(self) -> int:
+        """Number of leading patches whose features have been written."""
+        return self.f.attrs["num_written"]
+
+    def _write_array(self, group: zarr.Group, name: str, start: int, data):
+        # int8 arrays are encoded by close(), once all of their values are known
+        encoded, attrs = encode_features(data, "float32" if self.encoding == "int8" else self.encoding)
+        if name not in group:
+            array = group.create_dataset(
+                name,
+                shape=(self.num_patches, *encoded.shape[1:]),
+                chunks=(self.chunk_size, *encoded.shape[1:]),
+                dtype=encoded.dtype,
+                compressor=self.compressor,
+            )
+            array.attrs.update(attrs)
+        group[name][start : start + len(encoded)] = encoded
+
+    def write(
+        self,
+        start: int,
+        feats: torch.Tensor,
+        feats_augs: Dict[str, torch.Tensor],
+        feats_norm: Optional[torch.Tensor] = None,
+    ):
+        """Write the features of the patches start, ..., start + len(feats) - 1."""
+        self._write_array(self.f, "feats", start, feats)
+        for aug_name, feats_aug in feats_augs.items():
+            self._write_array(self.f["feats_augs"], aug_name, start, feats_aug)
+        if feats_norm is not None:
+            self._write_array(self.f, "feats_norm", start, feats_norm)
+        # Only record progress once the whole batch is written, so that an interrupted batch is redone when resuming
+        self.f.attrs["num_written"] = max(self.num_written, start + len(feats))
+
+    def _encode_int8(self, group: zarr.Group, name: str):
+        """Re-encode a float32 array as int8. The encoded array is written next to it and then moved into its place, so
+        that calling close() again after an interruption completes the encoding."""
+        encoded_name = f"{name}__int8"
+        if name in group and group[name].dtype != np.int8:
+            encoded, attrs = encode_features(group[name][:], "int8")
+            array = group.create_dataset(
+                encoded_name, data=encoded, chunks=group[name].chunks, compressor=self.compressor, overwrite=True
+            )
+            array.attrs.update(attrs)
+            del group[name]
+        if encoded_name in group:
+            group.move(encoded_name, name)
+
+    def close(self):
+        assert self.num_written == self.num_patches, f"only {self.num_written}/{self.num_patches} patches written"
+        if self.encoding == "int8":
+            for group in (self.f, self.f["feats_augs"]):
+                names = {name.removesuffix("__int8") for name in group.array_keys()} - {"coords"}
+                for name in sorted(names):
+                    self._encode_int8(group, name)
+        self.f.attrs["version"] = self.version
 
 
 class LoadedFeatures(NamedTuple):
@@ -68,16 +286,29 @@ def load_features(
     augmentations: Optional[Sequence[str]] = None,
     n: Optional[int] = None,
 ) -> LoadedFeatures:
-    n = n or -1
+    """Load the features of a file written by save_features(), decoded to float32.
+
+    Args:
+        path (Path): Path to the feature file.
+        remove_classes (Sequence[str], optional): Classes whose rows are removed. Defaults to ().
+        augmentations (Optional[Sequence[str]], optional): Augmentations to load. Defaults to None (all).
+        n (Optional[int], optional): Number of leading rows to load. None or 0 loads all rows (previously, the last row
+            was dropped in that case). Defaults to None.
+    """
+    n = n or None
     f = zarr.open_group(str(path), mode="r")
     classes = np.array(f.attrs["classes"]) if "classes" in f.attrs else None
 
-    feats = f["feats"][:n]
+    feats = decode_features(f["feats"][:n], f["feats"].attrs)
     labels = classes[f["labels"][:n]] if classes is not None and "labels" in f else None
     files = f["files"][:n] if "files" in f else None
     coords = f["coords"][:n] if "coords" in f else None
 
-    feats_augs = {k: v[:n] for k, v in f["feats_augs"].items() if augmentations is None or k in augmentations}
+    feats_augs = {
+        k: decode_features(v[:n], v.attrs)
+        for k, v in f["feats_augs"].items()
+        if augmentations is None or k in augmentations
+    }
 
     # Remove classes
     if len(remove_classes) > 0:
@@ -1,5 +1,6 @@
-from typing import NamedTuple
+from typing import NamedTuple, List
 import math
+import numpy as np
 
 
 class Statistic(NamedTuple):
@@ -33,3 +34,57 @@ class RunningStats:
         variance = self.M2 / self.count
         # sample_variance = self.M2 / (self.count - 1)
         return Statistic(mean, math.sqrt(variance))
+
+
+def _cdf(sorted_values: np.ndarray, points: np.ndarray) -> np.ndarray:
+    """Empirical CDF P(X <= point) of each column of sorted_values [n, k] at the given points [m] -> [m, k]"""
+    return np.stack([np.searchsorted(column, points, side="right") for column in sorted_values.T], axis=-1) / len(
+        sorted_values
+    )
+
+
+def max_minus_value_stats(values: np.ndarray) -> List[Statistic]:
+    """Mean and (population) standard deviation of max(x) - x_j for each column j, where x ranges over the Cartesian
+    product of the columns of values, i.e. x_i is any of the n values in column i.
+
+    This is what iterating over itertools.product(*values.T) with a RunningStats per column computes, but in closed form:
+    with M the maximum of x and M_j the maximum of the other columns, E[M - x_j] = E[M] - E[x_j] and
+    E[(M - x_j)^2] = E[M^2] - 2 E[x_j max(x_j, M_j)] + E[x_j^2], where the distribution of M_j is the product of the
+    empirical CDFs of the other columns. This takes O(n k^2) rather than O(n^k) time.
+
+    Args:
+        values (np.ndarray): Values of shape [n, k] (e.g. the AUROC of each of n seeds for each of k feature extractors).
+
+    Returns:
+        List[Statistic]: The statistics of each column. If any value is NaN, all statistics are NaN.
+    """
+    values = np.asarray(values, dtype=np.float64)
+    n, k = values.shape
+    if n == 0 or k == 0 or np.isnan(values).any():
+        return [Statistic(float("nan"), float("nan"))] * k
+
+    sorted_values = np.sort(values, axis=0)
+    support = np.unique(values)  # possible values of the maximum
+    cdfs = _cdf(sorted_values, support)  # [m, k]
+    # Products of the CDFs of all columns but j, from prefix and suffix products over the columns
+    prefix = np.cumprod(np.concatenate([np.ones((len(support), 1)), cdfs[:, :-1]], axis=-1), axis=-1)
+    suffix = np.cumprod(np.concatenate([np.ones((len(support), 1)), cdfs[:, :0:-1]], axis=-1), axis=-1)[:, ::-1]
+    other_cdfs = prefix * suffix  # [m, k], P(M_j <= support)
+    other_pmfs = np.diff(other_cdfs, axis=0, prepend=0)  # [m, k], P(M_j = support)
+    # E[M_j 1{M_j > support[l]}], so that E[max(x, M_j)] = x P(M_j <= x) + E[M_j 1{M_j > x}]
+    tail_sums = np.cumsum((support[:, None] * other_pmfs)[::-1], axis=0)[::-1]
+    tail_sums = np.concatenate([tail_sums[1:], np.zeros((1, k))], axis=0)
+
+    max_cdf = prefix[:, -1] * cdfs[:, -1]  # P(M <= support)
+    max_pmf = np.diff(max_cdf, prepend=0)
+    mean_max, mean_max_sq = (support * max_pmf).sum(), (support**2 * max_pmf).sum()
+
+    stats = []
+    for j in range(k):
+        x = values[:, j]
+        l = np.searchsorted(support, x)  # x == support[l]
+        x_times_max = x * (x * other_cdfs[l, j] + tail_sums[l, j])
+        mean = mean_max - x.mean()
+        variance = mean_max_sq - 2 * x_times_max.mean() + (x**2).mean() - mean**2
+        stats.append(Statistic(float(mean), math.sqrt(max(variance, 0.0))))
+    return stats
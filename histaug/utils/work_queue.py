@@ -0,0 +1,166 @@
+import json
+import os
+import socket
+import threading
+import time
+import uuid
+from pathlib import Path
+from typing import Iterator, Sequence, Union
+from loguru import logger
+
+__all__ = ["WorkQueue"]
+
+
+class _Heartbeat(threading.Thread):
+    """Background thread that periodically touches a claim file to show that its owner is still alive."""
+
+    def __init__(self, path: Path, interval: float):
+        super().__init__(daemon=True)
+        self.path = path
+        self.interval = interval
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            try:
+                os.utime(self.path)
+            except FileNotFoundError:
+                logger.warning(f"Claim {self.path} was removed while still being processed")
+                return
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+
+class WorkQueue:
+    """A work queue over a fixed list of items, coordinated through lock files in a shared directory.
+
+    Any number of processes (on the same machine, or on different nodes with shared storage) can iterate over the same
+    queue; each item is yielded to only one of them. An item is claimed by atomically creating <key>.lock, which is
+    touched periodically while the item is processed. Claims whose lock file has not been touched for stale_after
+    seconds (e.g. because the worker crashed) are released and can be claimed again. Finished items are marked with a
+    <key>.done file, so a crashed or interrupted run resumes with the remaining items when it is started again.
+
+    Args:
+        queue_dir (Union[str, Path]): Shared directory containing the lock files.
+        keys (Sequence[str]): Unique (file name safe) key of each item, e.g. the slide names.
+        heartbeat_interval (float, optional): Seconds between heartbeats. Defaults to 30.
+        stale_after (float, optional): Seconds after the last heartbeat after which a claim is considered stale.
+            Defaults to 300.
+    """
+
+    def __init__(
+        self,
+        queue_dir: Union[str, Path],
+        keys: Sequence[str],
+        heartbeat_interval: float = 30.0,
+        stale_after: float = 300.0,
+    ):
+        assert stale_after > heartbeat_interval, "claims must be refreshed more often than they become stale"
+        self.queue_dir = Path(queue_dir)
+        self.queue_dir.mkdir(parents=True, exist_ok=True)
+        self.keys = list(keys)
+        self.heartbeat_interval = heartbeat_interval
+        self.stale_after = stale_after
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self._heartbeats = dict()
+
+    def _lock_file(self, key: str) -> Path:
+        return self.queue_dir / f"{key}.lock"
+
+    def _done_file(self, key: str) -> Path:
+        return self.queue_dir / f"{key}.done"
+
+    def is_done(self, key: str) -> bool:
+        return self._done_file(key).exists()
+
+    def _is_stale(self, path: Path) -> bool:
+        try:
+            return time.time() - path.stat().st_mtime > self.stale_after
+        except FileNotFoundError:
+            return False
+
+    def _create_lock(self, key: str) -> bool:
+        try:
+            fd = os.open(self._lock_file(key), os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return False
+        with os.fdopen(fd, "w") as f:
+            json.dump(dict(worker=self.worker_id, claimed_at=time.time()), f)
+        return True
+
+    def _release_stale_lock(self, key: str) -> bool:
+        """Remove a stale lock file. Only one worker can succeed in moving the lock file out of the way."""
+        lock_file = self._lock_file(key)
+        stale_file = lock_file.with_name(f"{lock_file.name}.{uuid.uuid4().hex}.stale")
+        try:
+            os.rename(lock_file, stale_file)
+        except FileNotFoundError:
+            return False
+        if not self._is_stale(stale_file):
+            # Another worker replaced the stale lock in the meantime, so we moved a live claim; put it back
+            try:
+                os.link(stale_file, lock_file)
+            except FileExistsError:
+                pass
+            os.remove(stale_file)
+            return False
+        os.remove(stale_file)
+        logger.warning(f"Released stale claim on {key}")
+        return True
+
+    def claim(self, key: str) -> bool:
+        """Try to claim an item. If successful, the claim is kept alive by a heartbeat until it is released."""
+        if self.is_done(key):
+            return False
+        claimed = self._create_lock(key)
+        if not claimed and self._is_stale(self._lock_file(key)) and self._release_stale_lock(key):
+            claimed = self._create_lock(key)
+        if claimed:
+            self._heartbeats[key] = _Heartbeat(self._lock_file(key), self.heartbeat_interval)
+            self._heartbeats[key].start()
+        return claimed
+
+    def release(self, key: str, done: bool = False):
+        if key in self._heartbeats:
+            self._heartbeats.pop(key).stop()
+        if done:
+            self._done_file(key).touch()
+        try:
+            os.remove(self._lock_file(key))
+        except FileNotFoundError:
+            pass
+
+    def claims(self) -> Iterator[int]:
+        """Yield the indices of the items claimed by this worker. The consumer must release() each item itself."""
+        while True:
+            claimed_any = False
+            for index, key in enumerate(self.keys):
+                if self.claim(key):
+                    claimed_any = True
+                    yield index
+
+            # Items claimed by crashed workers become available again once their claims are stale, so keep going
+            # until a full pass does not yield anything
+            if not claimed_any:
+                break
+
+    def __iter__(self) -> Iterator[int]:
+        """Yield the indices of the items claimed by this worker. An item is marked as done when the consumer asks for
+        the next one; if the consumer raises an exception instead, the claim is released without marking it done."""
+        for index in self.claims():
+            done = False
+            try:
+                yield index
+                done = True
+            finally:
+                self.release(self.keys[index], done=done)
+
+    def __len__(self) -> int:
+        return sum(not self.is_done(key) for key in self.keys)
+
+    def summary(self) -> str:
+        done = sum(self.is_done(key) for key in self.keys)
+        claimed = sum(self._lock_file(key).exists() for key in self.keys)
+        return f"{done}/{len(self.keys)} done, {claimed} in progress"
@@ -5,7 +5,7 @@ if [ "$1" = "" ]; then
     exit 1
 fi
 
-model="$1" # "ctranspath" "swin" "retccl" "resnet50" "owkin" "vit"
+model="$1" # "ctranspath" "swin" "retccl" "resnet50" "owkin" "vit" (multiple models can be given as e.g. "ctranspath swin", in which case each slide is only read once)
 
 aug=""
 
@@ -40,6 +40,10 @@ CMDS=(
     # "env/bin/python -m histaug.extract_features.slide_dataset --dataset $dataset --output $output --model $model $aug --start 300 --end 600"
     # "env/bin/python -m histaug.extract_features.slide_dataset --dataset $dataset --output $output --model $model $aug --start 600 --end 900"
     # "env/bin/python -m histaug.extract_features.slide_dataset --dataset $dataset --output $output --model $model $aug --start 900"
+    # Alternatively, run the same command on multiple GPUs with a shared work queue (slides are split automatically; other
+    # models or augmentations get their own queue within $output/.queue, so they do not skip the slides finished here):
+    # "env/bin/python -m histaug.extract_features.slide_dataset --dataset $dataset --output $output --model $model $aug --queue $output/.queue"
+    # "env/bin/python -m histaug.extract_features.slide_dataset --dataset $dataset --output $output --model $model $aug --queue $output/.queue"
 )
 
 session="extract"
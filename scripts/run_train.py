@@ -14,7 +14,29 @@ IGNORE_CONFIG_KEYS = ["early_stopping.metric", "early_stopping.goal", "dataset.n
 RAM_BOMB = True  # whether to run the RAM bomb to clear disk cache before changing feature extractors (only makes sense when using 1 GPU)
 
 
-def run(dry_run: bool = False, check_wandb: bool = True):
+def completed_overrides(from_wandb: bool = False):
+    """Yield the command line overrides of each finished run, from the local results index or from wandb."""
+    if from_wandb:
+        import wandb
+
+        api = wandb.Api()
+        runs = (run for run in api.runs("histaug", order="+created_at", per_page=1000) if run.state == "finished")
+        for run in tqdm(runs, desc="Checking wandb"):
+            yield run.config.get("overrides", "")
+    else:
+        from histaug.analysis.results_index import update_results_index
+
+        overrides = update_results_index().overrides
+        if len(overrides) == 0:
+            logger.warning(
+                "The results index is empty (index runs trained before it existed with python -m histaug.analysis.results_index --from-wandb); checking wandb instead"
+            )
+            yield from completed_overrides(from_wandb=True)
+        else:
+            yield from overrides
+
+
+def run(dry_run: bool = False, check_wandb: bool = True, online: bool = False):
     log_dir = Path("experiment_logs")
     success_dir = log_dir / "success"
     fail_dir = log_dir / "fail"
@@ -103,13 +125,8 @@ def run(dry_run: bool = False, check_wandb: bool = True):
     logger.info(f"Generated task list")
 
     if check_wandb:
-        import wandb
-
-        api = wandb.Api()
-
-        runs = (run for run in api.runs("histaug", order="+created_at", per_page=1000) if run.state == "finished")
-        for run in tqdm(runs, desc="Checking wandb"):
-            run_overrides = {k: v for (k, v) in [x.split("=") for x in run.config.get("overrides", "").split(" ")]}
+        for overrides in completed_overrides(from_wandb=online):
+            run_overrides = {k: v for (k, v) in [x.split("=", 1) for x in overrides.split(" ") if "=" in x]}
             configs = [
                 config
                 for config in configs
@@ -119,7 +136,9 @@ def run(dry_run: bool = False, check_wandb: bool = True):
                     if k not in IGNORE_CONFIG_KEYS and v is not None
                 )
             ]
-        logger.info(f"Removed configs that were already completed on wandb; {len(configs)} remaining")
+        logger.info(
+            f"Removed configs that were already completed ({'on wandb' if online else 'in the results index'}); {len(configs)} remaining"
+        )
     else:
         # Remove already completed tasks
         for path in success_dir.glob("*.json"):
@@ -201,7 +220,10 @@ if __name__ == "__main__":
 
     parser = argparse.ArgumentParser()
     parser.add_argument("--dry-run", action="store_true")
-    parser.add_argument("--no-check-wandb", action="store_true")
+    parser.add_argument("--no-check-wandb", action="store_true", help="Do not skip runs that were already completed")
+    parser.add_argument(
+        "--online", action="store_true", help="Check wandb for completed runs, instead of the local results index"
+    )
     args = parser.parse_args()
 
-    run(dry_run=args.dry_run, check_wandb=not args.no_check_wandb)
+    run(dry_run=args.dry_run, check_wandb=not args.no_check_wandb, online=args.online)
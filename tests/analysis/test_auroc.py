@@ -0,0 +1,28 @@
+import numpy as np
+import torch
+from torchmetrics.classification import MulticlassAUROC
+
+from histaug.analysis.auroc import bootstrap_auroc, draw_bootstraps
+
+
+def test_bootstrap_auroc_matches_torchmetrics():
+    rng = np.random.default_rng(0)
+    n_patients, n_classes = 40, 3
+    preds = rng.random((n_patients, n_classes)).round(1)  # with ties
+    preds /= preds.sum(axis=1, keepdims=True)
+    targets = np.arange(n_patients) % n_classes
+    bootstraps = rng.integers(0, n_patients, size=(20, n_patients))
+    bootstraps[:, :n_classes] = np.arange(n_classes)  # each class occurs in each bootstrap
+
+    aurocs = bootstrap_auroc(preds, targets, bootstraps)
+    for bootstrap, auroc in zip(bootstraps, aurocs):
+        metric = MulticlassAUROC(num_classes=n_classes)
+        metric.update(torch.from_numpy(preds[bootstrap]), torch.from_numpy(targets[bootstrap]))
+        assert np.isclose(metric.compute().item(), auroc, atol=1e-6)
+
+
+def test_draw_bootstraps_contain_each_class():
+    labels = np.array([0] * 50 + [1] * 2 + [-1] * 3 + [2])  # rare classes, and unlabeled samples
+    bootstraps = draw_bootstraps(labels, n_bootstraps=200, seed=0)
+    assert bootstraps.shape == (200, len(labels))
+    assert all({0, 1, 2} <= set(labels[bootstrap]) for bootstrap in bootstraps)
@@ -0,0 +1,49 @@
+import json
+import pandas as pd
+
+from histaug.analysis.collect_results import INDEX_COLS
+from histaug.analysis.results_index import update_results_index
+
+
+def _write_run(run_dir, wandb_id, seed, test_auroc):
+    (run_dir / "lightning_logs" / "version_0").mkdir(parents=True)
+    pd.DataFrame(
+        {
+            "epoch": [0, 0, 1, 1, 1],
+            "val/loss": [0.7, None, 0.5, None, None],
+            "val/y/auroc": [0.6, None, 0.8, None, None],
+            "train/y/auroc": [None, 0.7, None, 0.9, None],
+            "test/y/auroc": [None, None, None, None, test_auroc],
+        }
+    ).to_csv(run_dir / "lightning_logs" / "version_0" / "metrics.csv", index=False)
+    config = dict(
+        settings=dict(feature_extractor="ctranspath"),
+        dataset=dict(targets=[dict(column="y")], name="tcga_mpp0.5", augmentations=dict(name="none")),
+        test=dict(dataset=dict(name="cptac")),
+        model=dict(_target_="histaug.train.models.AttentionMIL"),
+        seed=seed,
+    )
+    with (run_dir / "run.json").open("w") as f:
+        json.dump(dict(wandb_id=wandb_id, overrides=f"model=attmil seed={seed}", runtime=1.0, config=config), f)
+
+
+def test_results_index_adds_new_runs(tmp_path):
+    train_dir, index = tmp_path / "train", tmp_path / "results" / "index.sqlite"
+    _write_run(train_dir / "tcga" / "run0", "run0", 0, 0.75)
+    (train_dir / "tcga" / "unfinished").mkdir()
+
+    df = update_results_index(train_dir, index)
+    assert len(df) == 1
+    run = df.iloc[0]
+    assert (run.wandb_id, run.train_dataset, run.model, run.seed) == ("run0", "tcga", "AttentionMIL", 0)
+    assert (run.val_auroc, run.train_auroc, run.test_auroc) == (0.8, 0.9, 0.75)  # at the epoch with the best val/loss
+
+    _write_run(train_dir / "tcga" / "run1", "run1", 1, 0.7)
+    df = update_results_index(train_dir, index)
+    assert sorted(df.wandb_id) == ["run0", "run1"] and sorted(df.overrides)[1] == "model=attmil seed=1"
+
+
+def test_empty_results_index_has_all_columns(tmp_path):
+    df = update_results_index(tmp_path / "train", tmp_path / "index.sqlite")
+    assert len(df) == 0 and list(df.overrides) == []
+    df.drop(columns=["run_dir", "overrides"]).set_index(INDEX_COLS)  # as in load_results()
@@ -0,0 +1,55 @@
+from pathlib import Path
+import cv2
+import torch
+
+import histaug
+from histaug.augmentations.macenko_torchstain import TorchMacenkoNormalizer, masked_percentile, percentile
+
+TEMPLATE = Path(histaug.__file__).parent.parent / "normalization_template.jpg"
+
+
+def load_patches(n: int = 8, size: int = 224):
+    image = cv2.cvtColor(cv2.imread(str(TEMPLATE)), cv2.COLOR_BGR2RGB)
+    image = torch.from_numpy(image).permute(2, 0, 1)
+    generator = torch.Generator().manual_seed(0)
+    patches = []
+    for _ in range(n):
+        i, j = torch.randint(0, image.shape[1] - size, (2,), generator=generator).tolist()
+        patches.append(image[:, i : i + size, j : j + size])
+    return torch.stack(patches)
+
+
+def test_masked_percentile_matches_percentile():
+    t = torch.randn(4, 1000)
+    mask = torch.rand(4, 1000) > 0.3
+    for q in (1, 50, 99):
+        result = masked_percentile(t, mask, q)
+        for row, row_mask, value in zip(t, mask, result):
+            assert value == percentile(row[row_mask], q)
+
+
+def test_normalize_batch_matches_normalize():
+    normalizer = TorchMacenkoNormalizer()
+    patches = load_patches()
+    Inorm, valid = normalizer.normalize_batch(patches)
+    assert valid.all()
+    for patch, patch_norm in zip(patches, Inorm):
+        expected, *_ = normalizer.normalize(patch)
+        assert (expected.int() - patch_norm.int()).abs().max() <= 1
+
+
+def test_normalize_batch_fully_transparent():
+    normalizer = TorchMacenkoNormalizer()
+    patches = load_patches(n=3)
+    patches[1] = 255
+    Inorm, valid = normalizer.normalize_batch(patches)
+    assert valid.tolist() == [True, False, True]
+    assert (Inorm[1] == patches[1]).all()
+
+
+def test_macenko_forward_image_matches_forward():
+    from histaug.augmentations import Macenko
+
+    macenko = Macenko()
+    patches = load_patches(n=2).float() / 255.0
+    assert torch.equal(macenko.forward_image(patches[1]), macenko(patches)[1])
@@ -0,0 +1,59 @@
+import numpy as np
+import torch
+import zarr
+
+from histaug.augmentations.stain_cache import SlideStainCache, sample_slide_pixels
+
+
+def test_stain_cache_roundtrip(tmp_path):
+    cache = SlideStainCache(tmp_path / "stains.json")
+    HE, maxC = torch.rand(3, 2), torch.rand(2)
+    assert cache.get("slide", dict(n_pixels=10)) is None
+
+    cache.set("slide", HE, maxC, params=dict(n_pixels=10))
+    assert "slide" in cache
+    cached_HE, cached_maxC = cache.get("slide", dict(n_pixels=10))
+    assert torch.allclose(cached_HE, HE) and torch.allclose(cached_maxC, maxC)
+
+    # Entries estimated with different parameters are not reused
+    assert cache.get("slide", dict(n_pixels=20)) is None
+
+
+def test_sample_slide_pixels_is_deterministic(tmp_path):
+    patches = zarr.open_array(
+        str(tmp_path / "patches.zarr"), mode="w", shape=(10, 8, 8, 3), chunks=(4, 8, 8, 3), dtype="uint8"
+    )
+    patches[:] = np.random.randint(0, 256, size=patches.shape, dtype="uint8")
+    pixels = sample_slide_pixels(patches, n_patches=5, n_pixels=100)
+    assert pixels.shape == (3, 1, 100)
+    assert (pixels == sample_slide_pixels(patches, n_patches=5, n_pixels=100)).all()
+
+
+def test_slidewise_macenko_is_opt_in_and_keyed_by_dataset(tmp_path):
+    from types import SimpleNamespace
+    from histaug.augmentations import MacenkoSlidewise, augmentation_names, load_augmentations
+
+    assert "Macenko slidewise" not in augmentation_names()
+    assert list(load_augmentations(["Macenko slidewise"]).keys()) == ["Macenko slidewise"]
+
+    slide_a = SimpleNamespace(path=tmp_path / "TCGA" / "slide.zarr", name="slide")
+    slide_b = SimpleNamespace(path=tmp_path / "CPTAC" / "slide.zarr", name="slide")
+    assert MacenkoSlidewise.stain_cache_key(slide_a) != MacenkoSlidewise.stain_cache_key(slide_b)
+
+
+def test_slidewise_macenko_passes_through_transparent_patches(tmp_path):
+    from types import SimpleNamespace
+    from histaug.augmentations import MacenkoSlidewise
+    from test_macenko_torchstain import load_patches
+
+    patches = load_patches(n=4).permute(0, 2, 3, 1).contiguous()
+    group = zarr.open_group(str(tmp_path / "slide.zarr"), mode="w")
+    group.create_dataset("patches", data=patches.numpy(), chunks=(2, *patches.shape[1:]))
+    macenko = MacenkoSlidewise(n_patches=4, n_pixels=10_000)
+    macenko.fit_slide(SimpleNamespace(path=tmp_path / "slide.zarr", name="slide", zarr_group=group))
+
+    images = patches.permute(0, 3, 1, 2).float() / 255.0
+    images[1] = 1.0  # fully transparent
+    normalized = macenko(images)
+    assert macenko.num_passed_through == 1
+    assert torch.equal(normalized[1], images[1]) and not torch.equal(normalized[0], images[0])
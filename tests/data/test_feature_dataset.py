@@ -0,0 +1,62 @@
+import numpy as np
+import zarr
+
+from histaug.data.feature_dataset import CachedFeatureDataset, FeatureDataset, ORIGINAL_FEATURES, open_slide_features
+
+
+def _make_features(path, num_patches, augmentations, slide_index):
+    """Create features whose values encode (slide, augmentation, patch), so that gathered rows can be checked."""
+    f = zarr.open_group(str(path), mode="w")
+    patch_index = np.arange(num_patches)
+    coords = np.stack([np.full(num_patches, slide_index), patch_index], axis=-1)
+    f.create_dataset("coords", data=coords, chunks=-1)
+    for aug_index, aug in enumerate(augmentations):
+        feats = np.stack([np.full(num_patches, slide_index), np.full(num_patches, aug_index), patch_index], axis=-1)
+        name = "feats" if aug == ORIGINAL_FEATURES else f"feats_augs/{aug}"
+        f.create_dataset(name, data=feats.astype(np.float32), chunks=(16, 3))
+
+
+def test_feature_dataset_gathers_sampled_rows(tmp_path):
+    augmentations = [ORIGINAL_FEATURES, "a", "b"]
+    _make_features(tmp_path / "s0.zarr", 50, augmentations, 0)
+    _make_features(tmp_path / "s1.zarr", 30, augmentations, 1)
+    ds = FeatureDataset(
+        ["p"], [[tmp_path / "s0.zarr", tmp_path / "s1.zarr"]], None, instances_per_bag=60, augmentations=augmentations
+    )
+
+    np.random.seed(0)
+    feats, coords, labels, patient_id = ds[0]
+    assert feats.shape == (60, 3) and coords.shape == (60, 2)
+    assert (feats[:, [0, 2]] == coords).all()  # each row comes from the slide and patch given by its coordinates
+    assert len(np.unique(coords, axis=0)) == 60  # patches are sampled without replacement
+    assert set(feats[:, 1].astype(int)) == {0, 1, 2}
+    assert patient_id == "p" and labels is None
+
+
+def test_cached_feature_dataset_gathers_cached_indices(tmp_path):
+    augmentations = [ORIGINAL_FEATURES, "a"]
+    _make_features(tmp_path / "s0.zarr", 40, augmentations, 0)
+    ds = FeatureDataset(["p"], [[tmp_path / "s0.zarr"]], None, instances_per_bag=20, augmentations=augmentations)
+
+    # Cache the sampled indices in the per-patient format of older caches
+    np.random.seed(0)
+    f = zarr.open(str(tmp_path / "cache" / "epoch_000" / "p.zarr"), mode="w")
+    f.attrs["augmentations"] = augmentations
+    f.attrs["slides"] = [str(slide) for slide in ds.slides[0]]
+    f.create_dataset("indices", data=ds.sample_indices(0).astype(np.int32))
+
+    np.random.seed(0)
+    feats, coords, *_ = ds[0]
+    cached_feats, cached_coords, _, patient_id = CachedFeatureDataset(["p"], None, tmp_path / "cache")[0]
+    assert patient_id == "p"
+    assert (cached_feats == feats).all() and (cached_coords == coords).all()
+
+
+def test_open_slide_features_reads_encodings_once(tmp_path, monkeypatch):
+    _make_features(tmp_path / "s0.zarr", 10, [ORIGINAL_FEATURES, "a"], 0)
+    f = open_slide_features(tmp_path / "s0.zarr")
+    assert open_slide_features(tmp_path / "s0.zarr") is f  # opened once per process
+    assert f.encoding("feats_augs/a") == dict()
+
+    monkeypatch.setattr(zarr.attrs.Attributes, "asdict", lambda self: 1 / 0)
+    assert f.encoding("feats_augs/a") == dict()  # not read again
@@ -0,0 +1,42 @@
+import numpy as np
+import pytest
+import zarr
+
+from histaug.data import FeatureDataset, FeatureStore, build_feature_store
+from histaug.data.feature_dataset import ORIGINAL_FEATURES
+from histaug.utils import save_features
+
+
+def test_feature_store_matches_zarr_backend(tmp_path):
+    for name, n in [("a", 30), ("b", 50)]:
+        save_features(
+            tmp_path / f"{name}.zarr",
+            feats=np.random.rand(n, 4).astype(np.float32),
+            feats_augs={"flip": np.random.rand(n, 4).astype(np.float32)},
+            coords=np.random.randint(0, 1000, size=(n, 2)),
+        )
+    zarr.open_group(str(tmp_path / "incomplete.zarr"), mode="w").create_dataset("feats", data=np.zeros((5, 4)))
+
+    store = build_feature_store(tmp_path, encoding="bfloat16")
+    assert set(store.slides) == {"a", "b"} and store.slides["b"] == (30, 50)
+    assert sorted(store.groups) == ["coords", "feats", "feats_augs/flip"]
+    assert store["b"]["feats"].dtype == np.uint16
+
+    bags = [[tmp_path / "a.zarr", tmp_path / "b.zarr"]]
+    results = []
+    for backend in ["zarr", "store"]:
+        ds = FeatureDataset(
+            ["p"], bags, None, instances_per_bag=40, augmentations=[ORIGINAL_FEATURES, "flip"], backend=backend
+        )
+        np.random.seed(0)
+        results.append(ds[0][:2])
+    (zarr_feats, zarr_coords), (store_feats, store_coords) = results
+    assert (zarr_coords == store_coords).all()
+    assert np.allclose(zarr_feats, store_feats, rtol=1e-2)  # the store holds bfloat16 features
+
+
+def test_feature_store_rejects_unknown_slides(tmp_path):
+    save_features(tmp_path / "a.zarr", feats=np.zeros((3, 2)), feats_augs={}, coords=np.zeros((3, 2)))
+    build_feature_store(tmp_path)
+    with pytest.raises(KeyError):
+        FeatureStore(tmp_path / "store")["b"]
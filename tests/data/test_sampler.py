@@ -0,0 +1,22 @@
+import numpy as np
+
+from histaug.data.sampler import LengthBucketedBatchSampler
+
+
+def test_length_bucketed_batches_respect_token_budget():
+    np.random.seed(0)
+    lengths = np.random.randint(1, 100, size=200)
+    sampler = LengthBucketedBatchSampler(lengths, max_tokens=256, bucket_size=16)
+
+    epochs = [list(sampler), list(sampler)]
+    for batches in epochs:
+        assert len(batches) == len(sampler)
+        assert sorted(i for batch in batches for i in batch) == list(range(len(lengths)))  # each bag exactly once
+        assert all(len(batch) * lengths[batch].max() <= 256 for batch in batches)
+    assert epochs[0] != epochs[1]  # batches are shuffled every epoch
+
+
+def test_length_bucketed_batches_of_long_bags():
+    sampler = LengthBucketedBatchSampler([10, 500, 10, 10], max_tokens=20, bucket_size=3, shuffle=False)
+    assert list(sampler) == [[0, 2], [3], [1]]  # a bag longer than the budget forms a batch of its own
+    assert len(sampler) == 3
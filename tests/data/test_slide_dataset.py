@@ -0,0 +1,59 @@
+import numpy as np
+import zarr
+
+from histaug.data import SlideDataset, SlidesDataset, SlidesLoader
+from histaug.data.slide_dataset import chunk_aligned_batch_size, patches_to_tensor, tensor_to_patches
+
+
+def _make_slide(path, num_patches, chunk_rows=4):
+    g = zarr.open_group(str(path), mode="w")
+    patches = np.random.randint(0, 256, size=(num_patches, 8, 8, 3), dtype=np.uint8)
+    g.create_dataset("patches", data=patches, chunks=(chunk_rows, 8, 8, 3))
+    g["coords"] = np.arange(num_patches * 2).reshape(num_patches, 2)
+
+
+def test_slides_loader_yields_all_batches_in_order(tmp_path):
+    _make_slide(tmp_path / "a.zarr", 10)
+    _make_slide(tmp_path / "b.zarr", 7)
+    ds = SlidesDataset(tmp_path, batch_size=4)
+
+    loaded = [
+        (slide.name, batch_index, patches.shape[0], coords[0, 0].item())
+        for slide, batch_index, patches, coords, _ in SlidesLoader(((slide, 0) for slide in ds), num_workers=2)
+    ]
+    assert loaded == [("a", 0, 4, 0), ("a", 1, 4, 8), ("a", 2, 2, 16), ("b", 0, 4, 0), ("b", 1, 3, 8)]
+
+    # Resume from the second batch of each slide
+    loaded = [(slide.name, batch_index) for slide, batch_index, *_ in SlidesLoader(((s, 1) for s in ds), num_workers=0)]
+    assert loaded == [("a", 1), ("a", 2), ("b", 1)]
+
+
+def test_chunk_aligned_batch_size():
+    assert chunk_aligned_batch_size(256, 64) == 256
+    assert chunk_aligned_batch_size(300, 64) == 256
+    assert chunk_aligned_batch_size(256, 1000) == 250
+    assert chunk_aligned_batch_size(256, 1009) == 256  # prime number of rows per chunk: keep the batch size
+
+
+def test_slide_dataset_decompresses_each_chunk_once(tmp_path):
+    _make_slide(tmp_path / "a.zarr", 50, chunk_rows=8)
+    patches = zarr.open_group(str(tmp_path / "a.zarr"), mode="r")["patches"][:]
+    chunk_nbytes = 8 * 8 * 8 * 3
+
+    for batch_size, align_to_chunks, aligned_batch_size in [(12, True, 8), (12, False, 12), (5, False, 5)]:
+        slide = SlideDataset(tmp_path / "a.zarr", patches_to_tensor, tensor_to_patches, batch_size, align_to_chunks)
+        assert slide.batch_size == aligned_batch_size
+        batches = [tensor_to_patches(slide[i][0]).numpy() for i in range(len(slide))]
+        assert (np.concatenate(batches) == patches).all()
+        # Reading the batches sequentially decompresses every chunk exactly once, even if they are not aligned
+        assert slide.decompressed_bytes == 7 * chunk_nbytes
+
+
+def test_slides_loader_reads_each_chunk_in_one_worker(tmp_path):
+    _make_slide(tmp_path / "a.zarr", 32, chunk_rows=8)
+    ds = SlidesDataset(tmp_path, batch_size=2)
+    assert ds[0].batch_groups(1) == [range(1, 4), range(4, 8), range(8, 12), range(12, 16)]
+
+    loader = SlidesLoader(((slide, 0) for slide in ds), num_workers=2)
+    assert [batch_index for _, batch_index, *_ in loader] == list(range(16))
+    assert loader.decompression_overhead == 1.0  # batches of a chunk are not spread over the two workers
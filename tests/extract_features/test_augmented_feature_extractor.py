@@ -0,0 +1,88 @@
+import numpy as np
+import pytest
+import torch
+import zarr
+from torch import nn
+
+from histaug.augmentations import Augmentations
+from histaug.data import SlidesDataset
+from histaug.data.slide_dataset import patches_to_tensor
+from histaug.extract_features.augmented_feature_extractor import embed_views, iter_views
+from histaug.extract_features.slide_dataset import process_dataset, work_queue_dir
+from histaug.utils.saving import load_features
+
+
+class CountingLinear(nn.Linear):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.batch_sizes = []
+
+    def forward(self, x):
+        self.batch_sizes.append(len(x))
+        return super().forward(x)
+
+
+@pytest.mark.parametrize("micro_batch_size", [None, 1, 7, 10, 25, 100])
+def test_embed_views_micro_batches(micro_batch_size):
+    torch.manual_seed(0)
+    models = {"a": CountingLinear(4, 3), "b": CountingLinear(4, 2)}
+    views = [(f"view{i}", torch.randn(10, 4)) for i in range(5)]
+
+    with torch.no_grad():
+        outputs = embed_views(models, iter(views), micro_batch_size=micro_batch_size)
+
+        for name, model in models.items():
+            assert list(outputs[name].keys()) == [view_name for view_name, _ in views]
+            for view_name, view in views:
+                assert torch.allclose(outputs[name][view_name], nn.Linear.forward(model, view), atol=1e-6)
+            if micro_batch_size is not None:
+                assert max(model.batch_sizes) <= micro_batch_size
+                assert len(model.batch_sizes) == -(-50 // micro_batch_size)
+
+
+def test_iter_views_converts_uint8_patches():
+    patches = torch.randint(0, 256, (3, 8, 8, 3), dtype=torch.uint8)
+    augmentations = Augmentations({"flip": lambda x: x.flip(-1)})
+    float_views = dict(iter_views(augmentations, patches_to_tensor(patches.numpy())))
+    uint8_views = dict(iter_views(augmentations, patches))
+    for name, view in float_views.items():
+        assert uint8_views[name].dtype == torch.float32
+        assert torch.equal(uint8_views[name], view)
+
+
+def test_process_dataset_shares_augmented_views_between_models(tmp_path):
+    torch.manual_seed(0)
+    g = zarr.open_group(str(tmp_path / "slides" / "a.zarr"), mode="w")
+    g.create_dataset("patches", data=np.random.randint(0, 256, size=(10, 8, 8, 3), dtype=np.uint8), chunks=(4, 8, 8, 3))
+    g["coords"] = np.arange(20).reshape(10, 2)
+
+    models = []
+    for name, dim in [("a", 3), ("b", 5)]:
+        model = nn.Sequential(nn.Flatten(), nn.Linear(3 * 8 * 8, dim))
+        model.name = name
+        models.append(model)
+
+    views = []  # the randomly augmented patches of each batch
+
+    def noise(patches):
+        views.append(patches + torch.randn_like(patches))
+        return views[-1]
+
+    ds = SlidesDataset(tmp_path / "slides", batch_size=4)
+    process_dataset(ds, models, Augmentations({"noise": noise}), tmp_path / "features", device="cpu", num_workers=0)
+
+    assert len(views) == len(ds[0])  # each batch is augmented once, not once per model
+    with torch.no_grad():
+        for model in models:
+            loaded = load_features(tmp_path / "features" / model.name / "a.zarr")
+            assert loaded.feats.shape == (10, model[1].out_features)
+            expected = model(torch.cat(views)).numpy()
+            np.testing.assert_allclose(loaded.feats_augs["noise"], expected, atol=1e-5)
+
+
+def test_work_queue_dir_depends_on_models_and_augmentations(tmp_path):
+    queue_dir = work_queue_dir(tmp_path, ["swin", "ctranspath"], ["Macenko", "flip"])
+    assert queue_dir == work_queue_dir(tmp_path, ["ctranspath", "swin"], ["flip", "Macenko"])
+    assert queue_dir.parent == tmp_path
+    assert queue_dir != work_queue_dir(tmp_path, ["ctranspath"], ["Macenko", "flip"])
+    assert queue_dir != work_queue_dir(tmp_path, ["swin", "ctranspath"], ["Macenko"])
@@ -0,0 +1,31 @@
+import numpy as np
+import zarr
+
+from histaug.data import CachedFeatureDataset, FeatureDataset
+from histaug.data.feature_dataset import ORIGINAL_FEATURES
+from histaug.train.cache import BackgroundEpochCache
+
+
+def test_background_epoch_cache(tmp_path):
+    f = zarr.open_group(str(tmp_path / "slide.zarr"), mode="w")
+    f.create_dataset("feats", data=np.random.rand(30, 4).astype(np.float32))
+    f.create_dataset("coords", data=np.arange(60).reshape(30, 2))
+    ds = FeatureDataset(
+        ["p"], [[tmp_path / "slide.zarr"]], None, instances_per_bag=10, augmentations=[ORIGINAL_FEATURES]
+    )
+    cached_ds = CachedFeatureDataset(["p"], None, tmp_path / "cache")
+
+    cache = BackgroundEpochCache(ds, tmp_path / "cache", max_epochs=5, epochs_ahead=2)
+    try:
+        for epoch in range(5):
+            cache.wait_for(epoch)
+            epoch_files = sorted(p.name for p in (tmp_path / "cache" / f"epoch_{epoch:03d}").iterdir())
+            assert epoch_files == ["index.json", "indices.npy"]  # one packed file per epoch, not one per patient
+            cached_ds.epoch = epoch
+            feats, coords, _, _ = cached_ds[0]
+            assert feats.shape == (10, 4) and (feats == f["feats"][:][coords[:, 0] // 2]).all()
+            epochs_on_disk = sorted(int(d.name[len("epoch_") :]) for d in (tmp_path / "cache").glob("epoch_*"))
+            assert epochs_on_disk[0] >= epoch - 1 and epochs_on_disk[-1] <= epoch + 1
+    finally:
+        cache.close()
+    assert not (tmp_path / "cache").exists()
@@ -0,0 +1,51 @@
+import torch
+from omegaconf import OmegaConf
+
+from histaug.train.models import AttentionMIL, MeanAveragePooling
+from histaug.train.models.segment import segment_softmax
+
+
+def _pad(bags):
+    n_max = max(len(b) for b in bags)
+    feats = torch.zeros(len(bags), n_max, bags[0].shape[-1])
+    mask = torch.zeros(len(bags), n_max, dtype=torch.bool)
+    for i, b in enumerate(bags):
+        feats[i, : len(b)], mask[i, : len(b)] = b, True
+    return feats, mask
+
+
+def test_segment_softmax_matches_softmax_per_bag():
+    scores = torch.randn(10)
+    offsets = torch.tensor([0, 3, 3, 10])  # includes an empty bag
+    attention = segment_softmax(scores, offsets)
+    assert torch.allclose(attention[:3], scores[:3].softmax(0))
+    assert torch.allclose(attention[3:], scores[3:].softmax(0))
+
+
+def test_packed_bags_match_padded_bags():
+    torch.manual_seed(0)
+    targets = OmegaConf.create([dict(column="y", type="categorical", classes=["a", "b"])])
+    bags = [torch.randn(n, 8) for n in (5, 2, 7)]
+    feats, mask = _pad(bags)
+    packed, offsets = torch.cat(bags), torch.tensor([0, 5, 7, 14])
+    for model in (AttentionMIL(targets, d_features=8, hidden_dim=16), MeanAveragePooling(targets, d_features=8)):
+        model.eval()
+        assert torch.allclose(model(feats, None, mask)["y"], model(packed, None, offsets)["y"], atol=1e-6)
+
+
+def test_chunked_attention_matches_attention():
+    torch.manual_seed(0)
+    targets = OmegaConf.create([dict(column="y", type="categorical", classes=["a", "b"])])
+    bags = [torch.randn(n, 8) * 10 for n in (5, 2, 13)]
+    feats, mask = _pad(bags)
+    packed, offsets = torch.cat(bags), torch.tensor([0, 5, 7, 20])
+    model = AttentionMIL(targets, d_features=8, hidden_dim=16)
+    chunked = AttentionMIL(targets, d_features=8, hidden_dim=16, chunk_size=3)
+    chunked.load_state_dict(model.state_dict())
+    model.eval(), chunked.eval()
+    for inputs in ((feats, None, mask), (packed, None, offsets)):
+        logits, chunked_logits = model(*inputs)["y"], chunked(*inputs)["y"]
+        assert torch.allclose(logits, chunked_logits, atol=1e-5)
+        grad = torch.autograd.grad(logits.sum(), model.encoder[0].weight)[0]
+        chunked_grad = torch.autograd.grad(chunked_logits.sum(), chunked.encoder[0].weight)[0]
+        assert torch.allclose(grad, chunked_grad, atol=1e-5)
@@ -0,0 +1,43 @@
+import torch
+from omegaconf import OmegaConf
+
+from histaug.train.models import Transformer
+from histaug.train.models.transformer import z_order
+
+TARGETS = OmegaConf.create([dict(column="y", type="categorical", classes=["a", "b"])])
+
+
+def _padded_batch(lengths, d_features=8):
+    n_max = max(lengths)
+    feats = torch.randn(len(lengths), n_max, d_features)
+    coords = torch.randint(0, 10_000, (len(lengths), n_max, 2))
+    mask = torch.arange(n_max) < torch.tensor(lengths).unsqueeze(-1)
+    return feats, coords, mask
+
+
+def test_padding_does_not_change_predictions():
+    torch.manual_seed(0)
+    feats, coords, mask = _padded_batch([5, 9])
+    for attention_window in (None, 4):
+        model = Transformer(TARGETS, d_features=8, hidden_dim=16, num_heads=2, attention_window=attention_window)
+        model.eval()
+        logits = model(feats, coords, mask)["y"]
+        alone = model(feats[:1, :5], coords[:1, :5], mask[:1, :5])["y"]
+        assert torch.allclose(logits[0], alone[0], atol=1e-5)
+        assert not logits.isnan().any()
+
+
+def test_single_window_is_global_attention():
+    torch.manual_seed(0)
+    feats, coords, mask = _padded_batch([6, 3])
+    model = Transformer(TARGETS, d_features=8, hidden_dim=16, num_heads=2)
+    model.eval()
+    logits = model(feats, coords, mask)["y"]
+    model.attention_window = 6
+    assert torch.allclose(model(feats, coords, mask)["y"], logits, atol=1e-5)
+
+
+def test_z_order_puts_padding_last():
+    coords = torch.tensor([[[3, 3], [0, 0], [9, 9], [1, 0]]])
+    mask = torch.tensor([[True, True, False, True]])
+    assert z_order(coords, mask).tolist() == [[1, 3, 0, 2]]
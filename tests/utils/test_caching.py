@@ -0,0 +1,55 @@
+import numpy as np
+import pandas as pd
+
+from histaug.utils.caching import cached_df, clear_memory_cache, hash_df, _MemoryCache
+
+
+def _table(seed=0):
+    rng = np.random.default_rng(seed)
+    index = pd.MultiIndex.from_product([["low", "high"], ["a", "b"]], names=["magnification", "target"])
+    columns = pd.MultiIndex.from_product([["ctranspath", "vit"], ["mean", "std"]], names=["feature_extractor", "stats"])
+    return pd.DataFrame(rng.random((4, 4)), index=index, columns=columns)
+
+
+def test_cached_df_roundtrips_tables_and_memoizes(tmp_path):
+    calls = []
+
+    @cached_df(lambda seed: f"table_{seed}", cache_dir=tmp_path)
+    def make_table(seed):
+        calls.append(seed)
+        return _table(seed)
+
+    df = make_table(0)
+    df.iloc[0, 0] = -1  # callers get a copy
+    clear_memory_cache()
+    loaded = make_table(0)
+    assert calls == [0] and loaded.equals(_table(0))  # dtypes and multi-indices are preserved
+    assert (tmp_path / "table_0.parquet").exists()
+
+
+def test_cached_df_reads_legacy_csv_tables(tmp_path):
+    df = _table()
+    df.to_csv(tmp_path / "old_name.csv")
+    (tmp_path / "old_name.json").write_text('{"index_col": [0, 1], "header": [0, 1]}')
+
+    @cached_df(lambda: "new_name", cache_dir=tmp_path, legacy_table_name=lambda: "old_name", memoize=False)
+    def make_table():
+        raise AssertionError("should be loaded from the cache")
+
+    assert np.allclose(make_table().values, df.values)
+    assert (tmp_path / "new_name.parquet").exists()
+
+
+def test_hash_df_depends_on_content():
+    assert hash_df(_table(0)) == hash_df(_table(0)) != hash_df(_table(1))
+    assert hash_df(_table(0)) != hash_df(_table(0).rename(columns={"vit": "swin"}))
+
+
+def test_memory_cache_evicts_least_recently_used():
+    df = pd.DataFrame({"a": np.zeros(100)})
+    size = df.memory_usage(deep=True, index=True).sum()
+    cache = _MemoryCache(max_bytes=2 * size)
+    cache.put("x", df), cache.put("y", df)
+    cache.get("x")
+    cache.put("z", df)
+    assert cache.get("y") is None and cache.get("x") is not None and cache.get("z") is not None
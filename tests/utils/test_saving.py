@@ -0,0 +1,108 @@
+import numpy as np
+import pytest
+import zarr
+
+from histaug.extract_features.verify_encoding import cosine_error
+from histaug.utils.saving import FeatureWriter, check_version, load_features, save_features
+
+
+def test_feature_writer_resume(tmp_path):
+    file = tmp_path / "slide.zarr"
+    feats = np.random.rand(10, 4).astype(np.float32)
+    feats_aug = np.random.rand(10, 4).astype(np.float32)
+    coords = np.arange(20).reshape(10, 2)
+
+    writer = FeatureWriter(file, num_patches=10, coords=coords, chunk_size=4)
+    writer.write(0, feats[:3], {"aug": feats_aug[:3]})
+    writer.write(3, feats[3:6], {"aug": feats_aug[3:6]})
+    assert writer.num_written == 6
+    assert not check_version(file, throw=False)
+
+    # Re-opening a partially written file resumes it
+    writer = FeatureWriter(file, num_patches=10, coords=coords, chunk_size=4)
+    assert writer.num_written == 6
+    writer.write(6, feats[6:], {"aug": feats_aug[6:]})
+    writer.close()
+    assert check_version(file)
+
+    f = zarr.open_group(str(file), mode="r")
+    assert (f["feats"][:] == feats).all()
+    assert (f["feats_augs/aug"][:] == feats_aug).all()
+    assert (f["coords"][:] == coords).all()
+    assert "feats_norm" not in f
+
+
+def test_feature_writer_restarts_on_mismatch(tmp_path):
+    file = tmp_path / "slide.zarr"
+    writer = FeatureWriter(file, num_patches=10)
+    writer.write(0, np.zeros((5, 4), dtype=np.float32), {})
+    assert FeatureWriter(file, num_patches=12).num_written == 0
+
+    # Partial files written with another chunk size or compressor are not resumed either
+    for kwargs in [dict(chunk_size=4), dict(compressor="lz4"), dict(compressor="lz4:1")]:
+        writer = FeatureWriter(file, num_patches=10)
+        writer.write(0, np.zeros((5, 4), dtype=np.float32), {})
+        assert FeatureWriter(file, num_patches=10).num_written == 5
+        assert FeatureWriter(file, num_patches=10, **kwargs).num_written == 0
+
+
+@pytest.mark.parametrize(
+    "encoding, max_error", [("float32", 1e-6), ("float16", 1e-5), ("bfloat16", 1e-4), ("int8", 1e-2)]
+)
+def test_feature_encodings(tmp_path, encoding, max_error):
+    np.random.seed(0)
+    feats = np.random.randn(50, 16).astype(np.float32)
+    feats_aug = np.random.randn(50, 16).astype(np.float32) * 10
+    save_features(tmp_path / "a.zarr", feats, {"aug": feats_aug}, coords=np.zeros((50, 2)), encoding=encoding)
+    loaded = load_features(tmp_path / "a.zarr")
+    assert loaded.feats.dtype == np.float32 and loaded.feats.shape == feats.shape
+    assert cosine_error(feats, loaded.feats).max() <= max_error
+    assert cosine_error(feats_aug, loaded.feats_augs["aug"]).max() <= max_error
+
+    # Features written batch by batch are encoded the same way
+    writer = FeatureWriter(tmp_path / "b.zarr", num_patches=50, encoding=encoding)
+    writer.write(0, feats[:25], {"aug": feats_aug[:25]})
+    writer.write(25, feats[25:], {"aug": feats_aug[25:]})
+    writer.close()
+    loaded = load_features(tmp_path / "b.zarr")
+    assert cosine_error(feats, loaded.feats).max() <= max_error
+    assert cosine_error(feats_aug, loaded.feats_augs["aug"]).max() <= max_error
+
+
+@pytest.mark.parametrize("compressor", ["default", "none", "lz4", "zstd:3:bitshuffle"])
+def test_save_features_compressor_and_chunks(tmp_path, compressor):
+    feats = np.random.rand(100, 8).astype(np.float32)
+    save_features(tmp_path / "a.zarr", feats, {}, coords=None, chunk_size=32, compressor=compressor)
+    f = zarr.open_group(str(tmp_path / "a.zarr"), mode="r")
+    assert f["feats"].chunks == (32, 8)
+    assert (f["feats"].compressor is None) == (compressor == "none")
+    assert (f["feats"][:] == feats).all()
+
+
+def test_feature_writer_int8_scale_covers_all_batches(tmp_path):
+    np.random.seed(0)
+    feats = np.random.randn(40, 8).astype(np.float32)
+    feats[30:] *= 10  # a later batch exceeds the range of the first one
+
+    writer = FeatureWriter(tmp_path / "a.zarr", num_patches=40, encoding="int8", chunk_size=16)
+    for start in range(0, 40, 10):
+        writer.write(start, feats[start : start + 10], {"aug": -feats[start : start + 10]})
+    writer.close()
+    f = zarr.open_group(str(tmp_path / "a.zarr"), mode="r")
+    assert f["feats"].dtype == np.int8 and f["feats"].chunks == (16, 8)
+    assert list(f.array_keys()) == ["feats"] and list(f["feats_augs"].array_keys()) == ["aug"]
+
+    # Encoded like save_features(), i.e. with the scale of the whole array and without clipping
+    loaded = load_features(tmp_path / "a.zarr")
+    save_features(tmp_path / "b.zarr", feats, {"aug": -feats}, coords=None, encoding="int8")
+    expected = load_features(tmp_path / "b.zarr")
+    assert (loaded.feats == expected.feats).all() and (loaded.feats_augs["aug"] == expected.feats_augs["aug"]).all()
+    assert np.abs(loaded.feats - feats).max() <= np.abs(feats).max(axis=0).max() / 127
+
+
+def test_load_features_n(tmp_path):
+    feats = np.random.rand(10, 4).astype(np.float32)
+    save_features(tmp_path / "a.zarr", feats, {"aug": feats}, coords=np.zeros((10, 2)))
+    for n, expected_rows in [(None, 10), (0, 10), (3, 3)]:
+        loaded = load_features(tmp_path / "a.zarr", n=n)
+        assert len(loaded.feats) == len(loaded.coords) == len(loaded.feats_augs["aug"]) == expected_rows
@@ -1,5 +1,7 @@
-from histaug.utils.statistics import RunningStats
+from histaug.utils.statistics import RunningStats, max_minus_value_stats
+import itertools
 import math
+import numpy as np
 
 
 def test_initialization():
@@ -55,3 +57,19 @@ def test_update_with_multiple_data_points():
     mean, std = stats.compute()
     assert mean == expected_mean
     assert std == expected_std
+
+
+def test_max_minus_value_stats_matches_brute_force():
+    rng = np.random.default_rng(0)
+    for n, k in [(1, 1), (3, 2), (4, 4), (5, 3)]:
+        values = rng.random((n, k)).round(1)  # with ties
+        brute_force = [RunningStats() for _ in range(k)]
+        for x in itertools.product(*values.T):
+            for stats, diff in zip(brute_force, max(x) - np.array(x)):
+                stats.update(diff)
+        for expected, actual in zip(brute_force, max_minus_value_stats(values)):
+            assert np.allclose(expected.compute(), actual)
+
+
+def test_max_minus_value_stats_with_nan():
+    assert all(math.isnan(s.mean) for s in max_minus_value_stats(np.array([[0.5, np.nan], [0.6, 0.7]])))
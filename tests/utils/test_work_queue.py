@@ -0,0 +1,39 @@
+import os
+import time
+
+from histaug.utils.work_queue import WorkQueue
+
+
+def test_work_queue_splits_items(tmp_path):
+    keys = [f"slide{i}" for i in range(6)]
+    queue_a = WorkQueue(tmp_path, keys)
+    queue_b = WorkQueue(tmp_path, keys)
+
+    claimed_a, claimed_b = [], []
+    iter_a, iter_b = iter(queue_a), iter(queue_b)
+    for _ in range(3):
+        claimed_a.append(next(iter_a))
+        claimed_b.append(next(iter_b))
+    assert list(iter_a) == [] and list(iter_b) == []
+
+    assert sorted(claimed_a + claimed_b) == list(range(6))
+    assert len(queue_a) == 0
+
+
+def test_work_queue_resumes_after_failure(tmp_path):
+    keys = ["a", "b", "c"]
+    for index in WorkQueue(tmp_path, keys):
+        if index == 1:
+            break  # e.g. an exception while processing "b"
+
+    assert [keys[index] for index in WorkQueue(tmp_path, keys)] == ["b", "c"]
+
+
+def test_work_queue_releases_stale_claims(tmp_path):
+    keys = ["a", "b"]
+    # Simulate a crashed worker whose claim has not been refreshed for a while
+    (tmp_path / "a.lock").touch()
+    assert not WorkQueue(tmp_path, keys, heartbeat_interval=0.1, stale_after=1.0).claim("a")
+    old = time.time() - 10
+    os.utime(tmp_path / "a.lock", (old, old))
+    assert list(WorkQueue(tmp_path, keys, heartbeat_interval=0.1, stale_after=1.0)) == [0, 1]